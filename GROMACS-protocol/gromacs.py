@@ -51,6 +51,40 @@ def argument_parser():
              'task or to suit the specific computational workload.',
         default='0'
     )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        help='Number of identifiers to simulate at once. The cores are'
+             ' split into one pinned slot per job, overriding --ntomp.',
+        default=1
+    )
+    parser.add_argument(
+        '--cores',
+        type=int,
+        help='Number of cores shared by the jobs, all cores by default.',
+        default=None
+    )
+    parser.add_argument(
+        '--prepare_jobs',
+        type=int,
+        help='Number of identifiers prepared at once before the mdrun'
+             ' queue starts, all cores by default.',
+        default=None
+    )
+    parser.add_argument(
+        '--cache_directory',
+        type=str,
+        help='Directory of the preparation cache shared by identifiers'
+             ' with the same cleaned structure, .prep_cache in the'
+             ' output directory by default.',
+        default=None
+    )
+    parser.add_argument(
+        '--no_cache',
+        action='store_true',
+        default=False,
+        help='Prepare every identifier without the preparation cache.'
+    )
     args = parser.parse_args()
     return args
 
@@ -64,11 +98,21 @@ def main():
         GMX=args.GMX,
         hard_force=args.hard_force,
         ntomp=args.ntomp,
-        ntmpi=args.ntmpi
-    )
-    gromacs_prot.main(
-        args_list=gromacs_prot.identifiers_list
+        ntmpi=args.ntmpi,
+        cache_directory=args.cache_directory,
+        use_cache=not args.no_cache
     )
+    if args.jobs > 1:
+        gromacs_prot.run_campaign(
+            args_list=gromacs_prot.identifiers_list,
+            jobs=args.jobs,
+            total_cores=args.cores,
+            prepare_jobs=args.prepare_jobs
+        )
+    else:
+        gromacs_prot.main(
+            args_list=gromacs_prot.identifiers_list
+        )
 
 
 if __name__ == '__main__':
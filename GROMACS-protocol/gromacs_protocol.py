@@ -2,16 +2,486 @@
 # a) Set up node by install nvm. The node version should be around 16 or later
 # b) Install npm icn3d by following the "Installation" instruction at 
 # https://github.com/ncbi/icn3d/tree/master/icn3dnode
-# c) Download the script "rmhet.js" and "addmissingatoms.js" to your directory from
+# c) Download the script "addmissingatoms.js" to your directory from
 # https://github.com/ncbi/icn3d/tree/master/icn3dnode.
+# Waters and hetero atoms are removed in Python with pdb_analysis_lib,
+# in place of grep and "rmhet.js".
 
+import glob
+import hashlib
+import json
 import os
+import re
+import resource
 import sys
 import time
 import shutil
-from subprocess import PIPE, DEVNULL, STDOUT, Popen, run, TimeoutExpired, call
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from subprocess import PIPE, DEVNULL, STDOUT, Popen, run, TimeoutExpired, call, CompletedProcess
+from tempfile import TemporaryFile
 from multiprocessing import Process
 
+# pdb_analysis_lib is in the directory above GROMACS-protocol
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pdb_analysis_lib as pal
+
+
+# Completion markers of the stages of a simulation, kept in its directory
+STAGES_DIRECTORY = '.stages'
+HASH_CHUNK_SIZE = 1 << 20
+# Preparation cache, shared by the simulations of an output directory
+CACHE_DIRECTORY = '.prep_cache'
+# Stands for the identifier in the file names of the preparation cache
+IDENTIFIER_PLACEHOLDER = '{identifier}'
+# JSON lines of the metrics of each stage run, kept in the simulation directory
+TELEMETRY_FILE = 'telemetry.jsonl'
+# Summary of the telemetry of all simulations, kept in the output directory
+SUMMARY_FILE = 'campaign_summary.json'
+# Characters of the error of a failed command kept in its telemetry
+TELEMETRY_ERROR_LENGTH = 2000
+
+
+def file_hash(file_path: str):
+    """
+    SHA-256 of the content of a file.
+    """
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def read_marker(sim_dir: str, name: str, state: str):
+    """
+    Hash recorded in the marker of a stage, None when there is none.
+    state is 'started' or 'done'.
+    """
+    marker = os.path.join(sim_dir, STAGES_DIRECTORY, f'{name}.{state}')
+    try:
+        with open(marker) as f:
+            return json.load(f)['digest']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def marker_files(sim_dir: str, name: str):
+    """
+    Files a completed stage shares with the preparation cache, as
+    recorded in its marker.
+    """
+    marker = os.path.join(sim_dir, STAGES_DIRECTORY, f'{name}.done')
+    try:
+        with open(marker) as f:
+            return json.load(f).get('files', [])
+    except (OSError, ValueError, AttributeError):
+        return []
+
+
+def write_marker(sim_dir: str, name: str, state: str, digest: str, files: list = None):
+    """
+    Record the hash of the inputs of a stage in its marker, with the
+    files it shares with the preparation cache when given.
+    The marker is renamed into place, so it is never left half written.
+    """
+    stages_dir = os.path.join(sim_dir, STAGES_DIRECTORY)
+    os.makedirs(stages_dir, exist_ok=True)
+    marker = os.path.join(stages_dir, f'{name}.{state}')
+    content = {'digest': digest, 'time': time.time()}
+    if files is not None:
+        content['files'] = list(files)
+    with open(f'{marker}.tmp', 'w') as f:
+        json.dump(content, f)
+    os.replace(f'{marker}.tmp', marker)
+
+
+def generic_name(file_name: str, identifier: str):
+    """
+    Name of a file in the preparation cache, with the identifier prefix
+    of identifier specific files replaced by IDENTIFIER_PLACEHOLDER.
+    """
+    if file_name.startswith(f'{identifier}_'):
+        return IDENTIFIER_PLACEHOLDER + file_name[len(identifier):]
+    return file_name
+
+
+def identifier_name(file_name: str, identifier: str):
+    """
+    Name in a simulation directory of a file of the preparation cache.
+    """
+    if file_name.startswith(f'{IDENTIFIER_PLACEHOLDER}_'):
+        return identifier + file_name[len(IDENTIFIER_PLACEHOLDER):]
+    return file_name
+
+
+def link_or_copy(source: str, target: str):
+    """
+    Hard-link source to target, or copy it across file systems.
+    An existing target is replaced.
+    """
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def directory_files(directory: str):
+    """
+    Modification time of each file of a directory, by name. Hidden files
+    and the backups GROMACS makes of overwritten files are left out.
+    """
+    return {
+        entry.name: entry.stat().st_mtime_ns
+        for entry in os.scandir(directory)
+        if entry.is_file() and not entry.name.startswith(('.', '#'))
+    }
+
+
+def is_pattern(file_name: str):
+    """
+    Whether a stage file name is a glob pattern, for files such as the
+    per chain topologies of pdb2gmx whose names depend on the structure.
+    """
+    return glob.has_magic(file_name)
+
+
+def expand_files(sim_dir: str, file_names: list):
+    """
+    Names of the files of a simulation directory matching the stage file
+    names, patterns expanded in sorted order and named files kept as is.
+    """
+    expanded = []
+    for file_name in file_names:
+        if is_pattern(file_name):
+            expanded.extend(sorted(
+                os.path.basename(match)
+                for match in glob.glob(os.path.join(glob.escape(sim_dir), file_name))
+            ))
+        else:
+            expanded.append(file_name)
+    return expanded
+
+
+class Stage:
+    """
+    One step of the protocol: a command run in the simulation directory,
+    reading its input files and writing its output files.
+    options are command arguments left out of the hash, stdout is the
+    file written with the output of the command, copies are (source,
+    target) files copied before the command runs, and deffnm names the
+    files of an mdrun stage, which resumes from its checkpoint.
+    function, when given, is run in this process in place of the command,
+    with the simulation directory as argument, and the command then only
+    describes it in the hash.
+    The outputs of a cache stage are shared between identifiers through
+    the preparation cache.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            command: list,
+            inputs: list,
+            outputs: list,
+            options: list = (),
+            stdout: str = None,
+            copies: list = (),
+            input: bytes = None,
+            deffnm: str = None,
+            cache: bool = False,
+            function=None,
+    ):
+        self.name = name
+        self.command = list(command)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.options = list(options)
+        self.stdout = stdout
+        self.copies = list(copies)
+        self.input = input
+        self.deffnm = deffnm
+        self.cache = cache
+        self.function = function
+
+    def input_hashes(self, sim_dir: str):
+        hashes = []
+        for file_name in self.inputs:
+            if is_pattern(file_name):
+                # Files matched by a pattern are hashed with their names
+                hashes.append(hashlib.sha256(json.dumps([
+                    [match, file_hash(os.path.join(sim_dir, match))]
+                    for match in expand_files(sim_dir, [file_name])
+                ]).encode()).hexdigest())
+                continue
+            file_path = os.path.join(sim_dir, file_name)
+            if not os.path.exists(file_path):
+                raise ValueError(
+                    f'input {file_name} of stage {self.name} is missing'
+                )
+            hashes.append(file_hash(file_path))
+        return hashes
+
+    def digest(self, sim_dir: str):
+        """
+        SHA-256 of the command and the content of the input files.
+        """
+        sha = hashlib.sha256()
+        sha.update(json.dumps([self.name, self.command]).encode())
+        if self.input is not None:
+            sha.update(self.input)
+        for input_hash in self.input_hashes(sim_dir):
+            sha.update(input_hash.encode())
+        return sha.hexdigest()
+
+    def cache_key(self, sim_dir: str, identifier: str):
+        """
+        SHA-256 of the command and the content of the input files, with
+        the names of the input files and the identifier left out, so that
+        identifiers with the same inputs share the key. The command holds
+        the force field, water model and box parameters.
+        """
+        command = [
+            f'<input {self.inputs.index(arg)}>' if arg in self.inputs
+            else generic_name(arg, identifier)
+            for arg in self.command
+        ]
+        sha = hashlib.sha256()
+        sha.update(json.dumps([self.name, command]).encode())
+        if self.input is not None:
+            sha.update(self.input)
+        for input_hash in self.input_hashes(sim_dir):
+            sha.update(input_hash.encode())
+        return sha.hexdigest()
+
+    def is_done(self, sim_dir: str, digest: str):
+        """
+        Whether the stage completed with these inputs and its outputs exist.
+        Output patterns may match no file, so only named outputs are checked.
+        """
+        return read_marker(sim_dir, self.name, 'done') == digest and all(
+            os.path.exists(os.path.join(sim_dir, file_name))
+            for file_name in self.outputs
+            if not is_pattern(file_name)
+        )
+
+
+def stage_order(stages: list):
+    """
+    Sort stages so that each one comes after the stages writing its inputs.
+    Independent stages keep their order.
+    """
+    producers = {}
+    for stage in stages:
+        for file_name in stage.outputs:
+            producers[file_name] = stage.name
+    depends = {
+        stage.name: {
+            producers[file_name]
+            for file_name in stage.inputs
+            if file_name in producers and producers[file_name] != stage.name
+        }
+        for stage in stages
+    }
+    ordered = []
+    done = set()
+    remaining = list(stages)
+    while remaining:
+        ready = [stage for stage in remaining if depends[stage.name] <= done]
+        if not ready:
+            raise ValueError(
+                'cyclic stages: '
+                + ', '.join(stage.name for stage in remaining)
+            )
+        for stage in ready:
+            ordered.append(stage)
+            done.add(stage.name)
+        remaining = [stage for stage in remaining if stage.name not in done]
+    return ordered
+
+
+def parse_mdrun_log(log_file: str):
+    """
+    Performance of a run from the last accounting at the end of its mdrun
+    log: number of atoms, MPI ranks and OpenMP threads used, core and wall
+    time, ns/day and the wall time and share of each activity of the cycle
+    accounting. Values missing from the log, such as the ns/day of an
+    energy minimization, are left out.
+    """
+    try:
+        with open(log_file, errors='replace') as f:
+            text = f.read()
+    except OSError:
+        return {}
+    metrics = {}
+    atoms = re.findall(r'There are:\s+(\d+)\s+Atoms', text)
+    if atoms:
+        metrics['atoms'] = int(atoms[-1])
+    # A resumed run appends to the log, so its last accounting is read
+    start = text.rfind('R E A L   C Y C L E')
+    if start == -1:
+        return metrics
+    text = text[start:]
+    layout = re.search(
+        r'On (\d+) MPI ranks?(?:, each using (\d+) OpenMP threads?)?', text
+    )
+    if layout:
+        metrics['mpi_ranks'] = int(layout.group(1))
+        if layout.group(2):
+            metrics['openmp_threads'] = int(layout.group(2))
+    cycle_accounting = {}
+    in_table = False
+    for line in text.splitlines():
+        if line.startswith('-----'):
+            if in_table:
+                break
+            in_table = True
+            continue
+        if not in_table:
+            continue
+        fields = re.split(r'\s{2,}', line.strip())
+        try:
+            wall_time, percent = float(fields[-3]), float(fields[-1])
+        except (IndexError, ValueError):
+            continue
+        cycle_accounting[fields[0]] = {'wall_time': wall_time, 'percent': percent}
+    if cycle_accounting:
+        metrics['cycle_accounting'] = cycle_accounting
+    times = re.search(r'Time:\s+([\d.]+)\s+([\d.]+)', text)
+    if times:
+        metrics['core_time'] = float(times.group(1))
+        metrics['mdrun_wall_time'] = float(times.group(2))
+    performance = re.search(r'Performance:\s+([\d.]+)\s+([\d.]+)', text)
+    if performance:
+        metrics['ns_per_day'] = float(performance.group(1))
+        metrics['hours_per_ns'] = float(performance.group(2))
+    return metrics
+
+
+def write_telemetry(sim_dir: str, record: dict):
+    """
+    Append the metrics of a stage to the telemetry of a simulation.
+    """
+    with open(os.path.join(sim_dir, TELEMETRY_FILE), 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def read_telemetry(sim_dir: str):
+    """
+    Metrics of the stages of a simulation, in the order they ran.
+    """
+    try:
+        with open(os.path.join(sim_dir, TELEMETRY_FILE)) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except OSError:
+        return []
+
+
+def summarize_telemetry(records: list):
+    """
+    Campaign summary of the telemetry of several simulations.
+    Only the last record of each stage of an identifier is counted.
+    Stages are summed by status, with the mean ns/day of mdrun stages,
+    and mdrun stages are listed with their system size, thread layout and
+    performance, for tuning the thread layout per system size.
+    """
+    last = {}
+    for record in records:
+        last[(record['identifier'], record['stage'])] = record
+    stages = {}
+    mdruns = []
+    for record in last.values():
+        summary = stages.setdefault(record['stage'], {
+            'run': 0,
+            'resumed': 0,
+            'cached': 0,
+            'failed': 0,
+            'wall_time': 0.0,
+            'cpu_time': 0.0,
+        })
+        summary[record['status']] += 1
+        summary['wall_time'] += record.get('wall_time', 0.0)
+        summary['cpu_time'] += record.get('cpu_time', 0.0)
+        if 'ns_per_day' in record:
+            summary.setdefault('ns_per_day', []).append(record['ns_per_day'])
+            mdruns.append({
+                key: record.get(key)
+                for key in (
+                    'identifier',
+                    'stage',
+                    'atoms',
+                    'ntmpi',
+                    'ntomp',
+                    'mpi_ranks',
+                    'openmp_threads',
+                    'ns_per_day',
+                    'wall_time',
+                    'cpu_utilisation',
+                    'peak_rss_kb',
+                )
+            })
+    for summary in stages.values():
+        if 'ns_per_day' in summary:
+            values = summary.pop('ns_per_day')
+            summary['mean_ns_per_day'] = sum(values) / len(values)
+    return {
+        'identifiers': len({identifier for identifier, _ in last}),
+        'wall_time': sum(summary['wall_time'] for summary in stages.values()),
+        'cpu_time': sum(summary['cpu_time'] for summary in stages.values()),
+        'stages': stages,
+        'mdrun': sorted(
+            mdruns,
+            key=lambda row: (row['stage'], row['atoms'] or 0, row['identifier'])
+        ),
+    }
+
+
+def core_slots(total_cores: int, jobs: int, ntmpi: int = 1):
+    """
+    Split cores into one slot per concurrent job.
+    Each slot is a dict of the ntmpi and ntomp of its mdrun and the
+    pinoffset of its first core, so that jobs are pinned to disjoint cores.
+    """
+    cores_per_job = total_cores // jobs
+    ntmpi = max(1, int(ntmpi or 1))
+    ntomp = cores_per_job // ntmpi
+    if ntomp < 1:
+        raise ValueError(
+            f'{total_cores} cores cannot run {jobs} jobs'
+            f' of {ntmpi} MPI threads'
+        )
+    return [
+        {
+            'ntmpi': str(ntmpi),
+            'ntomp': str(ntomp),
+            'pinoffset': str(job * cores_per_job)
+        }
+        for job in range(jobs)
+    ]
+
+
+def run_protocol(
+        gromacs_protocol,
+        identifier: str,
+        slot: dict = None,
+        prepare_only: bool = False,
+):
+    """
+    Run the protocol of one identifier in a worker process.
+    Returns the identifier, the time taken and any error message.
+    """
+    tic = time.time()
+    try:
+        gromacs_protocol.protocol(
+            identifier=identifier,
+            slot=slot,
+            prepare_only=prepare_only
+        )
+    except ValueError as e:
+        return identifier, time.time() - tic, str(e)
+    return identifier, time.time() - tic, None
+
 
 class GromacsProtocol:
     def __init__(
@@ -23,14 +493,26 @@ class GromacsProtocol:
             ntomp: str,
             GMX='gmx',
             hard_force: bool = False,
+            cache_directory: str = None,
+            use_cache: bool = True,
     ):
-        self.pdb_directory = pdb_directory
-        self.output_directory = output_directory
-        self.mdp_directory = mdp_directory
+        # Commands run with the simulation directory as cwd,
+        # so every directory is kept as an absolute path
+        self.pdb_directory = os.path.abspath(pdb_directory)
+        self.output_directory = os.path.abspath(output_directory)
+        self.mdp_directory = os.path.abspath(mdp_directory)
         self.GMX = GMX
         self.ntmpi = ntmpi
         self.ntomp = ntomp
         self.hard_force = hard_force
+        # Preparations are shared by identifiers of the same protein,
+        # such as a WT and its mutants, through the preparation cache
+        if not use_cache:
+            self.cache_directory = None
+        elif cache_directory is None:
+            self.cache_directory = os.path.join(self.output_directory, CACHE_DIRECTORY)
+        else:
+            self.cache_directory = os.path.abspath(cache_directory)
         self.identifiers_list = [
             filename.rsplit('_NoHOH.pdb')[0]
             if "NoHOH" in filename
@@ -58,101 +540,162 @@ class GromacsProtocol:
             raise ValueError(
                 'all identifiers should be distinct'
             )
-        # remove incomplete runs
-        for identifier in os.listdir(self.output_directory):
-            dir_path = os.path.join(
-                self.output_directory,
-                identifier
-            )
-            contains_edr = any(
-                file.endswith('.edr') for file in os.listdir(dir_path)
-            )
-            if not contains_edr:
-                shutil.rmtree(dir_path)
 
     @staticmethod
-    def subprocess_call(command_list: list, capture_output=False):
-        stdout_setting = PIPE if capture_output else DEVNULL
-        result = run(
-            command_list,
-            stdout=stdout_setting,
-            stderr=PIPE
-        )
+    def subprocess_call(
+            command_list: list,
+            capture_output=False,
+            cwd=None,
+            input=None,
+            usage: dict = None
+    ):
+        """
+        Run a command, raising ValueError with its stderr when it fails.
+        usage, when given, is filled with the CPU time and peak RSS of the
+        command, read from the resource usage of its process.
+        """
+        with TemporaryFile() as stdout_file, TemporaryFile() as stderr_file:
+            process = Popen(
+                command_list,
+                stdin=PIPE if input is not None else None,
+                stdout=stdout_file if capture_output else DEVNULL,
+                stderr=stderr_file,
+                cwd=cwd
+            )
+            if input is not None:
+                try:
+                    process.stdin.write(input)
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+            _, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            stdout_file.seek(0)
+            stderr_file.seek(0)
+            result = CompletedProcess(
+                command_list,
+                process.returncode,
+                stdout_file.read() if capture_output else None,
+                stderr_file.read()
+            )
+        if usage is not None:
+            usage['cpu_time'] = rusage.ru_utime + rusage.ru_stime
+            usage['peak_rss_kb'] = rusage.ru_maxrss
         if result.returncode != 0:
             error_message = result.stderr.decode('utf-8') if result.stderr else 'Unknown error'
             raise ValueError(f'{error_message}')
         else:
             return result
 
-    def protocol(
+    def mdrun_options(self, slot: dict = None):
+        """
+        Threading and pinning options of mdrun. They do not change the
+        results, so they are left out of the hash of mdrun stages.
+        """
+        ntmpi = slot['ntmpi'] if slot else self.ntmpi
+        ntomp = slot['ntomp'] if slot else self.ntomp
+        options = ['-ntomp', ntomp]
+        if ntmpi:
+            options.extend(['-ntmpi', str(ntmpi)])
+        if slot:
+            options.extend([
+                '-pin',
+                'on',
+                '-pinoffset',
+                slot['pinoffset'],
+                '-pinstride',
+                '1'
+            ])
+        return options
+
+    def mdrun_stage(self, name: str, deffnm: str, outputs: list, slot: dict = None):
+        return Stage(
+            name,
+            [self.GMX, 'mdrun', '-deffnm', deffnm],
+            inputs=[f'{deffnm}.tpr'],
+            outputs=outputs,
+            options=self.mdrun_options(slot),
+            deffnm=deffnm
+        )
+
+    def stages(
             self,
             identifier: str,
+            slot: dict = None,
     ):
-        simulation_directory = os.path.join(self.output_directory, identifier)
-        if not os.path.exists(simulation_directory):
-            os.mkdir(simulation_directory)
-        os.chdir(simulation_directory)
+        """
+        The steps of the protocol of an identifier as a list of Stage.
+        Files are named relative to the simulation directory. Commands
+        editing topol.top in place work on their own copy of it, so that
+        no stage writes a file it reads. The stages up to solvate are
+        deterministic, so their outputs are cached.
+        """
+        stages = []
+        # Restraint and per chain topologies written by pdb2gmx and
+        # included by topol.top, so they are inputs of every grompp
+        itp_files = ['posre*.itp', 'topol_processed_*.itp']
         # STEP 0:remove any water molecules to create a clean PDB:
-        pdb_file_direct = os.path.join(self.pdb_directory, f'{identifier}_NoHOH.pdb')
-        if not os.path.exists(pdb_file_direct):
-            pdb_file_direct = os.path.join(self.pdb_directory, f'{identifier}.pdb')
-            molecules = ["HOH", "PO4"]
-            pattern = '|'.join(molecules)
-            rmv_hoh_command = [
-                "grep",
-                "-v",
-                "-E",  # Use extended regular expressions
-                pattern,
-                pdb_file_direct
-            ]
-            with open(f"{identifier}_NoHOH.pdb", 'w') as out:
-                run(rmv_hoh_command, stdout=out)
+        pdb_file = os.path.join(self.pdb_directory, f'{identifier}_NoHOH.pdb')
+        if not os.path.exists(pdb_file):
+            pdb_file = os.path.join(self.pdb_directory, f'{identifier}.pdb')
         # STEP 1: The following step will remove all hetero atoms,
         # use one chain name, and add missing atoms
-        rmhet_command = [
-            "node",
-            os.path.join(self.mdp_directory, 'rmhet.js'),
-            f'{identifier}_NoHOH.pdb'
-        ]
-        result = self.subprocess_call(
-            command_list=rmhet_command,
-            capture_output=True
-        )
-        with open(f'{identifier}_nohet.pdb', 'w') as out:
-            out.write(result.stdout.decode())
-        addmissingatom_command = [
-            "node",
-            os.path.join(self.mdp_directory, 'addmissingatoms.js'),
-            f'{identifier}_nohet.pdb'
-        ]
-        result = self.subprocess_call(
-            command_list=addmissingatom_command,
-            capture_output=True
-        )
-        with open(f'{identifier}_clean.pdb', 'w') as out:
-            out.write(result.stdout.decode())
+        molecules = ["HOH", "PO4"]
+
+        def clean_pdb(sim_dir):
+            pal.clean_pdb_file(
+                pdb_file,
+                os.path.join(sim_dir, f'{identifier}_nohet.pdb'),
+                residues=molecules,
+                hetatm=True,
+                merge_chains=True
+            )
+        stages.append(Stage(
+            'clean_pdb',
+            ['clean_pdb', ','.join(molecules), 'hetatm', 'merge_chains', pdb_file],
+            inputs=[pdb_file],
+            outputs=[f'{identifier}_nohet.pdb'],
+            function=clean_pdb,
+            cache=True
+        ))
+        addmissingatoms_script = os.path.join(self.mdp_directory, 'addmissingatoms.js')
+        stages.append(Stage(
+            'addmissingatoms',
+            ["node", addmissingatoms_script, f'{identifier}_nohet.pdb'],
+            inputs=[addmissingatoms_script, f'{identifier}_nohet.pdb'],
+            outputs=[f'{identifier}_clean.pdb'],
+            stdout=f'{identifier}_clean.pdb',
+            cache=True
+        ))
         # STEP 2: Here we select AMBER99SB-ILDN force-field
         # (#6 in the list)
         # for describing atom-atom interaction energies
         # to be used in the GROMACS simulations.
-        if not os.path.exists(f'{identifier}_processed.gro'):
-            pdb2gmx_command = [
+        stages.append(Stage(
+            'pdb2gmx',
+            [
                 self.GMX,
                 'pdb2gmx',
                 '-f',
                 f'{identifier}_clean.pdb',
                 '-o',
                 f'{identifier}_processed.gro',
+                '-p',
+                'topol_processed.top',
                 '-water',
                 'spce',
                 '-ff',
                 'amber99sb-ildn'
-            ]
-            self.subprocess_call(pdb2gmx_command)
+            ],
+            inputs=[f'{identifier}_clean.pdb'],
+            outputs=[f'{identifier}_processed.gro', 'topol_processed.top'] + itp_files,
+            cache=True
+        ))
         # STEP 3: Here we create a simulation box 0.5nm
         # from the protein edge in all 6 directions.
-        if not os.path.exists(f'{identifier}_newbox.gro'):
-            editconf_command = [
+        stages.append(Stage(
+            'editconf',
+            [
                 self.GMX,
                 'editconf',
                 '-f',
@@ -164,12 +707,16 @@ class GromacsProtocol:
                 '0.5',
                 '-bt',
                 'cubic'
-            ]
-            self.subprocess_call(editconf_command)
+            ],
+            inputs=[f'{identifier}_processed.gro'],
+            outputs=[f'{identifier}_newbox.gro'],
+            cache=True
+        ))
         # STEP 4: Here we add water molecules in the
         # simulation box and new topology file is written.
-        if not os.path.exists(f'{identifier}_solv.gro'):
-            solvate_command = [
+        stages.append(Stage(
+            'solvate',
+            [
                 self.GMX,
                 'solvate',
                 '-cp',
@@ -179,84 +726,90 @@ class GromacsProtocol:
                 '-o',
                 f'{identifier}_solv.gro',
                 '-p',
-                f'topol.top'
-            ]
-            self.subprocess_call(solvate_command)
+                'topol_solv.top'
+            ],
+            inputs=[f'{identifier}_newbox.gro', 'topol_processed.top'],
+            outputs=[f'{identifier}_solv.gro', 'topol_solv.top'],
+            copies=[('topol_processed.top', 'topol_solv.top')],
+            cache=True
+        ))
         # STEP 5: Generate parameter file ions.tpr for all atoms.
-        if not os.path.exists(f'ions.tpr'):
-            grompp_command = [
+        ions_mdp = os.path.join(self.mdp_directory, 'ions.mdp')
+        stages.append(Stage(
+            'grompp_ions',
+            [
                 self.GMX,
                 'grompp',
                 '-f',
-                os.path.join(self.mdp_directory, "ions.mdp"),
+                ions_mdp,
                 '-c',
                 f'{identifier}_solv.gro',
                 '-p',
-                'topol.top',
+                'topol_solv.top',
                 '-o',
                 'ions.tpr',
                 '-maxwarn',
                 '2'
-            ]
-            self.subprocess_call(grompp_command)
+            ],
+            inputs=[ions_mdp, f'{identifier}_solv.gro', 'topol_solv.top'] + itp_files,
+            outputs=['ions.tpr']
+        ))
         # STEP 6: This will add ions to your simulation box and replace
         # the solvent molecules if there is a clash.
-        if not os.path.exists(f'{identifier}_solv_ions.gro'):
-            genion_command = [
-                'echo',
-                'SOL',
-                '|',
+        stages.append(Stage(
+            'genion',
+            [
                 self.GMX,
                 'genion',
                 '-s',
-                f'ions.tpr',
+                'ions.tpr',
                 '-o',
                 f'{identifier}_solv_ions.gro',
                 '-p',
-                f'topol.top',
+                'topol.top',
                 '-pname',
                 'NA',
                 '-nname',
                 'CL',
-                '-neutral',
-                '> /dev/null 2>&1'  # supress stdout
-            ]
-            os.system(' '.join(genion_command))
-            # STEP 7: Energy minimization
-        if not os.path.exists('em.tpr'):
-            em_command = [
+                '-neutral'
+            ],
+            inputs=['ions.tpr', 'topol_solv.top'],
+            outputs=[f'{identifier}_solv_ions.gro', 'topol.top'],
+            copies=[('topol_solv.top', 'topol.top')],
+            # Replace the SOL group with ions
+            input=b'SOL\n'
+        ))
+        # STEP 7: Energy minimization
+        minim_mdp = os.path.join(self.mdp_directory, 'minim.mdp')
+        stages.append(Stage(
+            'grompp_em',
+            [
                 self.GMX,
                 'grompp',
                 '-f',
-                f'{self.mdp_directory}/minim.mdp',
+                minim_mdp,
                 '-c',
                 f'{identifier}_solv_ions.gro',
                 '-p',
                 'topol.top',
                 '-o',
                 'em.tpr'
-            ]
-            self.subprocess_call(em_command)
+            ],
+            inputs=[minim_mdp, f'{identifier}_solv_ions.gro', 'topol.top'] + itp_files,
+            outputs=['em.tpr']
+        ))
         # STEP 8: This runs the energy minimization.
-        run_em_command = [
-            self.GMX,
-            'mdrun',
-            '-ntomp',
-            self.ntomp,
-            '-deffnm',
-            'em'
-        ]
-        if self.ntmpi:
-            run_em_command.extend(['-ntmpi', str(self.ntmpi)])
-        self.subprocess_call(run_em_command)
+        stages.append(self.mdrun_stage('mdrun_em', 'em', ['em.gro', 'em.edr'], slot))
         # STEP 9: This creates input parameters
         # for NVT molecular dynamics.
-        if not os.path.exists(f'nvt.tpr'):
-            nvt_md_command = [
+        nvt_mdp = os.path.join(self.mdp_directory, 'nvt.mdp')
+        stages.append(Stage(
+            'grompp_nvt',
+            [
                 self.GMX,
                 'grompp',
                 '-f',
-                f'{self.mdp_directory}/nvt.mdp',
+                nvt_mdp,
                 '-c',
                 'em.gro',
                 '-r',
@@ -265,34 +818,23 @@ class GromacsProtocol:
                 'topol.top',
                 '-o',
                 'nvt.tpr'
-            ]
-            self.subprocess_call(nvt_md_command)
+            ],
+            inputs=[nvt_mdp, 'em.gro', 'topol.top'] + itp_files,
+            outputs=['nvt.tpr']
+        ))
         # STEP 10: This runs the NVT MD.
-        tic = time.time()
-        run_nvt_md_command = [
-            self.GMX,
-            'mdrun',
-            '-ntomp',
-            self.ntomp,
-            '-deffnm',
-            'nvt'
-        ]
-        if self.ntmpi:
-            run_nvt_md_command.extend(['-ntmpi', str(self.ntmpi)])
-        self.subprocess_call(run_nvt_md_command)
-        tac = time.time()
-        sys.stdout.write(
-            f'NVT MD {identifier} '
-            f'- took {round((tac - tic) / 60, 2)} minutes \n'
-        )
-        tic = time.time()
+        stages.append(self.mdrun_stage(
+            'mdrun_nvt', 'nvt', ['nvt.gro', 'nvt.edr', 'nvt.cpt'], slot
+        ))
         # STEP 11: This creates input parameters for NPT molecular dynamics.
-        if not os.path.exists(f'npt.tpr'):
-            npt_md_command = [
+        npt_mdp = os.path.join(self.mdp_directory, 'npt.mdp')
+        stages.append(Stage(
+            'grompp_npt',
+            [
                 self.GMX,
                 'grompp',
                 '-f',
-                f'{self.mdp_directory}/npt.mdp',
+                npt_mdp,
                 '-c',
                 'nvt.gro',
                 '-r',
@@ -303,38 +845,212 @@ class GromacsProtocol:
                 'topol.top',
                 '-o',
                 'npt.tpr'
-            ]
-            self.subprocess_call(npt_md_command)
+            ],
+            inputs=[npt_mdp, 'nvt.gro', 'nvt.cpt', 'topol.top'] + itp_files,
+            outputs=['npt.tpr']
+        ))
         # STEP 12: This runs the NPT MD for 100ps.
-        run_npt_md_command = [
-            self.GMX,
-            'mdrun',
-            '-ntomp',
-            self.ntomp,
-            '-deffnm',
-            'npt'
-        ]
-        if self.ntmpi:
-            run_npt_md_command.extend(['-ntmpi', str(self.ntmpi)])
-        self.subprocess_call(run_npt_md_command)
-        tac = time.time()
-        sys.stdout.write(
-            f'NPT MD {identifier} '
-            f'- took {round((tac - tic) / 60, 2)} minutes \n'
-        )
-        sys.stdout.write(' ')
+        stages.append(self.mdrun_stage(
+            'mdrun_npt', 'npt', ['npt.gro', 'npt.edr', 'npt.cpt'], slot
+        ))
+        return stages
+
+    def restore_cached(self, key: str, sim_dir: str, identifier: str):
+        """
+        Link the files of a preparation cache entry into the simulation
+        directory. Returns the names of the linked files, or None when
+        there is no entry.
+        """
+        entry = os.path.join(self.cache_directory, key)
+        if not os.path.isdir(entry):
+            return None
+        restored = []
+        for file_name in os.listdir(entry):
+            restored.append(identifier_name(file_name, identifier))
+            link_or_copy(
+                os.path.join(entry, file_name),
+                os.path.join(sim_dir, restored[-1])
+            )
+        return restored
+
+    def store_cached(self, key: str, sim_dir: str, identifier: str, file_names: list):
+        """
+        Add the files written by a stage to the preparation cache.
+        The entry is renamed into place once complete, and the first of
+        several identifiers storing the same entry at once is kept.
+        """
+        os.makedirs(self.cache_directory, exist_ok=True)
+        entry = os.path.join(self.cache_directory, key)
+        temp_entry = f'{entry}.{os.getpid()}.tmp'
+        if os.path.exists(temp_entry):
+            shutil.rmtree(temp_entry)
+        os.mkdir(temp_entry)
+        for file_name in file_names:
+            link_or_copy(
+                os.path.join(sim_dir, file_name),
+                os.path.join(temp_entry, generic_name(file_name, identifier))
+            )
+        try:
+            os.rename(temp_entry, entry)
+        except OSError:
+            shutil.rmtree(temp_entry)
+
+    def run_stage(
+            self,
+            stage,
+            sim_dir: str,
+            digest: str,
+            identifier: str,
+            usage: dict = None,
+    ):
+        """
+        Run one stage in the simulation directory. An mdrun stage that was
+        interrupted with the same inputs and left a checkpoint resumes from it.
+        A cache stage whose inputs were already prepared for any identifier
+        links the cached outputs instead of running.
+        usage, when given, is filled with the status of the stage (run,
+        resumed or cached) and the CPU time and peak RSS of its command.
+        A function stage runs in this process, whose peak RSS is not its own,
+        so only its CPU time is recorded.
+        """
+        if usage is None:
+            usage = {}
+        usage['status'] = 'run'
+        key = None
+        if stage.cache and self.cache_directory:
+            key = stage.cache_key(sim_dir, identifier)
+            restored = self.restore_cached(key, sim_dir, identifier)
+            if restored is not None:
+                write_marker(sim_dir, stage.name, 'done', digest, restored)
+                usage['status'] = 'cached'
+                return
+        command = stage.command + stage.options
+        if stage.deffnm:
+            checkpoint = os.path.join(sim_dir, f'{stage.deffnm}.cpt')
+            if read_marker(sim_dir, stage.name, 'started') == digest \
+                    and os.path.exists(checkpoint):
+                command.extend(['-cpi', f'{stage.deffnm}.cpt'])
+                usage['status'] = 'resumed'
+                sys.stdout.write(
+                    f'Resuming {stage.name} from {stage.deffnm}.cpt\n'
+                )
+            else:
+                write_marker(sim_dir, stage.name, 'started', digest)
+        else:
+            # Outputs and any other file shared with the preparation cache
+            # are hard links into it, so they are replaced rather than
+            # written over, even by commands that write files in place
+            shared = expand_files(sim_dir, stage.outputs) + marker_files(sim_dir, stage.name)
+            for file_name in dict.fromkeys(shared):
+                file_path = os.path.join(sim_dir, file_name)
+                if os.path.lexists(file_path):
+                    os.remove(file_path)
+        before = directory_files(sim_dir) if key else None
+        for source, target in stage.copies:
+            shutil.copyfile(
+                os.path.join(sim_dir, source),
+                os.path.join(sim_dir, target)
+            )
+        if stage.function is not None:
+            before_usage = resource.getrusage(resource.RUSAGE_SELF)
+            try:
+                stage.function(sim_dir)
+            except OSError as e:
+                raise ValueError(f'{e}')
+            after_usage = resource.getrusage(resource.RUSAGE_SELF)
+            usage['cpu_time'] = (
+                after_usage.ru_utime + after_usage.ru_stime
+                - before_usage.ru_utime - before_usage.ru_stime
+            )
+            result = None
+        else:
+            result = self.subprocess_call(
+                command_list=command,
+                capture_output=stage.stdout is not None,
+                cwd=sim_dir,
+                input=stage.input,
+                usage=usage
+            )
+        if stage.stdout is not None:
+            with open(os.path.join(sim_dir, stage.stdout), 'wb') as out:
+                out.write(result.stdout)
+        if key:
+            # Every file the stage wrote is cached, such as the
+            # position restraint files written by pdb2gmx
+            written = [
+                file_name
+                for file_name, mtime in directory_files(sim_dir).items()
+                if before.get(file_name) != mtime
+            ]
+            self.store_cached(key, sim_dir, identifier, written)
+        write_marker(sim_dir, stage.name, 'done', digest, written if key else None)
+        if stage.deffnm:
+            # Only an interrupted run resumes from its checkpoint
+            os.remove(os.path.join(sim_dir, STAGES_DIRECTORY, f'{stage.name}.started'))
+
+    def protocol(
+            self,
+            identifier: str,
+            slot: dict = None,
+            prepare_only: bool = False,
+    ):
+        """
+        Run the stages of an identifier in dependency order, skipping those
+        whose completion marker matches the hash of their inputs and whose
+        outputs exist. A stage re-run with new outputs makes the stages
+        reading them stale in turn.
+        With prepare_only, the stages before the first mdrun are run.
+        """
+        simulation_directory = os.path.join(self.output_directory, identifier)
+        if not os.path.exists(simulation_directory):
+            os.mkdir(simulation_directory)
+        # Every command runs with the simulation directory as its cwd,
+        # so protocols of several identifiers can run at once
+        sim_dir = simulation_directory
+        for stage in stage_order(self.stages(identifier, slot)):
+            if prepare_only and stage.deffnm:
+                break
+            digest = stage.digest(sim_dir)
+            if stage.is_done(sim_dir, digest):
+                continue
+            record = {'identifier': identifier, 'stage': stage.name}
+            if stage.deffnm:
+                record['ntmpi'] = slot['ntmpi'] if slot else self.ntmpi
+                record['ntomp'] = slot['ntomp'] if slot else self.ntomp
+            tic = time.time()
+            record['start'] = tic
+            try:
+                self.run_stage(stage, sim_dir, digest, identifier, record)
+            except ValueError as e:
+                record['status'] = 'failed'
+                record['wall_time'] = time.time() - tic
+                record['error'] = str(e).strip()[-TELEMETRY_ERROR_LENGTH:]
+                write_telemetry(sim_dir, record)
+                raise
+            tac = time.time()
+            record['wall_time'] = tac - tic
+            if record.get('cpu_time') is not None and record['wall_time'] > 0:
+                record['cpu_utilisation'] = record['cpu_time'] / record['wall_time']
+            if stage.deffnm:
+                record.update(
+                    parse_mdrun_log(os.path.join(sim_dir, f'{stage.deffnm}.log'))
+                )
+                performance = (
+                    f', {record["ns_per_day"]} ns/day'
+                    if 'ns_per_day' in record else ''
+                )
+                sys.stdout.write(
+                    f'{stage.name} {identifier} '
+                    f'- took {round((tac - tic) / 60, 2)} minutes{performance} \n'
+                )
+            write_telemetry(sim_dir, record)
 
     def main(
             self,
             args_list
     ):
-        args_list = [
-            identifier
-            for identifier in args_list
-            if not os.path.exists(
-                os.path.join(self.output_directory, identifier)
-            )
-        ]
+        # Finished stages are skipped by protocol,
+        # so complete and interrupted runs are both safe to pass again
         if args_list:
             for arg in args_list:
                 try:
@@ -347,3 +1063,121 @@ class GromacsProtocol:
                         f'{e}\n'
                     )
                     continue
+            self.write_summary(args_list)
+
+    def write_summary(
+            self,
+            args_list,
+    ):
+        """
+        Write the summary of the telemetry of the identifiers to the
+        campaign summary file of the output directory, and return it.
+        """
+        records = []
+        for identifier in args_list:
+            records.extend(
+                read_telemetry(os.path.join(self.output_directory, identifier))
+            )
+        summary = summarize_telemetry(records)
+        summary_file = os.path.join(self.output_directory, SUMMARY_FILE)
+        with open(f'{summary_file}.tmp', 'w') as f:
+            json.dump(summary, f, indent=2)
+        os.replace(f'{summary_file}.tmp', summary_file)
+        sys.stdout.write(
+            f'Campaign summary of {summary["identifiers"]} identifiers,'
+            f' {round(summary["wall_time"] / 3600, 2)} stage hours,'
+            f' written to {summary_file}\n'
+        )
+        return summary
+
+    def prepare(
+            self,
+            args_list,
+            prepare_jobs: int = None,
+    ):
+        """
+        Run the stages before mdrun of several identifiers in a pool of
+        prepare_jobs single threaded processes.
+        Returns the identifiers prepared without error, in order.
+        """
+        if prepare_jobs is None:
+            prepare_jobs = os.cpu_count()
+        prepare_jobs = max(1, min(prepare_jobs, len(args_list)))
+        sys.stdout.write(
+            f'Preparing {len(args_list)} identifiers, {prepare_jobs} at once\n'
+        )
+        prepared = []
+        with ProcessPoolExecutor(max_workers=prepare_jobs) as executor:
+            futures = [
+                executor.submit(run_protocol, self, identifier, None, True)
+                for identifier in args_list
+            ]
+            for future in futures:
+                identifier, elapsed, error = future.result()
+                if error is not None:
+                    sys.stdout.write(
+                        f'**** ERROR PROCESSING: {identifier} ****\n'
+                        f'{error}\n'
+                    )
+                    continue
+                prepared.append(identifier)
+        return prepared
+
+    def run_campaign(
+            self,
+            args_list,
+            jobs: int,
+            total_cores: int = None,
+            prepare_jobs: int = None,
+    ):
+        """
+        Run the protocols of several identifiers at once, each in its own
+        process pinned to its own slot of total_cores cores.
+        All identifiers are first prepared in one pool, then queued and
+        started as slots become free.
+        """
+        if total_cores is None:
+            total_cores = os.cpu_count()
+        campaign = list(args_list)
+        args_list = self.prepare(args_list, prepare_jobs)
+        if not args_list:
+            self.write_summary(campaign)
+            return 0
+        jobs = max(1, min(jobs, len(args_list)))
+        free_slots = core_slots(total_cores, jobs, self.ntmpi)
+        sys.stdout.write(
+            f'Running {len(args_list)} identifiers, {jobs} at once'
+            f' with {free_slots[0]["ntmpi"]} MPI x'
+            f' {free_slots[0]["ntomp"]} OpenMP threads each\n'
+        )
+        queue = list(reversed(args_list))
+        running = {}
+        completed = 0
+        start = time.time()
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            while queue or running:
+                while queue and free_slots:
+                    slot = free_slots.pop()
+                    future = executor.submit(
+                        run_protocol, self, queue.pop(), slot
+                    )
+                    running[future] = slot
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    free_slots.append(running.pop(future))
+                    identifier, elapsed, error = future.result()
+                    if error is not None:
+                        sys.stdout.write(
+                            f'**** ERROR PROCESSING: {identifier} ****\n'
+                            f'{error}\n'
+                        )
+                        continue
+                    completed += 1
+                    hours = (time.time() - start) / 3600
+                    sys.stdout.write(
+                        f'{identifier} done in {round(elapsed / 60, 2)} minutes,'
+                        f' {completed}/{len(args_list)} complete,'
+                        f' {round(completed / hours, 2)} per hour\n'
+                    )
+        self.write_summary(campaign)
+        return completed
@@ -0,0 +1,190 @@
+"""Batch distance to features.
+
+This script takes a CSV of mutations, in the format used by
+download_icn3d_mutations_and_wt.py, and returns one table of the distances
+from each mutated residue to the features outlined in uniprot. Rows are
+grouped by structure, so each PDB and features file is loaded once, and
+results are written as each structure is finished.
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import re
+
+import pdb_analysis_lib as pal
+
+
+OUTPUT_COLUMNS = ["PDB ID",
+                  "Chain",
+                  "Residue",
+                  "Mutation",
+                  "Minimum Distance",
+                  "Uniprot ID",
+                  "Feature",
+                  "Feature Residue"]
+
+
+def argument_parser():
+    """Parse arguments for the batch_distance_to_features script."""
+    parser = argparse.ArgumentParser()
+    required_arguments = parser.add_argument_group("Required Arguments")
+    required_arguments.add_argument("-i",
+                                    "--input_file",
+                                    required=True,
+                                    type=str,
+                                    help="Input CSV file with PDB mutation information.")
+    required_arguments.add_argument("-p",
+                                    "--pdb_folder",
+                                    required=True,
+                                    type=str,
+                                    help="Folder of PDB files.")
+    required_arguments.add_argument("-f",
+                                    "--features_folder",
+                                    required=True,
+                                    type=str,
+                                    help="Folder of features files in JSON format.")
+    required_arguments.add_argument("-o",
+                                    "--output_file",
+                                    required=True,
+                                    type=str,
+                                    help=("Output CSV file, or Parquet file if it ends in "
+                                          ".parquet (requires pyarrow)."))
+    parser.add_argument("--pdb_pattern",
+                        type=str,
+                        default="{pdb_id}_icn3d.pdb",
+                        help=("PDB file name of a mutation, formatted with "
+                              "pdb_id, chain, residue and mutation."))
+    parser.add_argument("--features_pattern",
+                        type=str,
+                        default="{pdb_id}_regions.json",
+                        help="Features file name of a PDB ID, formatted with pdb_id.")
+    parser.add_argument("-d",
+                        "--max_distance",
+                        type=float,
+                        help=("Only report features within this distance of "
+                              "the residue in angstroms."))
+    parser.add_argument("-v",
+                        "--verbose",
+                        action="store_true")
+    args = parser.parse_args()
+    return args
+
+
+def read_mutations(filename):
+    """Return (pdb_id, chain, residue, mutation) for each row of a CSV file."""
+    with open(filename, newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader) # skip header
+        result = []
+        for row in reader:
+            residue = re.search(r"[0-9]+", row[3]).group(0)
+            result.append((row[1], row[2], residue, row[3][-1]))
+    return result
+
+
+def group_by_structure(mutations, pdb_folder, features_folder,
+                       pdb_pattern, features_pattern):
+    """Return mutations grouped by their PDB and features files.
+
+    Groups keep the order in which their first mutation appears.
+    """
+    result = {}
+    for pdb_id, chain, residue, mutation in mutations:
+        fields = {"pdb_id": pdb_id,
+                  "chain": chain,
+                  "residue": residue,
+                  "mutation": mutation}
+        key = (os.path.join(pdb_folder, pdb_pattern.format(**fields)),
+               os.path.join(features_folder, features_pattern.format(**fields)))
+        result.setdefault(key, []).append((pdb_id, chain, residue, mutation))
+    return result
+
+
+class CSVResultWriter:
+    """Write result rows to a CSV file, formatting distances."""
+
+    def __init__(self, output_file):
+        self.file_object = open(output_file, 'w', newline='')
+        self.writer = csv.writer(self.file_object)
+        self.writer.writerow(OUTPUT_COLUMNS)
+
+    def write(self, rows):
+        for row in rows:
+            self.writer.writerow(row[:4] + ["{0:.1f}".format(row[4])] + row[5:])
+        self.file_object.flush()
+
+    def close(self):
+        self.file_object.close()
+
+
+class ParquetResultWriter:
+    """Write result rows to a Parquet file, one row group per write."""
+
+    def __init__(self, output_file):
+        import pyarrow
+        import pyarrow.parquet
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema(
+            [(name, pyarrow.float64() if name == "Minimum Distance"
+              else pyarrow.string()) for name in OUTPUT_COLUMNS])
+        self.writer = pyarrow.parquet.ParquetWriter(output_file, self.schema)
+
+    def write(self, rows):
+        if not rows:
+            return
+        columns = [list(i) for i in zip(*rows)]
+        self.writer.write_table(
+            self.pyarrow.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def main():
+    """Write distances to features for every mutation of a CSV file."""
+    args = argument_parser()
+    if args.verbose:
+        log_level = logging.DEBUG
+    else:
+        log_level = logging.WARNING
+    logging.basicConfig(level=log_level)
+    mutations = read_mutations(args.input_file)
+    groups = group_by_structure(mutations,
+                                args.pdb_folder.rstrip('/'),
+                                args.features_folder.rstrip('/'),
+                                args.pdb_pattern,
+                                args.features_pattern)
+    logging.info(f"Input of {len(mutations)} mutations in {len(groups)} structures")
+    if args.output_file.endswith(".parquet"):
+        writer = ParquetResultWriter(args.output_file)
+    else:
+        writer = CSVResultWriter(args.output_file)
+    try:
+        for (pdb_file, features_file), group in groups.items():
+            try:
+                with open(features_file) as features_file_object:
+                    features_dict = json.load(features_file_object)
+                pdb_data = pal.load_structure(pdb_file, ["ATOM"])
+            except FileNotFoundError as err:
+                logging.warning(f"{len(group)} mutation(s) skipped: {err}")
+                continue
+            results = pal.distances_to_features(
+                pdb_data,
+                features_dict,
+                [(chain, residue) for _, chain, residue, _ in group],
+                args.max_distance)
+            rows = []
+            for mutation, result in zip(group, results):
+                rows.extend([list(mutation) + i for i in result])
+            writer.write(rows)
+            logging.info(f"{pdb_file}: {len(group)} mutation(s), {len(rows)} row(s)")
+    finally:
+        writer.close()
+    logging.info("Done!")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,12 @@
-"""Distance to features.
+"""Correct EMBER files.
 
-This script takes a PDB file and a features file with parameters indicating
-the chain and residue of the AA and returns a table of distances to
-features outlined in uniprot.
+This script takes a folder of EMBER3D PDB files and a folder of the
+corresponding WT PDB files, and writes each EMBER3D file with the chain and
+residue numbering of its WT. Files can be corrected in parallel with --jobs.
 """
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 import glob
 import os
 import sys
@@ -13,8 +14,12 @@ import sys
 import pdb_analysis_lib as pal
 
 
+# Parsed WT structures shared by the EMBER files of each protein
+WT_STRUCTURES = {}
+
+
 def argument_parser():
-    """Parse arguments for the distance_to_features script."""
+    """Parse arguments for the correct_ember_files script."""
     parser = argparse.ArgumentParser()
     parser.add_argument("ember_folder",
                                     type=str,
@@ -25,10 +30,35 @@ def argument_parser():
     parser.add_argument("output_folder",
                                     type=str,
                                     help="Output folder.")
+    parser.add_argument("-j",
+                        "--jobs",
+                        type=int,
+                        default=1,
+                        help="Number of processes to correct files with.")
     args = parser.parse_args()
     return args
 
 
+def init_worker(wt_structures):
+    """Share the parsed WT structures with a worker process."""
+    WT_STRUCTURES.update(wt_structures)
+
+
+def correct_file(task):
+    """Correct one EMBER file, returning its path and any error message."""
+    ember_file_path, pdb_id, chain, output_file = task
+    try:
+        if pdb_id not in WT_STRUCTURES:
+            raise FileNotFoundError(f"No WT file parsed for {pdb_id}")
+        pal.correct_ember_file(ember_file_path,
+                               WT_STRUCTURES[pdb_id],
+                               chain,
+                               output_file)
+    except Exception as err:
+        return (ember_file_path, f"{type(err).__name__}: {err}")
+    return (ember_file_path, None)
+
+
 def main():
     args = argument_parser()
     ember_folder = args.ember_folder.rstrip('/')
@@ -37,14 +67,36 @@ def main():
     output_folder = args.output_folder.rstrip('/')
     os.makedirs(output_folder, exist_ok=True)
     ember_files = glob.glob(f"{ember_folder}/*.pdb")
+    tasks = []
     for ember_file_path in ember_files:
         file_name = ember_file_path.split('/')[-1]
         pdb_id, chain = file_name.split('_')[0:2]
+        tasks.append((ember_file_path, pdb_id, chain, f"{output_folder}/{file_name}"))
+    # Parse each WT once for all EMBER files of that protein
+    wt_structures = {}
+    for pdb_id in sorted(set(task[1] for task in tasks)):
         try:
-            pal.correct_ember_file(ember_file_path, f"{wt_folder}/{pdb_id}_WT.pdb", chain, f"{output_folder}/{file_name}")
-        except:
-            print(f"Issue correcting residue numbers for: {ember_file_path}", file=sys.stderr)
-            raise
+            wt_structures[pdb_id] = pal.load_structure(f"{wt_folder}/{pdb_id}_WT.pdb",
+                                                       ["ATOM"])
+        except OSError as err:
+            print(f"Issue reading WT file for {pdb_id}: {err}", file=sys.stderr)
+    if args.jobs > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs,
+                                 initializer=init_worker,
+                                 initargs=(wt_structures,)) as executor:
+            results = list(executor.map(correct_file, tasks, chunksize=8))
+    else:
+        init_worker(wt_structures)
+        results = list(map(correct_file, tasks))
+    # Report every failure at the end instead of stopping at the first
+    failures = [result for result in results if result[1] is not None]
+    for ember_file_path, error in failures:
+        print(f"Issue correcting residue numbers for: {ember_file_path}: {error}",
+              file=sys.stderr)
+    if failures:
+        print(f"{len(failures)} of {len(tasks)} file(s) could not be corrected.",
+              file=sys.stderr)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
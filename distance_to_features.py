@@ -32,6 +32,11 @@ def argument_parser():
                                     required=True,
                                     type=str,
                                     help="Residue number to check distances from.")
+    parser.add_argument("-d",
+                        "--max_distance",
+                        type=float,
+                        help=("Only report features within this distance of "
+                              "the residue in angstroms."))
     args = parser.parse_args()
     return args
 
@@ -39,7 +44,11 @@ def argument_parser():
 def main():
     """Main function."""
     args = argument_parser()
-    result = pal.distance_to_features(args.pdb_file, args.features, args.chain, args.residue)
+    result = pal.distance_to_features(args.pdb_file,
+                                      args.features,
+                                      args.chain,
+                                      args.residue,
+                                      args.max_distance)
     # Format the distances to a single decimal place
     result = list(map(lambda x: ["{0:.1f}".format(x[0])] + x[1:], result))
     # Output result
@@ -1,12 +1,18 @@
 """Download PDB and Mutation files from iCn3D"""
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import csv
 import os
 import re
+import threading
 import time
 import sys
+import zlib
 
+import requests
+from requests.adapters import HTTPAdapter, Retry
 from selenium import webdriver
 from selenium.webdriver.firefox.options import Options
 
@@ -14,6 +20,12 @@ from selenium.webdriver.firefox.options import Options
 CRAWL_DELAY = 5
 MAX_SLEEP = 20
 MAX_ATTEMPTS = 2
+MAX_DRIVERS = 2
+POLL_INTERVAL = 0.5
+HTTP_CONNECTIONS = 4
+HTTP_CRAWL_DELAY = 0.2
+HTTP_TIMEOUT = 60
+WT_PDB_URL = "https://files.rcsb.org/download/{pdb_id}.pdb.gz"
 
 def argument_parser():
     """Parse arguments for the distance_to_features scipt."""
@@ -33,6 +45,22 @@ def argument_parser():
                         "--verbose",
                         action="store_true",
                         help="Prints updates on the download progress.")
+    parser.add_argument("-w",
+                        "--workers",
+                        type=int,
+                        default=MAX_DRIVERS,
+                        help="Number of browsers downloading at once.")
+    parser.add_argument("--crawl_delay",
+                        type=float,
+                        default=CRAWL_DELAY,
+                        help="Minimum seconds between requests to iCn3D, across all browsers.")
+    parser.add_argument("--wt_backend",
+                        choices=["selenium", "http"],
+                        default="selenium",
+                        help=("Download WT files by exporting them from iCn3D "
+                              "in a browser as <pdb_id>_icn3d.pdb, or fetch the "
+                              "deposited PDB file directly over http as "
+                              "<pdb_id>_rcsb.pdb."))
     args = parser.parse_args()
     return args
 
@@ -47,6 +75,30 @@ def read_csv_file(filename, skip_header=True):
         return rows
 
 
+def wait_for_download(expected_file_path,
+                      timeout=MAX_SLEEP,
+                      poll_interval=POLL_INTERVAL):
+    """Waits for a file to finish downloading and returns if it did.
+
+    Firefox downloads to a .part file next to the expected file and removes
+    it once done. The download is complete when the expected file exists,
+    no .part file is left, and the file size is unchanged between two polls
+    of the download folder. Returns False if that is not seen by timeout.
+    """
+    deadline = time.monotonic() + timeout
+    last_size = None
+    while True:
+        if (os.path.isfile(expected_file_path)
+                and not os.path.exists(f"{expected_file_path}.part")):
+            size = os.path.getsize(expected_file_path)
+            if size == last_size:
+                return True
+            last_size = size
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(poll_interval)
+
+
 def download_file_from_icn3d(api_call,
                              expected_file_path,
                              options,
@@ -66,22 +118,283 @@ def download_file_from_icn3d(api_call,
     while attempt < max_attempts and is_downloaded is False:
         # Open webdriver
         with webdriver.Firefox(options=options) as driver:
-            # Open icn3d with api call and wait
+            # Open icn3d with api call and wait for the download
             driver.get(api_call)
-            time.sleep(crawl_delay)
-            # Update download and sleep status
-            is_downloaded = os.path.isfile(expected_file_path)
-            total_sleep = crawl_delay
-            # If the file has not downloaded yet, wait
-            while is_downloaded is False and total_sleep <= max_sleep:
-                time.sleep(crawl_delay)
-                total_sleep += crawl_delay
-                is_downloaded = os.path.isfile(expected_file_path)
+            is_downloaded = wait_for_download(expected_file_path,
+                                              timeout=max_sleep)
         attempt += 1
+        if is_downloaded is False and attempt < max_attempts:
+            time.sleep(crawl_delay)
     if is_downloaded is False:
         expected_file = expected_file_path.split(r'/')[-1]
         raise FileNotFoundError(f"{expected_file} failed to download after {attempt} attempt(s).")
 
+
+class RateLimiter:
+    """Spaces out the start of requests shared by several threads."""
+
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._next_start = 0
+
+    def wait(self):
+        """Blocks until the next request is allowed to start."""
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self.min_interval
+        time.sleep(start - now)
+
+
+class DriverPool:
+    """A bounded pool of long-lived webdrivers shared by several threads.
+
+    Drivers are created on first use by driver_factory, up to size drivers,
+    and handed back to the pool after each download. A driver that raises
+    an error is quit, and a thread waiting for a driver builds its
+    replacement.
+    """
+
+    def __init__(self, driver_factory, size=MAX_DRIVERS):
+        self.driver_factory = driver_factory
+        self.size = size
+        self._idle = []
+        self._created = 0
+        self._available = threading.Condition()
+
+    @contextmanager
+    def driver(self):
+        """Lends a driver from the pool, waiting if all are in use."""
+        driver = self._take()
+        try:
+            yield driver
+        except BaseException:
+            self._discard(driver)
+            raise
+        with self._available:
+            self._idle.append(driver)
+            self._available.notify()
+
+    def _take(self):
+        with self._available:
+            # Waiters recheck both conditions, so a discarded driver frees
+            # a slot for a new one as much as a returned driver does
+            while not self._idle and self._created >= self.size:
+                self._available.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._created += 1
+        try:
+            return self.driver_factory()
+        except BaseException:
+            self._release()
+            raise
+
+    def _release(self):
+        with self._available:
+            self._created -= 1
+            self._available.notify()
+
+    def _discard(self, driver):
+        try:
+            driver.quit()
+        except Exception:
+            pass
+        self._release()
+
+    def close(self):
+        """Quits every idle driver in the pool."""
+        while True:
+            with self._available:
+                if not self._idle:
+                    break
+                driver = self._idle.pop()
+            self._discard(driver)
+
+
+class SeleniumFetcher:
+    """Fetches files by opening iCn3D pages in a pool of webdrivers.
+
+    The driver_factory is called with no arguments and must return an
+    object with get(url) and quit() methods, so tests can use a fake driver
+    that fetches from a local server instead of a browser. Drivers are only
+    started when a job uses this fetcher. Page loads are spaced by
+    crawl_delay across all drivers, counted from when a driver is in hand,
+    so threads that waited for a driver do not load pages back to back.
+    """
+
+    def __init__(self,
+                 driver_factory,
+                 max_drivers=MAX_DRIVERS,
+                 crawl_delay=CRAWL_DELAY,
+                 max_sleep=MAX_SLEEP,
+                 poll_interval=POLL_INTERVAL):
+        self.pool = DriverPool(driver_factory, max_drivers)
+        self.concurrency = max_drivers
+        self.crawl_delay = crawl_delay
+        self.rate_limiter = RateLimiter(crawl_delay)
+        self.max_sleep = max_sleep
+        self.poll_interval = poll_interval
+
+    def fetch(self, url, expected_file_path):
+        """Opens the url and returns if the expected file was downloaded."""
+        with self.pool.driver() as driver:
+            self.rate_limiter.wait()
+            driver.get(url)
+            return wait_for_download(expected_file_path,
+                                     timeout=self.max_sleep,
+                                     poll_interval=self.poll_interval)
+
+    def close(self):
+        self.pool.close()
+
+
+class HTTPFetcher:
+    """Fetches files directly over HTTP with a pooled requests session.
+
+    Connections are kept alive and reused across jobs, failed requests are
+    retried with backoff, and gzip responses, whether compressed in transit
+    or gzip files such as WT_PDB_URL, are written decompressed. Files are
+    written to a .part file first and renamed once complete. Requests are
+    spaced by crawl_delay across all threads.
+    """
+
+    def __init__(self,
+                 session=None,
+                 max_connections=HTTP_CONNECTIONS,
+                 crawl_delay=HTTP_CRAWL_DELAY,
+                 timeout=HTTP_TIMEOUT):
+        if session is None:
+            retries = Retry(total=5,
+                            backoff_factor=0.25,
+                            status_forcelist=[429, 500, 502, 503, 504])
+            adapter = HTTPAdapter(pool_connections=max_connections,
+                                  pool_maxsize=max_connections,
+                                  max_retries=retries)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        self.session = session
+        self.concurrency = max_connections
+        self.crawl_delay = crawl_delay
+        self.rate_limiter = RateLimiter(crawl_delay)
+        self.timeout = timeout
+
+    def fetch(self, url, expected_file_path):
+        """Downloads the url to the expected file and returns True."""
+        part_file_path = f"{expected_file_path}.part"
+        self.rate_limiter.wait()
+        try:
+            with self.session.get(url, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                decompressor = None
+                with open(part_file_path, 'wb') as part_file:
+                    for chunk in response.iter_content(chunk_size=2**16):
+                        if decompressor is None:
+                            # Decompress gzip files served without encoding
+                            is_gzip = chunk[:2] == b"\x1f\x8b" and \
+                                not expected_file_path.endswith(".gz")
+                            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) \
+                                if is_gzip else False
+                        if decompressor:
+                            chunk = decompressor.decompress(chunk)
+                        part_file.write(chunk)
+                    if decompressor:
+                        part_file.write(decompressor.flush())
+        except BaseException:
+            # Leave no partial file behind for the next attempt
+            if os.path.exists(part_file_path):
+                os.remove(part_file_path)
+            raise
+        os.replace(part_file_path, expected_file_path)
+        return True
+
+    def close(self):
+        self.session.close()
+
+
+class DownloadScheduler:
+    """Downloads files concurrently through pluggable fetchers.
+
+    Each download job is a tuple of a url, the expected file path and the
+    name of the fetcher to use, so the backend is chosen per job. Jobs
+    without a fetcher name use "selenium". Jobs run on a thread pool sized
+    to the concurrency of all fetchers, each fetcher spaces its own requests
+    by its crawl_delay across all threads, and failed jobs are retried up to
+    max_attempts times.
+    """
+
+    def __init__(self,
+                 fetchers,
+                 max_attempts=MAX_ATTEMPTS,
+                 verbose=False):
+        self.fetchers = fetchers
+        self.max_workers = sum(i.concurrency for i in fetchers.values())
+        self.max_attempts = max_attempts
+        self.verbose = verbose
+        self._done = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for fetcher in self.fetchers.values():
+            fetcher.close()
+
+    def download_job(self, job):
+        """Downloads one file, returning None or an error message."""
+        api_call, expected_file_path = job[:2]
+        backend = job[2] if len(job) > 2 else "selenium"
+        error = "unknown error"
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                if self.fetchers[backend].fetch(api_call, expected_file_path):
+                    return None
+            except Exception as err:
+                error = f"{type(err).__name__}: {err}"
+            else:
+                error = f"not found after {attempt} attempt(s)"
+        expected_file = expected_file_path.split(r'/')[-1]
+        return f"{expected_file} failed to download, {error}."
+
+    def _run(self, job, total):
+        error = self.download_job(job)
+        if self.verbose:
+            with self._lock:
+                self._done += 1
+                print_progress(job[1].split('/')[-1], self._done - 1, total)
+        return (job[1], error)
+
+    def download(self, jobs):
+        """Downloads the jobs not downloaded before, returning failures.
+
+        :return: List of (expected file path, error message) for each file
+            that failed to download
+        """
+        jobs = [job for job in jobs if os.path.isfile(job[1]) is False]
+        self._done = 0
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+            results = list(executor.map(lambda job: self._run(job, len(jobs)),
+                                        jobs))
+        return [result for result in results if result[1] is not None]
+
+
+def default_fetchers(webdriver_options,
+                     max_drivers=MAX_DRIVERS,
+                     crawl_delay=CRAWL_DELAY):
+    """Returns the selenium and http fetchers for a download folder."""
+    return {"selenium": SeleniumFetcher(
+                lambda: webdriver.Firefox(options=webdriver_options),
+                max_drivers=max_drivers,
+                crawl_delay=crawl_delay),
+            "http": HTTPFetcher()}
+
+
 def set_webdriver_options(download_folder, headless=True):
     """Set the driver options for the firefox selenium driver.
 
@@ -104,10 +417,10 @@ def print_progress(expected_file, idx, total):
           end='\r')
 
 
-def download_mutations(rows,
-                       webdriver_options,
-                       verbose=False):
-    for idx, row in enumerate(rows):
+def mutation_jobs(rows, download_folder):
+    """Returns a download job for the mutation of each row."""
+    result = []
+    for row in rows:
         pdb_id = row[1]
         chain = row[2]
         residue = re.search(r"[0-9]+", row[3]).group(0)
@@ -119,36 +432,59 @@ def download_mutations(rows,
         #mutation_api = ("https://www.ncbi.nlm.nih.gov/Structure/icn3d/full.html?"
         #               f"pdbid={pdb_id}&command=scap%20pdb%20{pdb_id}_{chain}_{residue}_{mutation}")
         expected_file = f"{pdb_id}_{chain}_{residue}_{mutation}.pdb"
-        download_folder = webdriver_options._preferences["browser.download.dir"]
-        expected_file_path = f"{download_folder}/{expected_file}"
-        if verbose:
-            print_progress(expected_file, idx, len(rows))
-        # If the file has not been downloaded before, download it
-        if os.path.isfile(expected_file_path) is False:
-            download_file_from_icn3d(mutation_api,
-                                     expected_file_path,
-                                     webdriver_options)
+        result.append((mutation_api,
+                       f"{download_folder}/{expected_file}",
+                       "selenium"))
+    return result
+
+
+def pdb_jobs(pdb_ids, download_folder, backend="selenium"):
+    """Returns a download job for the WT structure of each PDB ID.
+
+    The selenium backend exports the structure from iCn3D to
+    <pdb_id>_icn3d.pdb, while the http backend fetches the deposited PDB file
+    from WT_PDB_URL without a browser. The deposited file keeps its models,
+    ANISOU records and alternate locations, so it is saved as
+    <pdb_id>_rcsb.pdb rather than under the name of the iCn3D export.
+    """
+    result = []
+    for pdb_id in pdb_ids:
+        if backend == "http":
+            wt_api = WT_PDB_URL.format(pdb_id=pdb_id)
+            expected_file = f"{pdb_id}_rcsb.pdb"
+        else:
+            wt_api = ("https://www.ncbi.nlm.nih.gov/Structure/icn3d/full.html?"
+                      f"pdbid={pdb_id}&command=export%20pdb")
+            expected_file = f"{pdb_id}_icn3d.pdb"
+        result.append((wt_api, f"{download_folder}/{expected_file}", backend))
+    return result
+
+
+def download_mutations(rows,
+                       webdriver_options,
+                       verbose=False,
+                       max_drivers=MAX_DRIVERS):
+    download_folder = webdriver_options._preferences["browser.download.dir"]
+    with DownloadScheduler(default_fetchers(webdriver_options, max_drivers),
+                           verbose=verbose) as scheduler:
+        failures = scheduler.download(mutation_jobs(rows, download_folder))
     if verbose:
         print("\nDownload of PDB mutation file(s) complete.")
+    return failures
 
 
 def download_pdb_files(pdb_ids,
                        webdriver_options,
-                       verbose=False):
-    for idx, pdb_id in enumerate(pdb_ids):
-        wt_api = ("https://www.ncbi.nlm.nih.gov/Structure/icn3d/full.html?"
-                  f"pdbid={pdb_id}&command=export%20pdb")
-        expected_file = f"{pdb_id}_icn3d.pdb"
-        download_folder = webdriver_options._preferences["browser.download.dir"]
-        expected_file_path = f"{download_folder}/{expected_file}"
-        if verbose:
-            print_progress(expected_file, idx, len(pdb_ids))
-        if os.path.isfile(expected_file_path) is False:
-            download_file_from_icn3d(wt_api,
-                                     expected_file_path,
-                                     webdriver_options)
+                       verbose=False,
+                       max_drivers=MAX_DRIVERS,
+                       backend="selenium"):
+    download_folder = webdriver_options._preferences["browser.download.dir"]
+    with DownloadScheduler(default_fetchers(webdriver_options, max_drivers),
+                           verbose=verbose) as scheduler:
+        failures = scheduler.download(pdb_jobs(pdb_ids, download_folder, backend))
     if verbose:
         print("\nDownload of PDB file(s) complete.")
+    return failures
 
 
 def main():
@@ -156,11 +492,24 @@ def main():
     output_folder_abs = os.path.abspath(args.output_folder)
     options = set_webdriver_options(output_folder_abs)
     mutation_rows = read_csv_file(args.input_file)
-    download_mutations(mutation_rows, options, verbose=args.verbose)
     unique_pdb_ids = list(set(map(lambda x: x[1], mutation_rows)))
-    download_pdb_files(unique_pdb_ids, options, verbose=args.verbose)
+    # Share one pool of browsers across the mutation and WT downloads
+    fetchers = default_fetchers(options, args.workers, args.crawl_delay)
+    with DownloadScheduler(fetchers, verbose=args.verbose) as scheduler:
+        failures = scheduler.download(mutation_jobs(mutation_rows,
+                                                    output_folder_abs))
+        if args.verbose:
+            print("\nDownload of PDB mutation file(s) complete.")
+        failures += scheduler.download(pdb_jobs(unique_pdb_ids,
+                                                output_folder_abs,
+                                                args.wt_backend))
+        if args.verbose:
+            print("\nDownload of PDB file(s) complete.")
+    for _, error in failures:
+        print(error, file=sys.stderr)
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
     main()
-
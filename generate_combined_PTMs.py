@@ -1,17 +1,30 @@
-import csv
-import json
+"""Generate the combined PTMs store from Combined_PTMs.csv."""
+
+import argparse
+
+from ptm_store import build_ptm_json, build_ptm_store
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i",
+                        "--input_file",
+                        type=str,
+                        default="Combined_PTMs.csv",
+                        help="CSV of PTMs")
+    parser.add_argument("-o",
+                        "--output_file",
+                        type=str,
+                        default="Combined_PTMs.db",
+                        help=("indexed SQLite store of PTMs, or a single JSON "
+                              "dictionary if it ends in .json"))
+    args = parser.parse_args()
+    return args
+
 
 if __name__ == "__main__":
-    combined_ptms = {}
-    with open('Combined_PTMs.csv', newline='') as csvfile:
-        data = csv.reader(csvfile, delimiter=' ', quotechar='|')
-        next(data)
-        for row in data:
-            uniprotID, _, PTMpos, PTMs, _ = row[0].rsplit(',')
-            if uniprotID not in combined_ptms:
-                combined_ptms[uniprotID] = {}
-            if PTMs not in combined_ptms[uniprotID]:
-                combined_ptms[uniprotID][PTMs] = []
-            combined_ptms[uniprotID][PTMs].append(int(PTMpos))
-    with open('Combined_PTMs.json', "w") as f:
-        f.write(json.dumps(combined_ptms))
+    args = argument_parser()
+    if args.output_file.endswith('.json'):
+        build_ptm_json(args.input_file, args.output_file)
+    else:
+        build_ptm_store(args.input_file, args.output_file)
@@ -6,21 +6,56 @@ A local python module for functions used for scripts analyzing PDB files.
 Global variables:
 PDB_INDEX_DELIMS: Indexes to split a string when parsing an ATOM or HETATM
 PDB_COLUMN_NAMES: Names corresponding to each substring from PDB_INDEX_DELIMS
+PDB_COLUMN_KEYS: Short names of each column, as used by read_pdb_columns
+DISTANCE_BLOCK_SIZE: Maximum number of pairwise distances per distance block
+CELL_SIZE: Default edge length in angstroms of the cells of a SpatialIndex
+STRUCTURE_CACHE_BYTES: Default memory limit of a StructureCache
+STRUCTURE_CACHE: Structure cache shared by load_structure
+MODIFIED_RESIDUES: Parent amino acid of modified residues listed as HETATM
+WATER_RESIDUES: Residue names of waters left out by clean_pdb_lines
+
+Classes:
+Structure: Columnar NumPy model of the ATOM and HETATM rows of a PDB file.
+SpatialIndex: Uniform cell list for radius and nearest neighbor queries.
+StructureCache: LRU cache of parsed Structures with an optional disk cache.
+ResidueIndex: Index of the atom ranges of each residue of a Structure.
+IntervalTree: Static interval tree of closed integer intervals.
+FeatureIndex: Uniprot features of single residues and residue ranges.
 
 Functions:
 distance: Return the euclidean distance between 2 sets of coordinates.
 min_distance: Return the minimum distance of one coordinate to others.
+min_distances_between_groups: Return minimum distances between atom groups.
 pdb_row_to_list: Return a list of each item in an atm or hetatm row.
 read_pdb_atms_hetatms: Return a nested list of PDB ATOM and HETATM rows.
+open_pdb: Open a PDB file, gzip compressed PDB file or stdin as bytes.
+iter_pdb_lines: Yield the lines of a PDB source one at a time.
+iter_pdb_records: Yield parsed ATOM and HETATM rows of a PDB source lazily.
+read_pdb_columns: Return selected columns of a PDB file as NumPy arrays.
+load_structure: Return a Structure of a PDB file through STRUCTURE_CACHE.
+pdb_to_fastas: Return the sequences of several chains of a PDB file at once.
+residue_min_distances: Return the minimum distance of residues to coordinates.
+distances_to_features: Return distance to features of several residues.
+align_sequences: Return the aligned positions of two sequences.
+residue_alignment: Return the residues of a chain in two files aligned.
+clean_pdb_lines: Yield PDB lines without waters, hetero groups or chains.
+clean_pdb_file: Write a PDB file through clean_pdb_lines.
 """
 
 from collections import OrderedDict
+from contextlib import contextmanager
+import functools
+import gzip
+import hashlib
 import json
 import math
+import mmap
 import os
 import re
 import sys
 
+import numpy as np
+
 
 PDB_INDEX_DELIMS = [0,
                     6,
@@ -53,6 +88,41 @@ PDB_COLUMN_NAMES = ["Molecule Type",
                     "Temperature factor",
                     "Segment idenifier",
                     "Element symbol"]
+# Short names for each column in PDB_COLUMN_NAMES, used as array names
+PDB_COLUMN_KEYS = ["mol_type",
+                   "serial",
+                   "atom_name",
+                   "altloc",
+                   "residue_name",
+                   "chain",
+                   "resseq",
+                   "icode",
+                   "x",
+                   "y",
+                   "z",
+                   "occupancy",
+                   "bfactor",
+                   "segment",
+                   "element"]
+PDB_INT_COLUMNS = ("serial", "resseq")
+PDB_FLOAT_COLUMNS = ("x", "y", "z", "occupancy", "bfactor")
+
+# Maximum number of pairwise distances held in memory by one distance block
+DISTANCE_BLOCK_SIZE = 2**22
+# Edge length in angstroms of the cells of a SpatialIndex
+CELL_SIZE = 6.0
+# Memory limit in bytes of the parsed structures kept by a StructureCache
+STRUCTURE_CACHE_BYTES = 512 * 2**20
+# Environment variable naming a folder for the default on-disk cache
+STRUCTURE_CACHE_DIR_ENV = "PDB_STRUCTURE_CACHE_DIR"
+# Needleman-Wunsch scores of a match, mismatch and gap of residue alignments
+ALIGNMENT_SCORES = (2, -1, -2)
+# Sequences of equal length at least this identical are aligned by position
+IDENTITY_FAST_PATH = 0.9
+# Number of sequence pairs whose alignment is kept by align_sequences
+ALIGNMENT_CACHE_SIZE = 1024
+# Residue names of the waters left out by clean_pdb_lines
+WATER_RESIDUES = ("HOH",)
 
 AA_DICT = {"ALA":"A",
            "CYS":"C",
@@ -74,6 +144,22 @@ AA_DICT = {"ALA":"A",
            "VAL":"V",
            "TRP":"W",
            "TYR":"Y"}
+# Parent amino acid of modified residues listed as HETATM
+MODIFIED_RESIDUES = {"MSE":"M",
+                     "SEP":"S",
+                     "TPO":"T",
+                     "PTR":"Y",
+                     "HYP":"P",
+                     "MLY":"K",
+                     "M3L":"K",
+                     "KCX":"K",
+                     "LLP":"K",
+                     "CSO":"C",
+                     "CSD":"C",
+                     "CME":"C",
+                     "OCS":"C",
+                     "SEC":"C",
+                     "PCA":"E"}
 
 
 def distance(coord_a: list, coord_b: list) -> float:
@@ -118,12 +204,131 @@ def min_distance_coord_to_coords(query_coord: list, coord_list: list) -> float:
 
 def min_distance_coords_to_coords(query_coords: list, coord_list: list) -> float:
     """Return the minimum distance of one group of coordinates to another."""
-    result = math.inf
-    for query_coord in query_coords:
-        dist = min_distance_coord_to_coords(query_coord, coord_list)
-        if dist <= result:
-            result = dist
-    return result
+    distances, _, _ = min_distances_between_groups(query_coords, coord_list)
+    return float(distances[0, 0])
+
+
+def _as_coord_array(coords) -> np.ndarray:
+    """Return coordinates as a 2D float array, parsing strings if needed."""
+    if isinstance(coords, np.ndarray) and coords.dtype.kind == 'f':
+        result = coords
+    else:
+        result = np.array(coords, dtype=np.float64)
+    if result.size == 0:
+        return result.reshape(0, 3)
+    return result.reshape(len(result), -1)
+
+
+def _group_bounds(groups: np.ndarray) -> tuple:
+    """Return the start index and group of each run in sorted group labels."""
+    starts = np.flatnonzero(np.diff(groups)) + 1
+    starts = np.concatenate(([0], starts))
+    return (starts, groups[starts])
+
+
+def min_distances_between_groups(query_coords,
+                                 target_coords,
+                                 query_groups=None,
+                                 target_groups=None,
+                                 cutoff: float = None,
+                                 max_block_size: int = DISTANCE_BLOCK_SIZE) -> tuple:
+    """Return the minimum distance between every query and target group.
+
+    All atom pairs are compared in blocks of at most max_block_size pairwise
+    distances using NumPy broadcasting, so memory stays bounded regardless of
+    the number of atoms. Squared distances are compared against the squared
+    cutoff, and blocks whose bounding boxes are further apart than the cutoff
+    are skipped without computing any distance.
+
+    :param query_coords: (n, 3) array or nested list of query coordinates
+    :param target_coords: (m, 3) array or nested list of target coordinates
+    :param query_groups: Group index per query atom, from 0 to the number of
+        query groups minus 1. All atoms are in group 0 when omitted.
+    :param target_groups: Group index per target atom, as query_groups
+    :param cutoff: Distances above the cutoff are reported as infinity
+    :param max_block_size: Maximum number of pairwise distances per block
+    :return: Tuple of (distances, query_idx, target_idx) arrays shaped
+        (query groups, target groups). The indices are those of the closest
+        query and target atoms, or -1 where the groups have no pair within
+        the cutoff.
+    """
+    query_coords = _as_coord_array(query_coords)
+    target_coords = _as_coord_array(target_coords)
+    if query_coords.shape[1] != target_coords.shape[1] and \
+            len(query_coords) and len(target_coords):
+        raise ValueError("Coordinates are not the same length.")
+    if query_groups is None:
+        query_groups = np.zeros(len(query_coords), dtype=np.intp)
+    if target_groups is None:
+        target_groups = np.zeros(len(target_coords), dtype=np.intp)
+    query_groups = np.asarray(query_groups, dtype=np.intp)
+    target_groups = np.asarray(target_groups, dtype=np.intp)
+    n_query_groups = int(query_groups.max()) + 1 if len(query_groups) else 1
+    n_target_groups = int(target_groups.max()) + 1 if len(target_groups) else 1
+    best = np.full((n_query_groups, n_target_groups), np.inf)
+    best_query = np.full(best.shape, -1, dtype=np.intp)
+    best_target = np.full(best.shape, -1, dtype=np.intp)
+    if len(query_coords) == 0 or len(target_coords) == 0:
+        return (best, best_query, best_target)
+    max_sqr = np.inf if cutoff is None else float(cutoff) ** 2
+    # Sort atoms by group so that each group is a contiguous run
+    query_order = np.argsort(query_groups, kind="stable")
+    target_order = np.argsort(target_groups, kind="stable")
+    query_sorted = query_coords[query_order].astype(np.float64)
+    target_sorted = target_coords[target_order].astype(np.float64)
+    query_groups = query_groups[query_order]
+    target_groups = target_groups[target_order]
+    query_sqr = np.einsum("ij,ij->i", query_sorted, query_sorted)
+    target_sqr = np.einsum("ij,ij->i", target_sorted, target_sorted)
+    # Split the pairwise comparison into blocks of bounded size
+    target_step = max(1, min(len(target_sorted), max_block_size))
+    query_step = max(1, max_block_size // target_step)
+    for t_start in range(0, len(target_sorted), target_step):
+        t_stop = t_start + target_step
+        t_block = target_sorted[t_start:t_stop]
+        t_low, t_high = t_block.min(axis=0), t_block.max(axis=0)
+        t_starts, t_labels = _group_bounds(target_groups[t_start:t_stop])
+        for q_start in range(0, len(query_sorted), query_step):
+            q_stop = q_start + query_step
+            q_block = query_sorted[q_start:q_stop]
+            # Skip blocks whose bounding boxes are beyond the cutoff
+            if cutoff is not None:
+                gap = np.maximum(0, np.maximum(t_low - q_block.max(axis=0),
+                                               q_block.min(axis=0) - t_high))
+                if np.dot(gap, gap) > max_sqr:
+                    continue
+            sqr = (query_sqr[q_start:q_stop, None]
+                   + target_sqr[None, t_start:t_stop]
+                   - 2 * q_block @ t_block.T)
+            np.maximum(sqr, 0, out=sqr)
+            sqr[sqr > max_sqr] = np.inf
+            # Reduce columns to target groups, keeping the first argmin
+            col_min = np.minimum.reduceat(sqr, t_starts, axis=1)
+            col_idx = np.where(sqr == np.repeat(col_min, np.diff(
+                np.append(t_starts, sqr.shape[1])), axis=1),
+                np.arange(sqr.shape[1]), sqr.shape[1])
+            col_idx = np.minimum.reduceat(col_idx, t_starts, axis=1)
+            # Reduce rows to query groups
+            q_starts, q_labels = _group_bounds(query_groups[q_start:q_stop])
+            row_counts = np.diff(np.append(q_starts, sqr.shape[0]))
+            grp_min = np.minimum.reduceat(col_min, q_starts, axis=0)
+            row_idx = np.where(col_min == np.repeat(grp_min, row_counts, axis=0),
+                               np.arange(sqr.shape[0])[:, None], sqr.shape[0])
+            row_idx = np.minimum.reduceat(row_idx, q_starts, axis=0)
+            # Merge the block into the result where it improves on it
+            current = best[np.ix_(q_labels, t_labels)]
+            improved = grp_min < current
+            if not improved.any():
+                continue
+            rows, cols = np.nonzero(improved)
+            hit_rows = row_idx[rows, cols]
+            hit_cols = col_idx[hit_rows, cols]
+            best[q_labels[rows], t_labels[cols]] = grp_min[rows, cols]
+            best_query[q_labels[rows], t_labels[cols]] = \
+                query_order[q_start + hit_rows]
+            best_target[q_labels[rows], t_labels[cols]] = \
+                target_order[t_start + hit_cols]
+    return (np.sqrt(best), best_query, best_target)
 
 
 def pdb_row_to_list(row: str) -> str:
@@ -153,31 +358,951 @@ def read_pdb_atms(pdb_lines: list, mol_types: list = ["ATOM", "HETATM"]) -> list
     """Return a nested list of PDB ATOM and HETATM rows.
 
     Given a list of strings representing rows in a PDB file, return
-    all rows of specified molecule types.
+    all rows of specified molecule types. Given a Structure, return the
+    Structure of its atoms of those molecule types instead.
 
-    :param pdb_lines: List of strings representing lines in a PDB file
-    :type pdb_lines: list
-    :return: Nested list of parsed molecule type rows
+    :param pdb_lines: List of strings representing lines in a PDB file, or a
+        Structure to select the molecule types from
+    :type pdb_lines: list or Structure
+    :return: Nested list of parsed molecule type rows, or a Structure when
+        given a Structure
     """
+    if isinstance(pdb_lines, Structure):
+        return pdb_lines.select(mol_types=mol_types)
     result = []
     for line in pdb_lines:
         if any([line.startswith(mtype) for mtype in mol_types]):
             result.append(pdb_row_to_list(line))
     return result
 
+
+@contextmanager
+def open_pdb(pdb_source):
+    """Open a PDB file, gzip compressed PDB file or stdin as a binary stream.
+
+    Compression is detected from the gzip magic number rather than the file
+    extension, so mirrors that store compressed files without a .gz suffix
+    are read as well.
+
+    :param pdb_source: Path to a PDB file, '-' for stdin, or an open file
+    :return: Context manager of a binary file object
+    """
+    if hasattr(pdb_source, "read"):
+        # Opened files are left for the caller to close
+        stream = getattr(pdb_source, "buffer", pdb_source)
+        close = False
+    elif pdb_source == "-":
+        stream = sys.stdin.buffer
+        close = False
+    else:
+        stream = open(pdb_source, "rb")
+        close = True
+    try:
+        # Peek at the magic number without consuming it, as stdin can't seek
+        if hasattr(stream, "peek"):
+            is_gzip = stream.peek(2)[:2] == b"\x1f\x8b"
+        else:
+            is_gzip = str(pdb_source).endswith(".gz")
+        if is_gzip:
+            with gzip.GzipFile(fileobj=stream) as gzip_stream:
+                yield gzip_stream
+        else:
+            yield stream
+    finally:
+        if close:
+            stream.close()
+
+
+def iter_pdb_lines(pdb_source):
+    """Yield the lines of a PDB source as strings, one at a time.
+
+    :param pdb_source: Path to a PDB file, '-' for stdin, or an open file
+    """
+    with open_pdb(pdb_source) as stream:
+        for line in stream:
+            yield line.decode()
+
+
+def iter_pdb_records(pdb_source,
+                     mol_types: list = ["ATOM", "HETATM"],
+                     chains: list = None):
+    """Yield the parsed rows of specified molecule types and chains lazily.
+
+    Lines are filtered on their raw bytes before any column is decoded, so
+    skipped records cost no string slicing and only one record is held in
+    memory at a time.
+
+    :param pdb_source: Path to a PDB file, '-' for stdin, or an open file
+    :param mol_types: Molecule types (ATOM, HETATM) to keep
+    :type mol_types: list
+    :param chains: Chain identifiers to keep, all chains when omitted
+    :type chains: list
+    :return: Generator of rows as returned by pdb_row_to_list
+    """
+    prefixes = tuple(mtype.encode() for mtype in mol_types)
+    chain_set = None if chains is None else {chain.encode() for chain in chains}
+    with open_pdb(pdb_source) as stream:
+        for line in stream:
+            if not line.startswith(prefixes):
+                continue
+            if chain_set is not None and line[20:22].strip() not in chain_set:
+                continue
+            yield pdb_row_to_list(line.decode())
+
+
+
+def _gather_field(buffer: np.ndarray,
+                  starts: np.ndarray,
+                  ends: np.ndarray,
+                  first: int,
+                  last: int) -> np.ndarray:
+    """Return the bytes of a fixed-width field of each line as a 2D array.
+
+    Bytes past the end of a line, including carriage returns, are returned as
+    spaces so that short lines read as blank fields.
+    """
+    idx = starts[:, None] + np.arange(first, last)
+    result = buffer[np.minimum(idx, len(buffer) - 1)]
+    blank = (idx >= ends[:, None]) | (result == ord("\r"))
+    return np.where(blank, np.uint8(ord(" ")), result)
+
+
+def _parse_fixed_numbers(field: np.ndarray, dtype) -> np.ndarray:
+    """Return the numbers in the fixed-width fields of a 2D byte array.
+
+    The digits are combined arithmetically, so no string is created per
+    field. Blank or malformed fields are returned as NaN for floats and 0
+    for integers, as with the row based parsers.
+    """
+    is_digit = (field >= ord("0")) & (field <= ord("9"))
+    is_point = field == ord(".")
+    is_minus = field == ord("-")
+    valid = np.all(is_digit | is_point | is_minus | (field == ord(" ")), axis=1)
+    valid &= is_digit.any(axis=1) & (is_point.sum(axis=1) <= 1)
+    width = field.shape[1]
+    columns = np.arange(width)
+    # Decimal exponent of each byte relative to the decimal point
+    point = np.where(is_point.any(axis=1), is_point.argmax(axis=1), width)
+    exponent = point[:, None] - columns[None, :]
+    exponent = np.where(columns[None, :] < point[:, None], exponent - 1, exponent)
+    digits = np.where(is_digit, field.astype(np.float64) - ord("0"), 0)
+    result = (digits * 10.0 ** exponent).sum(axis=1)
+    result = np.where(is_minus.any(axis=1), -result, result)
+    if np.dtype(dtype).kind == "f":
+        return np.where(valid, result, np.nan).astype(dtype)
+    return np.where(valid, np.round(result), 0).astype(dtype)
+
+
+def _line_offsets(buffer: np.ndarray, block_size: int = 2**26) -> tuple:
+    """Return the start and end offsets of every line in a byte buffer."""
+    newlines = [np.flatnonzero(buffer[i:i + block_size] == ord("\n")) + i
+                for i in range(0, len(buffer), block_size)]
+    ends = np.concatenate(newlines) if newlines else np.empty(0, dtype=np.intp)
+    starts = np.concatenate(([0], ends + 1))
+    ends = np.append(ends, len(buffer))
+    # Drop the empty line after a trailing newline
+    keep = starts < ends
+    return (starts[keep], ends[keep])
+
+
+def _read_buffer_columns(buffer: np.ndarray,
+                         columns: list,
+                         mol_types: list,
+                         chains: list) -> dict:
+    """Return PDB columns of the selected records of a byte buffer."""
+    starts, ends = _line_offsets(buffer)
+    # Keep records of the specified molecule types, using the raw bytes
+    heads = _gather_field(buffer, starts, ends, 0, 6)
+    keep = np.zeros(len(starts), dtype=bool)
+    for mtype in mol_types:
+        prefix = np.frombuffer(mtype.encode(), dtype=np.uint8)
+        keep |= np.all(heads[:, :len(prefix)] == prefix, axis=1)
+    if chains is not None:
+        chain_field = _gather_field(buffer, starts, ends, 20, 22)
+        chain_field = np.char.strip(chain_field.view("S2").ravel())
+        keep &= np.isin(chain_field, [chain.encode() for chain in chains])
+    starts, ends = starts[keep], ends[keep]
+    result = {}
+    for name in columns:
+        if name == "xyz":
+            result[name] = np.stack([_parse_fixed_numbers(
+                _gather_field(buffer, starts, ends, first, last), np.float32)
+                for first, last in _column_bounds(["x", "y", "z"])], axis=1)
+            continue
+        [(first, last)] = _column_bounds([name])
+        field = _gather_field(buffer, starts, ends, first, last)
+        if name in PDB_INT_COLUMNS:
+            result[name] = _parse_fixed_numbers(field, np.int32)
+        elif name in PDB_FLOAT_COLUMNS:
+            result[name] = _parse_fixed_numbers(field, np.float32)
+        else:
+            field = field.view(f"S{last - first}").ravel()
+            result[name] = np.char.strip(field).astype(f"U{last - first}")
+    return result
+
+
+def _column_bounds(names: list) -> list:
+    """Return the (start, end) character offsets of named PDB columns."""
+    result = []
+    for name in names:
+        if name not in PDB_COLUMN_KEYS:
+            raise ValueError(f"Unknown PDB column: {name}")
+        idx = PDB_COLUMN_KEYS.index(name)
+        result.append((PDB_INDEX_DELIMS[idx], PDB_INDEX_DELIMS[idx + 1]))
+    return result
+
+
+def read_pdb_columns(pdb_file: str,
+                     columns: list = ("xyz", "resseq"),
+                     mol_types: list = ["ATOM", "HETATM"],
+                     chains: list = None) -> dict:
+    """Return selected columns of the records of a PDB file as NumPy arrays.
+
+    The file is memory-mapped and the offsets of every line are found with
+    one vectorized scan for newlines. Records are then selected and only the
+    requested fixed-width columns are decoded, directly from the mapped bytes
+    into arrays, without creating a Python string per line. Gzip compressed
+    files are decompressed into memory first.
+
+    :param pdb_file: Path to a PDB file
+    :param columns: Names from PDB_COLUMN_KEYS, or "xyz" for an (n, 3) array
+        of the X, Y and Z columns
+    :param mol_types: Molecule types (ATOM, HETATM) to keep
+    :param chains: Chain identifiers to keep, all chains when omitted
+    :return: Dictionary of column name to array with an entry per record
+    """
+    with open(pdb_file, "rb") as file:
+        if file.peek(2)[:2] == b"\x1f\x8b":
+            with gzip.GzipFile(fileobj=file) as gzip_file:
+                buffer = np.frombuffer(gzip_file.read(), dtype=np.uint8)
+            return _read_buffer_columns(buffer, columns, mol_types, chains)
+        if os.fstat(file.fileno()).st_size == 0:
+            buffer = np.empty(0, dtype=np.uint8)
+            return _read_buffer_columns(buffer, columns, mol_types, chains)
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            buffer = np.frombuffer(mapped, dtype=np.uint8)
+            try:
+                return _read_buffer_columns(buffer, columns, mol_types, chains)
+            finally:
+                # Release the view so the map can be closed
+                del buffer
+
+
+def _intern(values: list) -> tuple:
+    """Return the unique labels of a string column and a code per value."""
+    if isinstance(values, np.ndarray):
+        labels, codes = np.unique(values, return_inverse=True)
+        return (tuple(labels.tolist()), codes.astype(np.int32).ravel())
+    labels = {}
+    codes = [labels.setdefault(value, len(labels)) for value in values]
+    return (tuple(labels), np.array(codes, dtype=np.int32))
+
+
+def _to_int(value: str, default: int = 0) -> int:
+    """Return a PDB integer field, or default if it is blank or malformed."""
+    try:
+        return int(value)
+    except ValueError:
+        return default
+
+
+def _to_float(value: str) -> float:
+    """Return a PDB float field, or NaN if it is blank or malformed."""
+    try:
+        return float(value)
+    except ValueError:
+        return math.nan
+
+
+class Structure:
+    """Columnar NumPy model of the ATOM and HETATM rows of a PDB file.
+
+    Each PDB column is held as one array with an entry per atom. Coordinates
+    are parsed once into a float32 (n, 3) array, residue sequence numbers
+    into an int array, and the repetitive string columns (molecule type, atom
+    name, residue name and chain) are interned: a tuple of unique labels plus
+    an int32 code per atom. Subsets are selected with boolean masks, so the
+    parsed data is never copied back into per-atom lists.
+
+    The parsing helpers of this module (read_pdb_atms, parse_data_by_residues,
+    parse_data_by_chains and coords_from_pdb_data) accept a Structure in
+    place of the nested list of rows.
+    """
+
+    INTERNED_COLUMNS = ("mol_type", "atom_name", "residue_name", "chain")
+    ARRAY_COLUMNS = ("serial", "altloc", "resseq", "icode", "xyz", "occupancy",
+                     "bfactor", "segment", "element")
+
+    def __init__(self,
+                 labels: dict,
+                 codes: dict,
+                 serial: np.ndarray,
+                 altloc: np.ndarray,
+                 resseq: np.ndarray,
+                 icode: np.ndarray,
+                 xyz: np.ndarray,
+                 occupancy: np.ndarray,
+                 bfactor: np.ndarray,
+                 segment: np.ndarray,
+                 element: np.ndarray):
+        self.labels = labels
+        self.codes = codes
+        self.serial = serial
+        self.altloc = altloc
+        self.resseq = resseq
+        self.icode = icode
+        self.xyz = xyz
+        self.occupancy = occupancy
+        self.bfactor = bfactor
+        self.segment = segment
+        self.element = element
+        self._spatial_index = None
+        self._residue_index = None
+        self._chain_sequences = {}
+
+    def __len__(self):
+        return len(self.resseq)
+
+    @classmethod
+    def from_rows(cls, pdb_data: list):
+        """Return a Structure from a nested list of parsed PDB rows.
+
+        :param pdb_data: Iterable of rows as returned by pdb_row_to_list
+        :type pdb_data: list
+        :return: Structure holding the same atoms in the same order
+        """
+        # Collect the columns one row at a time, so rows can be streamed
+        columns = [[] for _ in PDB_COLUMN_NAMES]
+        xyz = []
+        for row in pdb_data:
+            for column, value in zip(columns, row):
+                column.append(value)
+            xyz.append([_to_float(i) for i in row[8:11]])
+        columns = dict(zip(PDB_COLUMN_KEYS, columns))
+        for name in PDB_INT_COLUMNS:
+            columns[name] = [_to_int(i) for i in columns[name]]
+        for name in ("occupancy", "bfactor"):
+            columns[name] = [_to_float(i) for i in columns[name]]
+        columns["xyz"] = xyz
+        return cls.from_columns(columns)
+
+    @classmethod
+    def from_columns(cls, columns: dict):
+        """Return a Structure from a dictionary of column values.
+
+        :param columns: Dictionary with a sequence per name in PDB_COLUMN_KEYS,
+            except for X, Y and Z which are given as one "xyz" sequence, as
+            returned by read_pdb_columns
+        :type columns: dict
+        :return: Structure of the columns
+        """
+        labels = {}
+        codes = {}
+        for name in cls.INTERNED_COLUMNS:
+            labels[name], codes[name] = _intern(columns[name])
+        return cls(labels,
+                   codes,
+                   serial=np.asarray(columns["serial"], dtype=np.int32),
+                   altloc=np.asarray(columns["altloc"], dtype="U1"),
+                   resseq=np.asarray(columns["resseq"], dtype=np.int32),
+                   icode=np.asarray(columns["icode"], dtype="U1"),
+                   xyz=np.asarray(columns["xyz"], dtype=np.float32).reshape(-1, 3),
+                   occupancy=np.asarray(columns["occupancy"], dtype=np.float32),
+                   bfactor=np.asarray(columns["bfactor"], dtype=np.float32),
+                   segment=np.asarray(columns["segment"], dtype="U4"),
+                   element=np.asarray(columns["element"], dtype="U2"))
+
+    @classmethod
+    def from_lines(cls, pdb_lines: list, mol_types: list = ["ATOM", "HETATM"]):
+        """Return a Structure of the rows of specified molecule types.
+
+        :param pdb_lines: Iterable of strings representing lines in a PDB file
+        :type pdb_lines: list
+        :param mol_types: Molecule types (ATOM, HETATM) to keep
+        :type mol_types: list
+        :return: Structure of the parsed rows
+        """
+        prefixes = tuple(mol_types)
+        return cls.from_rows(pdb_row_to_list(line) for line in pdb_lines
+                             if line.startswith(prefixes))
+
+    @classmethod
+    def from_file(cls,
+                  pdb_file: str,
+                  mol_types: list = ["ATOM", "HETATM"],
+                  chains: list = None):
+        """Return a Structure of the rows of a PDB file, gzip file or stdin.
+
+        Files given by path are decoded column by column with
+        read_pdb_columns. Stdin ('-') and open files are streamed through
+        iter_pdb_records, so they are never held in memory as a whole.
+        """
+        if hasattr(pdb_file, "read") or pdb_file == "-":
+            return cls.from_rows(iter_pdb_records(pdb_file, mol_types, chains))
+        columns = [name for name in PDB_COLUMN_KEYS
+                   if name not in ("x", "y", "z")] + ["xyz"]
+        return cls.from_columns(read_pdb_columns(pdb_file,
+                                                 columns,
+                                                 mol_types,
+                                                 chains))
+
+    def column(self, name: str) -> np.ndarray:
+        """Return an interned column decoded to an array of strings."""
+        labels = np.array(self.labels[name], dtype=str)
+        if len(labels) == 0:
+            return np.empty(len(self), dtype=str)
+        return labels[self.codes[name]]
+
+    def label_mask(self, name: str, values: list) -> np.ndarray:
+        """Return a boolean mask of atoms whose interned column is in values."""
+        wanted = [code for code, label in enumerate(self.labels[name])
+                  if label in values]
+        return np.isin(self.codes[name], wanted)
+
+    def mask(self,
+             mol_types: list = None,
+             chains: list = None,
+             residues: list = None) -> np.ndarray:
+        """Return a boolean mask of atoms matching all the given criteria.
+
+        :param mol_types: Molecule types (ATOM, HETATM) to match
+        :param chains: Chain identifiers to match
+        :param residues: Residue sequence numbers, as str or int, to match.
+            Values that are not integers never match, as with the nested
+            list helpers.
+        :return: Boolean array with an entry per atom
+        """
+        result = np.ones(len(self), dtype=bool)
+        if mol_types is not None:
+            result &= self.label_mask("mol_type", mol_types)
+        if chains is not None:
+            result &= self.label_mask("chain", chains)
+        if residues is not None:
+            numbers = [int(i) for i in residues
+                       if re.fullmatch(r"\s*-?[0-9]+\s*", str(i))]
+            result &= self.residue_index().mask(numbers)
+        return result
+
+    def subset(self, mask: np.ndarray):
+        """Return a Structure of the atoms selected by a mask or index array."""
+        return Structure(self.labels,
+                         {name: codes[mask] for name, codes in self.codes.items()},
+                         serial=self.serial[mask],
+                         altloc=self.altloc[mask],
+                         resseq=self.resseq[mask],
+                         icode=self.icode[mask],
+                         xyz=self.xyz[mask],
+                         occupancy=self.occupancy[mask],
+                         bfactor=self.bfactor[mask],
+                         segment=self.segment[mask],
+                         element=self.element[mask])
+
+    def spatial_index(self, cell_size: float = CELL_SIZE):
+        """Return a SpatialIndex of the atoms, built once and then reused."""
+        if self._spatial_index is None or \
+                self._spatial_index.cell_size != cell_size:
+            self._spatial_index = SpatialIndex(self.xyz, cell_size)
+        return self._spatial_index
+
+    def residue_index(self):
+        """Return a ResidueIndex of the atoms, built once and then reused."""
+        if self._residue_index is None:
+            self._residue_index = ResidueIndex(self)
+        return self._residue_index
+
+    def residue(self, chain: str, resseq, icode: str = None):
+        """Return a Structure of the atoms of one residue of a chain.
+
+        :param chain: Chain identifier of the residue
+        :param resseq: Residue sequence number, as str or int
+        :param icode: Insertion code, all insertion codes when omitted
+        :return: Structure of the atoms, empty if there is no such residue
+        """
+        return self.subset(self.residue_index().atoms(chain, resseq, icode))
+
+    def chain_sequence(self, chain: str) -> tuple:
+        """Return the residues and one letter sequence of the ATOMs of a chain.
+
+        The result is kept, so a WT structure shared by many models is only
+        read once per chain.
+
+        :param chain: Chain identifier
+        :return: Tuple of the (resseq, icode) of each residue in file order,
+            and the sequence with X for residues not in AA_DICT
+        """
+        if chain not in self._chain_sequences:
+            atoms = self.select(["ATOM"], [chain])
+            residue_index = atoms.residue_index()
+            keys = residue_index.keys()
+            first = [residue_index.ranges[key][0][0] for key in keys]
+            names = [atoms.labels["residue_name"][code] for code in
+                     atoms.codes["residue_name"][first].tolist()]
+            self._chain_sequences[chain] = (
+                [(resseq, icode) for _, resseq, icode in keys],
+                "".join(AA_DICT.get(name, "X") for name in names))
+        return self._chain_sequences[chain]
+
+    def select(self, mol_types=None, chains=None, residues=None):
+        """Return a Structure of the atoms matching all the given criteria."""
+        return self.subset(self.mask(mol_types, chains, residues))
+
+    @property
+    def nbytes(self) -> int:
+        """Return the memory used by the arrays of the structure."""
+        arrays = [self.serial, self.altloc, self.resseq, self.icode, self.xyz,
+                  self.occupancy, self.bfactor, self.segment, self.element]
+        return sum(i.nbytes for i in arrays + list(self.codes.values()))
+
+    def to_npz(self, npz_file: str):
+        """Save the arrays of the structure to a NumPy .npz file."""
+        arrays = {name: getattr(self, name) for name in self.ARRAY_COLUMNS}
+        for name in self.INTERNED_COLUMNS:
+            arrays[f"codes_{name}"] = self.codes[name]
+            arrays[f"labels_{name}"] = np.array(self.labels[name], dtype=str)
+        np.savez(npz_file, **arrays)
+
+    @classmethod
+    def from_npz(cls, npz_file: str):
+        """Return a Structure saved with to_npz."""
+        with np.load(npz_file) as arrays:
+            labels = {name: tuple(arrays[f"labels_{name}"].tolist())
+                      for name in cls.INTERNED_COLUMNS}
+            codes = {name: arrays[f"codes_{name}"]
+                     for name in cls.INTERNED_COLUMNS}
+            return cls(labels,
+                       codes,
+                       **{name: arrays[name] for name in cls.ARRAY_COLUMNS})
+
+    def to_rows(self) -> list:
+        """Return the atoms as a nested list of rows like pdb_row_to_list."""
+        def fmt(value, digits):
+            return "" if math.isnan(value) else f"{value:.{digits}f}"
+        columns = [self.column(name).tolist() for name in self.INTERNED_COLUMNS]
+        altloc, icode = self.altloc.tolist(), self.icode.tolist()
+        segment, element = self.segment.tolist(), self.element.tolist()
+        result = []
+        for i in range(len(self)):
+            x, y, z = self.xyz[i]
+            result.append([columns[0][i],
+                           str(self.serial[i]),
+                           columns[1][i],
+                           altloc[i],
+                           columns[2][i],
+                           columns[3][i],
+                           str(self.resseq[i]),
+                           icode[i],
+                           fmt(x, 3),
+                           fmt(y, 3),
+                           fmt(z, 3),
+                           fmt(self.occupancy[i], 2),
+                           fmt(self.bfactor[i], 2),
+                           segment[i],
+                           element[i]])
+        return result
+
+
+class ResidueIndex:
+    """Index of the atoms of each residue of a Structure.
+
+    Residues are keyed by (chain, resseq, icode) and map to the atom ranges
+    they occupy. The atoms of a residue are contiguous in a PDB file, so a
+    residue is normally one slice of the structure arrays, found with a
+    dictionary lookup instead of a scan of every atom. Residues split over
+    several ranges are returned as an array of atom indices.
+    """
+
+    def __init__(self, structure: Structure):
+        chain = structure.codes["chain"]
+        resseq = structure.resseq
+        icode = structure.icode
+        n_atoms = len(structure)
+        # Start a new range wherever the chain, number or insertion code changes
+        change = np.ones(n_atoms, dtype=bool)
+        change[1:] = ((chain[1:] != chain[:-1]) |
+                      (resseq[1:] != resseq[:-1]) |
+                      (icode[1:] != icode[:-1]))
+        starts = np.flatnonzero(change)
+        stops = np.append(starts[1:], n_atoms)
+        chains = structure.labels["chain"]
+        self.n_atoms = n_atoms
+        self.ranges = {}
+        self._by_resseq = {}
+        for start, stop, code, number, insertion in zip(starts.tolist(),
+                                                        stops.tolist(),
+                                                        chain[starts].tolist(),
+                                                        resseq[starts].tolist(),
+                                                        icode[starts].tolist()):
+            key = (chains[code], number, insertion)
+            if key not in self.ranges:
+                self.ranges[key] = []
+                self._by_resseq.setdefault(number, []).append(key)
+            self.ranges[key].append((start, stop))
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def __contains__(self, key):
+        return key in self.ranges
+
+    def keys(self) -> list:
+        """Return the (chain, resseq, icode) of each residue in file order."""
+        return list(self.ranges)
+
+    def atom_residues(self) -> np.ndarray:
+        """Return the position in keys() of the residue of each atom."""
+        result = np.empty(self.n_atoms, dtype=np.intp)
+        for position, ranges in enumerate(self.ranges.values()):
+            for start, stop in ranges:
+                result[start:stop] = position
+        return result
+
+    def _indices(self, ranges: list):
+        if len(ranges) == 1:
+            return slice(*ranges[0])
+        return np.concatenate([np.arange(start, stop) for start, stop in ranges]
+                              + [np.empty(0, dtype=np.intp)])
+
+    def atoms(self, chain: str, resseq, icode: str = None):
+        """Return the atoms of a residue as a slice or an index array.
+
+        :param chain: Chain identifier of the residue
+        :param resseq: Residue sequence number, as str or int
+        :param icode: Insertion code, all insertion codes when omitted
+        :return: Slice, or index array, of the residue atoms in the structure
+        """
+        number = _to_int(str(resseq), None)
+        if icode is not None:
+            keys = [(chain, number, icode)]
+        else:
+            keys = [key for key in self._by_resseq.get(number, ())
+                    if key[0] == chain]
+        ranges = [i for key in keys for i in self.ranges.get(key, ())]
+        return self._indices(sorted(ranges))
+
+    def mask(self, residues: list) -> np.ndarray:
+        """Return a boolean mask of the atoms of residue sequence numbers.
+
+        :param residues: Residue sequence numbers as int, in any chain
+        :return: Boolean array with an entry per atom
+        """
+        result = np.zeros(self.n_atoms, dtype=bool)
+        for number in set(residues):
+            for key in self._by_resseq.get(number, ()):
+                for start, stop in self.ranges[key]:
+                    result[start:stop] = True
+        return result
+
+
+class SpatialIndex:
+    """Uniform cell list for radius and nearest neighbor queries.
+
+    Coordinates are binned into cubic cells of cell_size angstroms and stored
+    sorted by cell, so the atoms of any cell are a contiguous run. A query
+    only computes distances to the atoms of the cells around each query
+    point, which costs O(neighbors) rather than O(atoms) per point.
+    """
+
+    def __init__(self, coords, cell_size: float = CELL_SIZE):
+        self.coords = _as_coord_array(coords).astype(np.float64)
+        self.cell_size = float(cell_size)
+        if len(self.coords) == 0:
+            self.origin = np.zeros(self.coords.shape[1])
+            self.dims = np.ones(self.coords.shape[1], dtype=np.int64)
+        else:
+            self.origin = self.coords.min(axis=0)
+            self.dims = self._cells(self.coords).max(axis=0) + 1
+        keys = self._keys(self._cells(self.coords))
+        self.order = np.argsort(keys, kind="stable")
+        self.cell_keys, self.cell_starts, self.cell_counts = np.unique(
+            keys[self.order], return_index=True, return_counts=True)
+
+    def __len__(self):
+        return len(self.coords)
+
+    def _cells(self, points: np.ndarray) -> np.ndarray:
+        return np.floor((points - self.origin) / self.cell_size).astype(np.int64)
+
+    def _keys(self, cells: np.ndarray) -> np.ndarray:
+        if len(cells) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.ravel_multi_index(cells.T, self.dims)
+
+    def _block_step(self, reach: int, max_block_size: int) -> int:
+        """Return how many points to search at once to bound memory."""
+        cells_searched = min((2 * reach + 1) ** 3, len(self.cell_keys))
+        atoms_per_cell = len(self) / max(1, len(self.cell_keys))
+        pairs_per_point = max(1, int(cells_searched * max(1, atoms_per_cell)))
+        return max(1, max_block_size // pairs_per_point)
+
+    def _candidates(self, points: np.ndarray, reach: int) -> tuple:
+        """Return (point, atom) index pairs of atoms within reach cells.
+
+        :param points: (n, 3) array of query coordinates
+        :param reach: Number of cells to search around each point
+        :return: Tuple of query point and atom index arrays
+        """
+        cells = self._cells(points)
+        if (2 * reach + 1) ** 3 > len(self.cell_keys):
+            # Fewer occupied cells than cells to search, so test each of them
+            occupied = np.stack(np.unravel_index(self.cell_keys, self.dims),
+                                axis=1)
+            near = np.abs(cells[:, None, :] - occupied[None, :, :]).max(axis=2)
+            point_idx, pos = np.nonzero(near <= reach)
+        else:
+            steps = np.arange(-reach, reach + 1)
+            offsets = np.stack(np.meshgrid(steps, steps, steps, indexing="ij"),
+                               axis=-1).reshape(-1, 3)
+            neighbors = cells[:, None, :] + offsets[None, :, :]
+            valid = np.all((neighbors >= 0) & (neighbors < self.dims), axis=2)
+            point_idx = np.nonzero(valid)[0]
+            keys = self._keys(neighbors[valid])
+            pos = np.minimum(np.searchsorted(self.cell_keys, keys),
+                             len(self.cell_keys) - 1)
+            found = self.cell_keys[pos] == keys
+            point_idx, pos = point_idx[found], pos[found]
+        counts = self.cell_counts[pos]
+        # Expand each (point, cell) pair into one pair per atom in the cell
+        run_starts = np.repeat(np.cumsum(counts) - counts, counts)
+        within_run = np.arange(counts.sum()) - run_starts
+        atoms = self.order[np.repeat(self.cell_starts[pos], counts) + within_run]
+        return (np.repeat(point_idx, counts), atoms)
+
+    def _distances(self, points, point_idx, atoms) -> np.ndarray:
+        diff = points[point_idx] - self.coords[atoms]
+        return np.sqrt(np.einsum("ij,ij->i", diff, diff))
+
+    def query_radius(self,
+                     points,
+                     radius: float,
+                     max_block_size: int = DISTANCE_BLOCK_SIZE) -> tuple:
+        """Return all pairs of query points and atoms within a radius.
+
+        :param points: (n, 3) array or nested list of query coordinates
+        :param radius: Search radius in angstroms
+        :param max_block_size: Approximate maximum number of candidate pairs
+            compared at once, to keep memory bounded for many query points
+        :return: Tuple of (point_idx, atom_idx, distances) arrays sorted by
+            query point then distance
+        """
+        points = _as_coord_array(points).astype(np.float64)
+        result = ([], [], [])
+        if len(self) and len(points):
+            reach = max(1, int(math.ceil(radius / self.cell_size)))
+            step = self._block_step(reach, max_block_size)
+            for start in range(0, len(points), step):
+                point_idx, atoms = self._candidates(points[start:start + step],
+                                                    reach)
+                point_idx += start
+                dists = self._distances(points, point_idx, atoms)
+                keep = dists <= radius
+                for values, found in zip(result, (point_idx, atoms, dists)):
+                    values.append(found[keep])
+        point_idx, atoms, dists = (np.concatenate(i) if i else np.empty(0)
+                                   for i in result)
+        order = np.lexsort((dists, point_idx))
+        return (point_idx[order].astype(np.intp),
+                atoms[order].astype(np.intp),
+                dists[order])
+
+    def query_nearest(self,
+                      points,
+                      k: int = 1,
+                      max_block_size: int = DISTANCE_BLOCK_SIZE) -> tuple:
+        """Return the k nearest atoms of each query point.
+
+        The search grows a cube of cells around each point until the k-th
+        nearest candidate is closer than any atom outside the searched cube.
+
+        :param points: (n, 3) array or nested list of query coordinates
+        :param k: Number of neighbors to return per point
+        :param max_block_size: As for query_radius
+        :return: Tuple of (distances, atom_idx) arrays shaped (n, k), sorted
+            by distance and padded with infinity and -1 when there are fewer
+            than k atoms
+        """
+        points = _as_coord_array(points).astype(np.float64)
+        distances = np.full((len(points), k), np.inf)
+        indexes = np.full((len(points), k), -1, dtype=np.intp)
+        if len(self) == 0:
+            return (distances, indexes)
+        # Reach of the cube around each point that covers the whole grid
+        cells = self._cells(points)
+        full_reach = np.maximum(np.abs(cells),
+                                np.abs(cells - self.dims + 1)).max(axis=1)
+        pending = np.arange(len(points))
+        reach = 1
+        while len(pending):
+            step = self._block_step(reach, max_block_size)
+            unresolved = []
+            for start in range(0, len(pending), step):
+                block = pending[start:start + step]
+                point_idx, atoms = self._candidates(points[block], reach)
+                dists = self._distances(points[block], point_idx, atoms)
+                # Rank the candidates of each point by distance
+                order = np.lexsort((dists, point_idx))
+                point_idx, atoms, dists = (point_idx[order], atoms[order],
+                                           dists[order])
+                starts = np.searchsorted(point_idx, np.arange(len(block)))
+                rank = np.arange(len(point_idx)) - starts[point_idx]
+                top = rank < k
+                found_d = np.full((len(block), k), np.inf)
+                found_i = np.full((len(block), k), -1, dtype=np.intp)
+                found_d[point_idx[top], rank[top]] = dists[top]
+                found_i[point_idx[top], rank[top]] = atoms[top]
+                # Atoms outside the searched cube are at least reach cells away
+                done = (full_reach[block] <= reach) | \
+                    (found_d[:, -1] <= reach * self.cell_size)
+                distances[block[done]] = found_d[done]
+                indexes[block[done]] = found_i[done]
+                unresolved.append(block[~done])
+            pending = np.concatenate(unresolved)
+            reach *= 2
+        return (distances, indexes)
+
+    def min_distances(self, points, cutoff: float = None) -> tuple:
+        """Return the distance and index of the nearest atom to each point.
+
+        :param points: (n, 3) array or nested list of query coordinates
+        :param cutoff: If given, only atoms within the cutoff are searched and
+            points without any are reported as infinity and -1
+        :return: Tuple of (distances, atom_idx) arrays with an entry per point
+        """
+        if cutoff is None:
+            distances, indexes = self.query_nearest(points, k=1)
+            return (distances[:, 0], indexes[:, 0])
+        points = _as_coord_array(points)
+        point_idx, atoms, dists = self.query_radius(points, cutoff)
+        distances = np.full(len(points), np.inf)
+        indexes = np.full(len(points), -1, dtype=np.intp)
+        # Pairs are sorted by distance within a point, so take the first
+        first = np.unique(point_idx, return_index=True)[1]
+        distances[point_idx[first]] = dists[first]
+        indexes[point_idx[first]] = atoms[first]
+        return (distances, indexes)
+
+
+class StructureCache:
+    """LRU cache of parsed Structures with an optional on-disk cache.
+
+    Structures are keyed by the file path, size and modification time, or by
+    a hash of the file content when hash_content is set, together with the
+    molecule types and chains parsed. Parsed structures are kept in memory
+    until their total size exceeds max_bytes, at which point the least
+    recently used are evicted. With a cache_dir, parsed arrays are also saved
+    as .npz files, so later processes load them instead of parsing.
+    """
+
+    def __init__(self,
+                 max_bytes: int = STRUCTURE_CACHE_BYTES,
+                 cache_dir: str = None,
+                 hash_content: bool = False):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.hash_content = hash_content
+        self.nbytes = 0
+        self._structures = OrderedDict()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self._structures)
+
+    def key(self, pdb_file: str, mol_types: list, chains: list) -> str:
+        """Return the cache key of a parse of a PDB file."""
+        if self.hash_content:
+            digest = hashlib.sha256()
+            with open(pdb_file, "rb") as file:
+                for block in iter(lambda: file.read(2**20), b""):
+                    digest.update(block)
+            file_id = digest.hexdigest()
+        else:
+            stat = os.stat(pdb_file)
+            file_id = (os.path.abspath(pdb_file), stat.st_size, stat.st_mtime_ns)
+        parse_id = (tuple(mol_types), None if chains is None else tuple(chains))
+        return hashlib.sha1(repr((file_id, parse_id)).encode()).hexdigest()
+
+    def load(self,
+             pdb_file: str,
+             mol_types: list = ["ATOM", "HETATM"],
+             chains: list = None) -> Structure:
+        """Return a Structure of a PDB file, parsing it only on a cache miss.
+
+        The same Structure object is returned on every hit, so it should be
+        treated as read only.
+        """
+        key = self.key(pdb_file, mol_types, chains)
+        if key in self._structures:
+            self._structures.move_to_end(key)
+            return self._structures[key]
+        npz_file = None
+        if self.cache_dir is not None:
+            npz_file = os.path.join(self.cache_dir, f"{key}.npz")
+        if npz_file is not None and os.path.exists(npz_file):
+            structure = Structure.from_npz(npz_file)
+        else:
+            structure = Structure.from_file(pdb_file, mol_types, chains)
+            if npz_file is not None:
+                # Write then rename, so concurrent readers never see a part
+                temp_file = f"{npz_file}.{os.getpid()}.tmp.npz"
+                structure.to_npz(temp_file)
+                os.replace(temp_file, npz_file)
+        self._add(key, structure)
+        return structure
+
+    def _add(self, key: str, structure: Structure):
+        self._structures[key] = structure
+        self.nbytes += structure.nbytes
+        # Evict the least recently used, but always keep the newest
+        while self.nbytes > self.max_bytes and len(self._structures) > 1:
+            _, evicted = self._structures.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        """Remove all structures held in memory."""
+        self._structures.clear()
+        self.nbytes = 0
+
+
+STRUCTURE_CACHE = StructureCache(cache_dir=os.environ.get(STRUCTURE_CACHE_DIR_ENV))
+
+
+def load_structure(pdb_file: str,
+                   mol_types: list = ["ATOM", "HETATM"],
+                   chains: list = None,
+                   cache: StructureCache = None) -> Structure:
+    """Return a Structure of a PDB file through a structure cache.
+
+    Repeated loads of an unchanged file return the parsed structure held by
+    the cache, STRUCTURE_CACHE by default. Setting the PDB_STRUCTURE_CACHE_DIR
+    environment variable enables the on-disk cache of STRUCTURE_CACHE.
+    Stdin ('-') and open files are always parsed.
+    """
+    if hasattr(pdb_file, "read") or pdb_file == "-":
+        return Structure.from_file(pdb_file, mol_types, chains)
+    if cache is None:
+        cache = STRUCTURE_CACHE
+    return cache.load(pdb_file, mol_types, chains)
+
+
 # Convert these into a single function 
 def parse_data_by_residues(pdb_data, residues):
     """Return subset of pdb data containing specified residues."""
+    if isinstance(pdb_data, Structure):
+        return pdb_data.select(residues=residues)
     result = list(filter(lambda x: x[6] in residues, pdb_data))
     return result
 
 def parse_data_by_chains(pdb_data, chains):
     """Return subset of pdb data containing specified chains"""
+    if isinstance(pdb_data, Structure):
+        return pdb_data.select(chains=chains)
     result = list(filter(lambda x: x[5] in chains, pdb_data))
     return result
 ###
 def coords_from_pdb_data(pdb_data):
     """Return just coordinates from pdb data."""
+    if isinstance(pdb_data, Structure):
+        return pdb_data.xyz
     result = list(map(lambda x: x[8:11], pdb_data))
     return result
 
@@ -188,140 +1313,550 @@ def parse_mutation_title(title_line):
 
 def pdb_to_fasta(pdb_file, chain):
     """Convert PDB sequence to FASTA."""
-    # Read file
-    file_object = open(pdb_file)
-    file_data = file_object.readlines()
-    file_object.close()
-    # Filter for ATOM lines
-    file_data = list(filter(lambda x: x.startswith("ATOM"), file_data))
-    # Split rows by data type
-    file_data = list(map(pdb_row_to_list, file_data))
-    # Filter by chain
-    file_data = list(filter(lambda x: x[5] == chain, file_data))
-    # Check that the chain exists
-    if len(file_data) == 0:
-        raise ValueError("No AA to convert.")
-    #file_data = sorted(file_data, key=lambda x: int(x[6]))
-    # Convert AAs listed in PDB file to single letter format
-    # Initialize with first letter and residue number
-    fasta_sequence = AA_DICT[file_data[0][4]]
+    # Stream the ATOM rows of the chain from the file
+    fasta_sequence = ""
     completed_residues = set()
-    residue = file_data[0][6]
-    for row in file_data:
-        if row[6] in completed_residues: # If there is a repeat residue number
-            raise ValueError("Repeated residues found.")
+    residue = None
+    for row in iter_pdb_records(pdb_file, ["ATOM"], [chain]):
         if row[6] != residue: # If there is a new residue
+            if row[6] in completed_residues: # If there is a repeat residue number
+                raise ValueError("Repeated residues found.")
+            # Convert AAs listed in PDB file to single letter format
             fasta_sequence = fasta_sequence + AA_DICT[row[4]]
-            completed_residues.add(residue)
+            completed_residues.add(row[6])
             residue = row[6]
+    # Check that the chain exists
+    if len(fasta_sequence) == 0:
+        raise ValueError("No AA to convert.")
     # Output FASTA header and sequence
     header = re.sub(r'^.*/', '', pdb_file)
     header = header.rstrip(".pdb")
     return (header, fasta_sequence)
 
+def pdb_to_fastas(pdb_file, chains: list = None, modified_residues: bool = True):
+    """Return the sequences of several chains of a PDB file in one pass.
+
+    Residues are keyed by number and insertion code, so inserted residues
+    are kept in file order. Modified residues in MODIFIED_RESIDUES listed as
+    HETATM, such as selenomethionine, are read as their parent amino acid.
+    Other HETATM residues are left out.
+
+    :param pdb_file: PDB file, gzip file or - for stdin
+    :param chains: Chains to convert, all chains when omitted
+    :param modified_residues: Read modified HETATM residues
+    :return: Tuple of the header, the file name without extension, and a
+        dictionary of chain to sequence in order of first appearance
+    :raises KeyError: For an ATOM residue that is not in AA_DICT
+    :raises ValueError: When a residue of a chain appears again after others
+    """
+    mol_types = ["ATOM", "HETATM"] if modified_residues else ["ATOM"]
+    letters = {}
+    last = {}
+    completed = {}
+    for row in iter_pdb_records(pdb_file, mol_types, chains):
+        chain = row[5]
+        residue = (row[6], row[7])
+        if last.get(chain) == residue:
+            continue
+        if row[0] == "HETATM":
+            if row[4] not in MODIFIED_RESIDUES:
+                continue
+            letter = MODIFIED_RESIDUES[row[4]]
+        else:
+            letter = AA_DICT[row[4]]
+        if residue in completed.setdefault(chain, set()):
+            raise ValueError(f"Repeated residues found in chain {chain}.")
+        completed[chain].add(residue)
+        letters.setdefault(chain, []).append(letter)
+        last[chain] = residue
+    header = re.sub(r"\.pdb$", "", re.sub(r'^.*/', '', str(pdb_file)))
+    return header, {chain: "".join(i) for chain, i in letters.items()}
+
+def residue_min_distances(pdb_data: Structure,
+                          query_coords,
+                          residues: list = None,
+                          max_distance: float = None) -> dict:
+    """Return the minimum distance of each residue to a set of coordinates.
+
+    Without a maximum distance, each atom of the residues is matched to its
+    nearest query coordinate through a spatial index of the query. With a
+    maximum distance, the spatial index of the structure is searched around
+    the query coordinates instead, so only nearby atoms are compared.
+
+    :param pdb_data: Structure to measure the residues of
+    :param query_coords: (n, 3) array of coordinates, e.g. of a mutant residue
+    :param residues: Residue sequence numbers to measure, all when omitted
+    :param max_distance: Residues further away are left out of the result
+    :return: Dictionary of residue sequence number to minimum distance
+    """
+    if max_distance is None:
+        residue_data = pdb_data if residues is None else \
+            pdb_data.select(residues=residues)
+        dists, _ = SpatialIndex(query_coords).min_distances(residue_data.xyz)
+        resseqs = residue_data.resseq
+    else:
+        _, atom_idx, dists = pdb_data.spatial_index().query_radius(query_coords,
+                                                                   max_distance)
+        resseqs = pdb_data.resseq[atom_idx]
+        if residues is not None:
+            keep = np.isin(resseqs, pdb_data.subset(
+                pdb_data.mask(residues=residues)).resseq)
+            resseqs, dists = resseqs[keep], dists[keep]
+    # Reduce atom distances to the minimum per residue
+    labels, inverse = np.unique(resseqs, return_inverse=True)
+    min_dists = np.full(len(labels), np.inf)
+    np.minimum.at(min_dists, inverse, dists)
+    return dict(zip(labels.tolist(), min_dists.tolist()))
+
+
+def feature_residues(features_dict: dict) -> list:
+    """Return [uniprot_id, feature, residue] for each residue of features."""
+    result = []
+    for uniprot_id in features_dict:
+        for feature in features_dict[uniprot_id]:
+            if feature not in ("Region"):
+                for residue in features_dict[uniprot_id][feature]:
+                    result.append([uniprot_id, feature, residue])
+    return result
+
+
+class IntervalTree:
+    """Static interval tree of closed integer intervals.
+
+    Intervals are sorted by start and stored as an implicit balanced binary
+    search tree, in which the middle of each range of the sorted arrays is a
+    node, together with the largest end within each subtree. Queries skip
+    the subtrees that end before the queried range, so finding the k
+    intervals that overlap a range takes O(log n + k).
+    """
+
+    def __init__(self, starts, ends):
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        self.order = np.lexsort((ends, starts))
+        self.starts = starts[self.order]
+        self.ends = ends[self.order]
+        self.max_ends = np.empty_like(self.ends)
+        # Iterate the nodes bottom up, so children are set before parents
+        nodes = []
+        stack = [(0, len(self.starts))]
+        while stack:
+            lo, hi = stack.pop()
+            if lo < hi:
+                mid = (lo + hi) // 2
+                nodes.append((lo, mid, hi))
+                stack.extend([(lo, mid), (mid + 1, hi)])
+        for lo, mid, hi in reversed(nodes):
+            self.max_ends[mid] = max(self.ends[mid],
+                                     self.max_ends[(lo + mid) // 2] if lo < mid
+                                     else self.ends[mid],
+                                     self.max_ends[(mid + 1 + hi) // 2] if mid + 1 < hi
+                                     else self.ends[mid])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def query(self, start: int, end: int = None) -> np.ndarray:
+        """Return the indices of the intervals overlapping [start, end].
+
+        :param start: First residue of the queried range
+        :param end: Last residue of the queried range, start when omitted
+        :return: Sorted indices into the starts and ends the tree was built from
+        """
+        if end is None:
+            end = start
+        starts, ends, max_ends = self.starts, self.ends, self.max_ends
+        result = []
+        stack = [(0, len(starts))]
+        while stack:
+            lo, hi = stack.pop()
+            if lo >= hi:
+                continue
+            mid = (lo + hi) // 2
+            if max_ends[mid] < start:
+                continue # Every interval of the subtree ends before the range
+            stack.append((lo, mid))
+            if starts[mid] <= end:
+                if ends[mid] >= start:
+                    result.append(mid)
+                stack.append((mid + 1, hi))
+        return np.sort(self.order[np.array(result, dtype=np.intp)])
+
+
+class FeatureIndex:
+    """Uniprot features of single residues and residue ranges.
+
+    Each feature residue of a features dictionary, as written by
+    uniprot_feature_regions, becomes a closed interval of residue numbers,
+    a single residue being an interval with the same start and end. Ranges
+    are labelled "start-end". Features that are not residue numbers are left
+    out. The intervals are held in an IntervalTree.
+    """
+
+    def __init__(self, features_dict: dict):
+        self.rows = []
+        starts = []
+        ends = []
+        for uniprot_id, feature, residue in feature_residues(features_dict):
+            if isinstance(residue, (list, tuple)) and len(residue) == 2:
+                start = _to_int(str(residue[0]), None)
+                end = _to_int(str(residue[1]), None)
+                label = f"{start}-{end}"
+            else:
+                start = end = _to_int(str(residue), None)
+                label = str(residue)
+            if start is None or end is None:
+                continue
+            self.rows.append([uniprot_id, feature, label])
+            starts.append(min(start, end))
+            ends.append(max(start, end))
+        self.starts = np.array(starts, dtype=np.int64)
+        self.ends = np.array(ends, dtype=np.int64)
+        self.tree = IntervalTree(self.starts, self.ends)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def residues(self) -> np.ndarray:
+        """Return the sorted residue numbers covered by any feature."""
+        if len(self) == 0:
+            return np.empty(0, dtype=np.int64)
+        lengths = self.ends - self.starts + 1
+        # Expand every interval to its residues with one vectorized range
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths,
+                                                       lengths)
+        return np.unique(np.repeat(self.starts, lengths) + offsets)
+
+    def min_distances(self, resseqs, dists) -> np.ndarray:
+        """Return the minimum distance to each feature from residue distances.
+
+        :param resseqs: Residue sequence numbers that were measured
+        :param dists: Distance of each residue in resseqs
+        :return: Array with the minimum distance over the residues of each
+            feature, inf for features without a measured residue
+        """
+        resseqs = np.asarray(resseqs, dtype=np.int64)
+        dists = np.asarray(dists, dtype=float)
+        result = np.full(len(self), np.inf)
+        if len(resseqs) == 0 or len(self) == 0:
+            return result
+        order = np.argsort(resseqs, kind="stable")
+        resseqs = resseqs[order]
+        # A trailing inf keeps every slice end a valid reduceat index
+        dists = np.append(dists[order], np.inf)
+        hits = self.tree.query(resseqs[0], resseqs[-1])
+        lo = np.searchsorted(resseqs, self.starts[hits], side="left")
+        hi = np.searchsorted(resseqs, self.ends[hits], side="right")
+        found = hi > lo
+        hits, lo, hi = hits[found], lo[found], hi[found]
+        if len(hits):
+            # Reduce each [lo, hi) slice, ignoring the [hi, next lo) ones between
+            bounds = np.column_stack((lo, hi)).ravel()
+            result[hits] = np.minimum.reduceat(dists, bounds)[::2]
+        return result
+
+
+def distances_to_features(pdb_data: Structure,
+                          features_dict: dict,
+                          residues: list,
+                          max_distance: float = None) -> list:
+    """Return distance to features of several residues of one structure.
+
+    The features are indexed once, ranges included, and the distances from
+    each residue to all residues covered by features are found with one
+    spatial index query per residue. The distance to a range is the
+    minimum over its residues.
+
+    :param pdb_data: Structure of the ATOM rows of a PDB file
+    :param features_dict: Features as loaded from a features JSON file
+    :param residues: List of (chain, residue) pairs to measure from
+    :param max_distance: Features further from a residue are left out
+    :return: List with, per residue, a nested list as distance_to_features
+    """
+    feature_index = FeatureIndex(features_dict)
+    feature_numbers = feature_index.residues().tolist()
+    results = []
+    for chain_input, residue_input in residues:
+        mut_coords = pdb_data.residue(chain_input, residue_input).xyz
+        residue_dists = residue_min_distances(pdb_data,
+                                              mut_coords,
+                                              feature_numbers,
+                                              max_distance)
+        dists = feature_index.min_distances(list(residue_dists.keys()),
+                                            list(residue_dists.values()))
+        result = [[dist] + row for dist, row in zip(dists.tolist(),
+                                                     feature_index.rows)]
+        # Sort result by distance
+        result = sorted(result, key=lambda x: x[0])
+        # Remove all infinity distances
+        result = list(filter(lambda x: x[0] != math.inf, result))
+        results.append(result)
+    return results
+
+
 def distance_to_features(pdb_file: str,
                          features_file: str,
                          chain_input: str,
-                         residue_input: str) -> list:
-    """Return distance to features as a nested list."""
-    # Read pdb file
-    with open(pdb_file) as pdb_file_object:
-        pdb_lines = pdb_file_object.readlines()
+                         residue_input: str,
+                         max_distance: float = None) -> list:
+    """Return distance to features as a nested list.
+
+    If max_distance is given, features further from the residue are left out
+    and only atoms within that distance of the residue are searched.
+    """
     # Read features file
     with open(features_file) as features_file_object:
         features_dict = json.load(features_file_object)
-    # Filter for PDB atom data
-    pdb_data = read_pdb_atms(pdb_lines, ["ATOM"])
-    mut_data = parse_data_by_residues(pdb_data, [residue_input])
-    mut_data = parse_data_by_chains(mut_data, [chain_input])
-    mut_coords = coords_from_pdb_data(mut_data)
-    # For each uniprot_id
-    seen_residue = {}  # Track previously calculated distances
-    result = []
-    for uniprot_id in features_dict:
-        for feature in features_dict[uniprot_id]:
-            if feature not in ("Region"):
-                for residue in features_dict[uniprot_id][feature]:
-                    # If the distance was already calculated, append to result
-                    if residue in seen_residue:
-                        result.append([seen_residue[residue],
-                                       uniprot_id,
-                                       feature,
-                                       str(residue)])
-                    # Else, calculate the distance, append to result, and save
-                    else:
-                        residue_entries = parse_data_by_residues(pdb_data,
-                                                                     [str(residue)])
-                        feature_coords = coords_from_pdb_data(residue_entries)
-                        dist = min_distance_coords_to_coords(mut_coords,
-                                                                 feature_coords)
-                        result.append([dist, uniprot_id, feature, str(residue)])
-                        seen_residue[residue] = dist
-    # Sort result by distance
-    result = sorted(result, key=lambda x: x[0])
-    # Remove all infinity distances
-    result = list(filter(lambda x: x[0] != math.inf, result))
+    # Load PDB atom data from the pdb file through the structure cache
+    pdb_data = load_structure(pdb_file, ["ATOM"])
+    [result] = distances_to_features(pdb_data,
+                                     features_dict,
+                                     [(chain_input, residue_input)],
+                                     max_distance)
     return result
 
+@functools.lru_cache(maxsize=ALIGNMENT_CACHE_SIZE)
+def align_sequences(sequence_a: str,
+                    sequence_b: str,
+                    scores: tuple = ALIGNMENT_SCORES) -> tuple:
+    """Return the aligned positions of two sequences.
+
+    Sequences of the same length that are at least IDENTITY_FAST_PATH
+    identical, such as a WT and a point mutant, are aligned by position.
+    Others are aligned globally with Needleman-Wunsch and a linear gap
+    score, filling the score matrix one row at a time: the diagonal and
+    vertical moves of a row are vectorized, and the horizontal moves are a
+    running maximum along the row. Results are cached, so the models of a
+    protein with the same sequence are aligned once.
+
+    :param sequence_a: First sequence
+    :param sequence_b: Second sequence
+    :param scores: Scores of a (match, mismatch, gap)
+    :return: Tuple of read only index arrays of the aligned positions in
+        sequence_a and sequence_b, gaps left out
+    """
+    match, mismatch, gap = scores
+    a = np.frombuffer(sequence_a.encode(), dtype=np.uint8)
+    b = np.frombuffer(sequence_b.encode(), dtype=np.uint8)
+    n, m = len(a), len(b)
+    if n == m and (n == 0 or np.count_nonzero(a == b) >= IDENTITY_FAST_PATH * n):
+        index_a = np.arange(n)
+        index_b = np.arange(m)
+    else:
+        columns = np.arange(m + 1, dtype=np.int64)
+        previous = gap * columns
+        # Moves into each cell: 0 diagonal, 1 vertical (gap in b), 2 horizontal
+        moves = np.zeros((n + 1, m + 1), dtype=np.uint8)
+        moves[0, 1:] = 2
+        moves[1:, 0] = 1
+        row = np.empty(m + 1, dtype=np.int64)
+        for i in range(1, n + 1):
+            diagonal = previous[:-1] + np.where(b == a[i - 1], match, mismatch)
+            vertical = previous[1:] + gap
+            row[0] = gap * i
+            row[1:] = np.maximum(diagonal, vertical)
+            # Best of the row so far with a gap score per horizontal move
+            current = np.maximum.accumulate(row - gap * columns) + gap * columns
+            moves[i, 1:] = np.where(current[1:] > row[1:], 2,
+                                    np.where(diagonal >= vertical, 0, 1))
+            previous = current
+        index_a = []
+        index_b = []
+        i, j = n, m
+        while i > 0 or j > 0:
+            move = moves[i, j]
+            if move == 0:
+                i, j = i - 1, j - 1
+                index_a.append(i)
+                index_b.append(j)
+            elif move == 1:
+                i -= 1
+            else:
+                j -= 1
+        index_a = np.array(index_a[::-1], dtype=np.intp)
+        index_b = np.array(index_b[::-1], dtype=np.intp)
+    index_a.setflags(write=False)
+    index_b.setflags(write=False)
+    return index_a, index_b
+
+
+def residue_alignment(pdb_file_a,
+                      pdb_file_b,
+                      chain) -> tuple:
+    """Return the residues of a chain in two files aligned by sequence.
+
+    Either file may be given as a path, loaded through the structure cache,
+    or as an already parsed Structure, whose chain sequence is then kept
+    for the next alignment.
+
+    :return: Tuple of (residues_a, residues_b, index_a, index_b), the
+        (resseq, icode) of each residue of the chain in each file and index
+        arrays of the aligned pairs of residues
+    """
+    chains = []
+    for pdb_file in (pdb_file_a, pdb_file_b):
+        if not isinstance(pdb_file, Structure):
+            pdb_file = load_structure(pdb_file, ["ATOM"], [chain])
+        chains.append(pdb_file.chain_sequence(chain))
+    (residues_a, sequence_a), (residues_b, sequence_b) = chains
+    index_a, index_b = align_sequences(sequence_a, sequence_b)
+    return residues_a, residues_b, index_a, index_b
+
+
 def residue_mapping(pdb_file_a,
                     pdb_file_b,
                     chain) -> dict:
-    # Read residues
-    file_lines = []
-    for i in (pdb_file_a, pdb_file_b):
-        with open(i) as file:
-            file_lines.append(file.readlines())
-    atoms = [read_pdb_atms(i, ["ATOM"]) for i in file_lines]
-    atoms = [list(filter(lambda x: x[5] == chain, i)) for i in atoms]
-    residues = []
-    for atom_list in atoms:
-        # Append ordered unique residues from the atom data
-        residues.append(list(OrderedDict.fromkeys([i[6] for i in atom_list])))
-    result = dict(zip(residues[0], residues[1]))
+    """Return a map of the residues of a chain in one file to another.
+
+    Residues are paired by aligning the sequences of the chain with
+    residue_alignment, so gaps and missing loops are not mapped. Residues
+    are given as the residue number followed by any insertion code.
+    """
+    residues_a, residues_b, index_a, index_b = residue_alignment(pdb_file_a,
+                                                                 pdb_file_b,
+                                                                 chain)
+    result = {f"{residues_a[i][0]}{residues_a[i][1]}":
+              f"{residues_b[j][0]}{residues_b[j][1]}"
+              for i, j in zip(index_a.tolist(), index_b.tolist())}
     return result
 
 def apply_residue_map(pdb_file, residue_dict, chain):
-    with open(pdb_file) as file:
-        lines = file.readlines()
-    result = []
+    """Yield the lines of a PDB file with the residues of a chain renumbered."""
+    return apply_residue_map_lines(iter_pdb_lines(pdb_file), residue_dict, chain)
+
+def apply_residue_map_lines(lines, residue_dict, chain, drop_unmapped=False):
+    """Yield PDB lines with the residues of a chain renumbered.
+
+    Residues are looked up by number and insertion code, as given by
+    residue_mapping. Lines of residues missing from the map raise a
+    KeyError, or are left out with drop_unmapped.
+    """
     for line in lines:
         if line.startswith("ATOM") and chain == line[20:22].strip():
-            residue = line[22:26].strip()
+            residue = line[22:27].strip()
+            if residue not in residue_dict and drop_unmapped:
+                continue
             new_residue = residue_dict[residue]
-            newline = line[:22] + f"{new_residue: >4}" + line[26:]
-            result.append(newline)
+            number = new_residue.rstrip("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+            icode = new_residue[len(number):]
+            newline = line[:22] + f"{number: >4}" + f"{icode: <1}" + line[27:]
+            yield newline
         else:
-            result.append(line)
-    return result
+            yield line
 
 def convert_chain(pdb_file, chain_dict):
-    with open(pdb_file) as file:
-        lines = file.readlines()
-    result = []
+    """Yield the lines of a PDB file with the ATOM chains renamed."""
+    return convert_chain_lines(iter_pdb_lines(pdb_file), chain_dict)
+
+def convert_chain_lines(lines, chain_dict):
+    """Yield PDB lines with the ATOM chains renamed."""
     for line in lines:
         if line.startswith("ATOM"):
             chain = line[20:22].strip()
             new_chain = chain_dict[chain]
             newline = line[:20] + f"{new_chain: >2}" + line[22:]
-            result.append(newline)
+            yield newline
         else:
-            result.append(line)
-    return result
+            yield line
 
-def correct_ember_file(ember_pdb, wt_pdb, chain, output):
+def clean_pdb_lines(lines,
+                    residues: list = WATER_RESIDUES,
+                    hetatm: bool = False,
+                    merge_chains: bool = False):
+    """Yield PDB lines without the atoms of given residues, in one pass.
+
+    Atoms are matched by the exact residue name column, so other lines that
+    merely contain a residue name, such as their REMARK or HETNAM, are kept.
+    ANISOU lines follow their atom. With merge_chains, every atom after the
+    first chain is moved to the first chain so that pdb2gmx reads one
+    chain. As in the iCn3D rmhet.js script, a residue keeps its number and
+    takes the last character of its chain as insertion code, or keeps its
+    own insertion code when it has one. A residue whose new number and
+    insertion code are already taken in the merged chain, such as 52 and
+    52A of another chain or residues of two character chains ending in the
+    same character, is instead numbered after the highest residue number.
+
+    :param lines: PDB lines
+    :param residues: Residue names of the atoms left out
+    :param hetatm: Leave out all HETATM atoms
+    :param merge_chains: Move every atom to the first chain
+    """
+    residue_names = {f"{residue:>3}" for residue in residues}
+    name_start, name_end = PDB_INDEX_DELIMS[4], PDB_INDEX_DELIMS[5]
+    chain_start, chain_end = PDB_INDEX_DELIMS[5], PDB_INDEX_DELIMS[6]
+    icode_end = PDB_INDEX_DELIMS[8]
+    first_chain = None
+    # Number and insertion code in the merged chain of each chain residue
+    merged = {}
+    taken = set()
+    highest = 0
+    dropped = False
+    for line in lines:
+        if line.startswith(("ATOM", "HETATM")):
+            dropped = (line[name_start:name_end] in residue_names
+                       or (hetatm and line.startswith("HETATM")))
+            if dropped:
+                continue
+            if merge_chains:
+                chain = line[chain_start:chain_end]
+                residue = line[chain_end:icode_end]
+                if first_chain is None:
+                    first_chain = chain
+                key = (chain, residue)
+                if key not in merged:
+                    new_residue = residue
+                    if chain != first_chain:
+                        if not residue[-1].strip():
+                            new_residue = residue[:-1] + chain[-1]
+                    if new_residue in taken:
+                        new_residue = f"{highest + 1:>4} "
+                    merged[key] = new_residue
+                    taken.add(new_residue)
+                    highest = max(highest, _to_int(new_residue[:-1]))
+                line = line[:chain_start] + first_chain + merged[key] + line[icode_end:]
+        elif line.startswith("ANISOU"):
+            if dropped:
+                continue
+        elif line.startswith("TER") and line[name_start:name_end] in residue_names:
+            continue
+        yield line
+
+def clean_pdb_file(pdb_source, output, **kwargs):
+    """Write a PDB source through clean_pdb_lines, streaming line by line.
+
+    :param pdb_source: Path to a PDB file, '-' for stdin, or an open file
+    :param output: Path of the cleaned PDB file, removed if cleaning fails
+    :param kwargs: Options of clean_pdb_lines
+    """
+    try:
+        with open(output, 'w') as outfile:
+            outfile.writelines(clean_pdb_lines(iter_pdb_lines(pdb_source), **kwargs))
+    except BaseException:
+        if os.path.exists(output):
+            os.remove(output)
+        raise
+
+def correct_ember_lines(ember_pdb, wt_pdb, chain) -> list:
+    """Return the lines of an EMBER3D file with the chain and residues of WT.
+
+    The chain conversion and residue renumbering are done in memory. The WT
+    may be given as a path, loaded through the structure cache, or as an
+    already parsed Structure shared across the EMBER files of a protein.
+    """
     # Convert to right chain
-    corr_chain = convert_chain(ember_pdb, {"A":chain})
-    with open(f"{output}.temp", 'w') as cchain_file:
-        for i in corr_chain:
-            cchain_file.write(i)
-    # Obtain residue dict
-    residue_dict = residue_mapping(f"{output}.temp", wt_pdb, chain)
+    corr_chain = list(convert_chain(ember_pdb, {"A":chain}))
+    # Obtain residue dict, parsing the converted lines outside the cache
+    residue_dict = residue_mapping(Structure.from_lines(corr_chain, ["ATOM"]),
+                                   wt_pdb,
+                                   chain)
     if len(residue_dict) == 0:
-        raise ValueError(f"No map created between {output}.temp and {wt_pdb}")
-    # Apply residue conversion
-    result = apply_residue_map(f"{output}.temp", residue_dict, chain)
+        raise ValueError(f"No map created between {ember_pdb} and WT chain {chain}")
+    # Apply residue conversion, leaving out residues missing from the WT
+    return list(apply_residue_map_lines(corr_chain, residue_dict, chain,
+                                        drop_unmapped=True))
+
+def correct_ember_file(ember_pdb, wt_pdb, chain, output):
+    """Write an EMBER3D file with the chain and residues of its WT."""
+    result = correct_ember_lines(ember_pdb, wt_pdb, chain)
     with open(output, 'w') as outfile:
-        for i in result:
-            outfile.write(i)
-    # Remove temp file
-    os.remove(f"{output}.temp")
+        outfile.writelines(result)
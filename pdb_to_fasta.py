@@ -32,16 +32,8 @@ def argument_parser():
 def main():
     """Convert PDB sequence to FASTA."""
     args = argument_parser()
-    # Read file
-    file_object = open(args.pdb_file)
-    file_data = file_object.readlines()
-    file_object.close()
-    # Filter for ATOM lines
-    file_data = list(filter(lambda x: x.startswith("ATOM"), file_data))
-    # Split rows by data type
-    file_data = list(map(pal.pdb_row_to_list, file_data))
-    # Filter by chain
-    file_data = list(filter(lambda x: x[5] == args.chain, file_data))
+    # Stream the ATOM lines of the chain, split by data type
+    file_data = pal.iter_pdb_records(args.pdb_file, ["ATOM"], [args.chain])
     file_data = sorted(file_data, key=lambda x: int(x[6]))
     # Convert AAs listed in PDB file to single letter format
     # Initialize with first letter and residue number
@@ -1,8 +1,10 @@
 """Given a folder with WT and mutations, return fasta files."""
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 import glob
 import logging
+import os
 
 import pdb_analysis_lib as pal
 
@@ -23,77 +25,134 @@ def argument_parser():
                                     required=True,
                                     type=str,
                                     help="Output folder for FASTA files.")
+    parser.add_argument('-m',
+                        "--multi_fasta",
+                        type=str,
+                        help=("Write every sequence to this one multi-record "
+                              "FASTA file instead of one file per chain."))
+    parser.add_argument('-j',
+                        "--jobs",
+                        type=int,
+                        default=1,
+                        help="Number of processes to convert files with.")
     args = parser.parse_args()
     return args
 
 
+def fasta_record(header, sequence, max_sequence_line_length=79):
+    """Return a FASTA record with the sequence wrapped into lines."""
+    lines = [f">{header}"]
+    lines.extend(sequence[i:i + max_sequence_line_length]
+                 for i in range(0, len(sequence), max_sequence_line_length))
+    if not sequence:
+        lines.append("")
+    return "\n".join(lines) + "\n"
+
+
 def write_fasta_file(file_path, header, sequence, max_sequence_line_length=79):
     with open(file_path, 'w') as file_object:
-        file_object.write(f">{header}\n")
-        start_idx = 0
-        end_idx = max_sequence_line_length
-        while end_idx < len(sequence):
-            file_object.write(sequence[start_idx:end_idx] + '\n')
-            start_idx += max_sequence_line_length
-            end_idx += max_sequence_line_length
-        file_object.write(sequence[start_idx:] + '\n')
+        file_object.write(fasta_record(header, sequence, max_sequence_line_length))
+
+
+def conversion_tasks(files):
+    """Return (pdb_file, chains, output names) to convert from each file.
+
+    Mutation files, named <pdb_id>_<chain>_<residue>_<mutation>.pdb, are
+    converted for their chain. WT files, named <pdb_id>_..WT..pdb, are
+    converted once for every chain of their mutation files.
+    """
+    tasks = []
+    wt_chains = {}
+    for mfile in files:
+        mfile_name = os.path.basename(mfile)
+        if "WT" in mfile_name:
+            continue
+        pdb_id, chain, residue, mutation = mfile_name[:-len('.pdb')].split('_')
+        wt_chains.setdefault(pdb_id, set()).add(chain)
+        tasks.append((mfile, [chain],
+                      {chain: f"{pdb_id}_{chain}_{residue}_{mutation}.fasta"}))
+    for wtfile in files:
+        wtfile_name = os.path.basename(wtfile)
+        if "WT" not in wtfile_name:
+            continue
+        pdb_id = wtfile_name.split('_')[0]
+        chains = sorted(wt_chains.get(pdb_id, ()))
+        if chains:
+            tasks.append((wtfile, chains,
+                          {chain: f"{pdb_id}_{chain}_WT.fasta" for chain in chains}))
+    return tasks
+
+
+def conversion_error(error):
+    """Return the message of a KeyError or ValueError of pdb_to_fastas."""
+    if isinstance(error, KeyError):
+        return f"unconventional AA: {error}"
+    return str(error)
+
+
+def convert_file(task):
+    """Return the header, chain sequences and chain errors of a file.
+
+    The chains are read in one pass. When that fails, each chain is read on
+    its own, so that one bad chain does not stop the others being converted.
+    """
+    pdb_file, chains, _ = task
+    try:
+        header, sequences = pal.pdb_to_fastas(pdb_file, chains)
+        return (task, header, sequences, {})
+    except (KeyError, ValueError) as error:
+        if len(chains) == 1:
+            return (task, None, {}, {chains[0]: conversion_error(error)})
+    header, sequences, errors = None, {}, {}
+    for chain in chains:
+        try:
+            header, chain_sequences = pal.pdb_to_fastas(pdb_file, [chain])
+        except (KeyError, ValueError) as error:
+            errors[chain] = conversion_error(error)
+        else:
+            sequences.update(chain_sequences)
+    return (task, header, sequences, errors)
 
 
 def main():
     args = argument_parser()
     input_folder = args.input_folder.rstrip('/')
     output_folder = args.output_folder.rstrip('/')
-    files = glob.glob(f"{input_folder}/*.pdb")
-    mutation_files = list(filter(lambda x: "WT" not in x.split('/')[-1],
-                                 files))
+    files = sorted(glob.glob(f"{input_folder}/*.pdb"))
     if args.verbose:
         log_level = logging.DEBUG
     else:
         log_level = logging.WARNING
     logging.basicConfig(level=log_level)
-    id_chain_pairs = set()
+    tasks = conversion_tasks(files)
     logging.info(f"Input of {len(files)} files")
-    logging.info(f"Converting {len(mutation_files)} mutation files")
-    for mfile in mutation_files:
-        mfile_name = mfile.split('/')[1]
-        pdb_id, chain, residue, mutation = mfile_name.rstrip('.pdb').split('_')
-        id_chain_pairs.add((pdb_id, chain))
-        try:
-            header, sequence = pal.pdb_to_fasta(mfile, chain)
-        except KeyError as keyerror:
-            logging.warning(f"{mfile_name} not converted, unconventional AA: {keyerror}")
-        except ValueError as valerr:
-            logging.warning(f"{mfile_name} not converted: {valerr}")
-        except:
-            logging.critical(f"{mfile_name} cannot be processed.")
-            raise
-        else:
-            # Output file
-            output_file_name = f"{pdb_id}_{chain}_{residue}_{mutation}.fasta"
-            output_file = f"{output_folder}/{output_file_name}"
-            write_fasta_file(output_file, header, sequence)
-    logging.info("Done!")
-    # Convert WT files
-    wt_files = list(filter(lambda x: "WT" in x.split('/')[-1], files))
-    wt_ids = list(map(lambda x: x.split('/')[-1].split('_')[0], wt_files))
-    wt_file_dict = dict(zip(wt_ids, wt_files))
-    id_chain_pairs = list(id_chain_pairs)
-    logging.info(f"Converting {len(wt_files)} wildtype files...")
-    for pdb_id, chain in id_chain_pairs:
-        wtfile_name = wt_file_dict[pdb_id]
-        try:
-            header, sequence = pal.pdb_to_fasta(wtfile_name, chain)
-        except KeyError as keyerror:
-            logging.warning(f"{wtfile_name} not converted, unconventional AA: {keyerror}")
-        except ValueError as valerr:
-            logging.warning(f"{wtfile_name} not converted: {valerr}")
-        except:
-            logging.critical(f"{wtfile_name} cannot be processed.")
-            raise
-        else:
-            output_file_name = f"{pdb_id}_{chain}_WT.fasta"
-            output_file = f"{output_folder}/{output_file_name}"
-            write_fasta_file(output_file, header, sequence)
+    logging.info(f"Converting {len(tasks)} files with {args.jobs} process(es)")
+    multi_fasta = None
+    if args.multi_fasta is not None:
+        multi_fasta = open(args.multi_fasta, 'w', buffering=2**20)
+    try:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            for task, header, sequences, errors in executor.map(convert_file,
+                                                                 tasks,
+                                                                 chunksize=16):
+                pdb_file, chains, output_names = task
+                file_name = os.path.basename(pdb_file)
+                for chain in chains:
+                    if chain in errors:
+                        logging.warning(f"{file_name} chain {chain} not converted, "
+                                        f"{errors[chain]}")
+                    elif chain not in sequences:
+                        logging.warning(f"{file_name} chain {chain} not converted: "
+                                        "No AA to convert.")
+                    elif multi_fasta is not None:
+                        multi_fasta.write(fasta_record(f"{header}:{chain}",
+                                                       sequences[chain]))
+                    else:
+                        output_file = f"{output_folder}/{output_names[chain]}"
+                        write_fasta_file(output_file, header, sequences[chain])
+    finally:
+        if multi_fasta is not None:
+            multi_fasta.close()
     logging.info("Done!")
 
 
@@ -0,0 +1,135 @@
+"""Indexed store of the combined PTMs of uniprot ids.
+
+The PTM table is kept in SQLite with an index on the uniprot id, so the
+PTMs of one id are looked up without loading the whole table.
+
+Classes:
+PTMStore -- read only mapping of uniprot id to PTM positions
+
+Functions:
+iter_ptm_rows -- stream (uniprot id, PTM, position) rows of the PTM CSV
+build_ptm_store -- write a PTMStore file from the PTM CSV
+build_ptm_json -- write the legacy Combined_PTMs.json from the PTM CSV
+open_ptms -- open a PTMStore or a legacy JSON file of PTMs
+"""
+
+import csv
+import json
+import os
+import sqlite3
+from collections.abc import Mapping
+from itertools import islice
+
+
+INSERT_BATCH_SIZE = 10000
+
+
+def iter_ptm_rows(csv_file):
+    """
+    Stream the rows of the combined PTMs CSV.
+    :param csv_file: path of the CSV, with a header line
+    :returns: iterator of (uniprot id, PTM, position)
+    """
+    with open(csv_file, newline='') as csvfile:
+        data = csv.reader(csvfile, delimiter=' ', quotechar='|')
+        next(data)
+        for row in data:
+            uniprotID, _, PTMpos, PTMs, _ = row[0].rsplit(',')
+            yield uniprotID, PTMs, int(PTMpos)
+
+
+def build_ptm_store(csv_file, db_file):
+    """
+    Write the rows of the combined PTMs CSV to an indexed SQLite store.
+    Rows are inserted in batches as they are read, and the store is
+    renamed into place once complete.
+    :param csv_file: path of the CSV
+    :param db_file: path of the store to write
+    """
+    temp_file = f"{db_file}.{os.getpid()}.tmp"
+    if os.path.exists(temp_file):
+        os.remove(temp_file)
+    connection = sqlite3.connect(temp_file)
+    try:
+        with connection:
+            connection.execute(
+                "CREATE TABLE ptms (accession TEXT, ptm TEXT, position INTEGER)")
+            rows = iter_ptm_rows(csv_file)
+            while True:
+                batch = list(islice(rows, INSERT_BATCH_SIZE))
+                if not batch:
+                    break
+                connection.executemany("INSERT INTO ptms VALUES (?, ?, ?)", batch)
+            # Indexing once all rows are in is faster than indexing each insert
+            connection.execute("CREATE INDEX ptms_accession ON ptms (accession)")
+    finally:
+        connection.close()
+    os.replace(temp_file, db_file)
+
+
+def build_ptm_json(csv_file, json_file):
+    """
+    Write the combined PTMs CSV as one JSON dictionary, as read by
+    open_ptms for stores made before PTMStore.
+    :param csv_file: path of the CSV
+    :param json_file: path of the JSON file to write
+    """
+    combined_ptms = {}
+    for uniprotID, PTMs, PTMpos in iter_ptm_rows(csv_file):
+        combined_ptms.setdefault(uniprotID, {}).setdefault(PTMs, []).append(PTMpos)
+    with open(json_file, "w") as f:
+        f.write(json.dumps(combined_ptms))
+
+
+class PTMStore(Mapping):
+    """
+    Read only mapping of uniprot id to a dictionary of PTM positions,
+    {PTM: [position, ...]}, as in Combined_PTMs.json. Each lookup is an
+    index search of the SQLite store.
+    """
+
+    def __init__(self, db_file):
+        if not os.path.exists(db_file):
+            raise FileNotFoundError(db_file)
+        self.db_file = db_file
+        self.connection = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+
+    def __getitem__(self, uniprotID):
+        rows = self.connection.execute(
+            "SELECT ptm, position FROM ptms WHERE accession = ? ORDER BY rowid",
+            (uniprotID,)).fetchall()
+        if not rows:
+            raise KeyError(uniprotID)
+        result = {}
+        for PTMs, PTMpos in rows:
+            result.setdefault(PTMs, []).append(PTMpos)
+        return result
+
+    def __contains__(self, uniprotID):
+        return self.connection.execute(
+            "SELECT 1 FROM ptms WHERE accession = ? LIMIT 1",
+            (uniprotID,)).fetchone() is not None
+
+    def __iter__(self):
+        for (uniprotID,) in self.connection.execute(
+                "SELECT DISTINCT accession FROM ptms ORDER BY accession"):
+            yield uniprotID
+
+    def __len__(self):
+        return self.connection.execute(
+            "SELECT COUNT(DISTINCT accession) FROM ptms").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+def open_ptms(filename):
+    """
+    Open the combined PTMs of uniprot ids.
+    :param filename: path of a PTMStore, or of a JSON file ending in .json
+    :returns: mapping of uniprot id to a dictionary of PTM positions
+    """
+    if filename.endswith('.json'):
+        with open(filename, "r") as f:
+            return json.load(f)
+    return PTMStore(filename)
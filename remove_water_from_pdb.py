@@ -1,17 +1,82 @@
-"""Remove water atoms from a pdb file."""
+"""Remove water atoms from pdb files.
 
-import sys
+Each PDB file is written to <name>_clean.pdb without the atoms of its
+waters, all files being cleaned in one process.
+"""
+
+import argparse
+import logging
 import os
+import sys
+
+import pdb_analysis_lib as pal
+
+
+def argument_parser():
+    """Parse arguments for the remove_water_from_pdb script."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pdb_files",
+                        nargs="+",
+                        type=str,
+                        help="PDB files to clean.")
+    parser.add_argument("-r",
+                        "--residues",
+                        type=str,
+                        default=",".join(pal.WATER_RESIDUES),
+                        help="Comma separated residue names to remove.")
+    parser.add_argument("--hetatm",
+                        action="store_true",
+                        help="Remove all HETATM atoms.")
+    parser.add_argument("--merge_chains",
+                        action="store_true",
+                        help=("Move all atoms to the first chain, keeping their "
+                              "chain as insertion code where it leaves residues "
+                              "unique."))
+    parser.add_argument("-o",
+                        "--output_folder",
+                        type=str,
+                        help="Folder of the cleaned files, next to each PDB file by default.")
+    parser.add_argument("-v",
+                        "--verbose",
+                        action="store_true")
+    args = parser.parse_args()
+    return args
 
 
 def main():
-    """Remove HOH atoms from pdn file and return results."""
-    pdb_file = sys.argv[1]
-    if pdb_file.endswith('.pdb'):
-        output = pdb_file[:-4]
+    """Remove HOH atoms from pdb files and write the results."""
+    args = argument_parser()
+    if args.verbose:
+        log_level = logging.DEBUG
     else:
-        output = pdb_file
-    os.system(f"grep -v HOH {pdb_file} > {output}_clean.pdb")
+        log_level = logging.WARNING
+    logging.basicConfig(level=log_level)
+    residues = [i for i in args.residues.split(',') if i]
+    if args.output_folder:
+        os.makedirs(args.output_folder, exist_ok=True)
+    failures = 0
+    for pdb_file in args.pdb_files:
+        if pdb_file.endswith('.pdb'):
+            output = pdb_file[:-4]
+        else:
+            output = pdb_file
+        if args.output_folder:
+            output = os.path.join(args.output_folder, os.path.basename(output))
+        try:
+            pal.clean_pdb_file(pdb_file,
+                               f"{output}_clean.pdb",
+                               residues=residues,
+                               hetatm=args.hetatm,
+                               merge_chains=args.merge_chains)
+        except (OSError, ValueError) as err:
+            # Clean the other files instead of stopping at the first failure
+            logging.error(f"Issue cleaning {pdb_file}: {err}")
+            failures += 1
+            continue
+        logging.info(f"{pdb_file} -> {output}_clean.pdb")
+    if failures:
+        logging.error(f"{failures} of {len(args.pdb_files)} file(s) could not be cleaned.")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -2,11 +2,14 @@
 
 This script parses the pdb file result of a mutation analysis from
 iCn3D for a single amino acid mutation and returns a csv output to
-stdout of the distance of all hetatms.
+stdout of the distance of all hetatms within a threshold distance of the
+mutant residue.
 """
 
 import argparse
 
+import numpy as np
+
 import pdb_analysis_lib as pal
 
 
@@ -18,12 +21,12 @@ def argument_parser():
                                     "--input_file",
                                     required=True,
                                     type=str,
-                                    help="Input PDB file")
+                                    help="Input PDB file, gzip file or - for stdin")
     parser.add_argument("-t",
                         "--threshold_distance",
                         default=8,
                         type=float,
-                        help=("Distance from the mutant residue in angstroms"
+                        help=("Distance from the mutant residue in angstroms "
                               "to search for hetatms"))
     args = parser.parse_args()
     return args
@@ -33,25 +36,33 @@ def main():
     """Print to stdout distance to mutation and atom information of hetatms."""
     # Parse arguments
     args = argument_parser()
-    # Read input PDB file as a list of lines
-    file_object = open(args.input_file)
-    file_data = file_object.readlines()
-    file_object.close()
+    # Stream the lines of the input PDB file
+    pdb_lines = pal.iter_pdb_lines(args.input_file)
     # Read title line and parse mutation chain and residue
-    title_line = file_data[1]
-    mut_chain, mut_residue = title_line.split()[3][:-1].split('_')
-    # Return nested list of rows starting with ATOM and HETATM
-    atm_results = pal.read_pdb_atms_hetatms(file_data)
+    title_line = next((line for line in pdb_lines if line.startswith("TITLE")), "")
+    try:
+        mut_chain, mut_residue = pal.parse_mutation_title(title_line)
+    except (IndexError, ValueError):
+        raise ValueError(f"{args.input_file} has no TITLE with the mutated "
+                         "chain_residue") from None
+    # Parse the remaining rows starting with ATOM and HETATM into a structure
+    structure = pal.Structure.from_lines(pdb_lines)
     # Parse the atom coordinates of the mutation
-    mutant_residues = list(filter(lambda x: x[5] == mut_chain and x[6] == mut_residue,
-                                  atm_results))
-    mutant_coordiantes = list(map(lambda x: x[8:11], mutant_residues))
-    # Return nested list of hetatms
-    hetatm_residues = list(filter(lambda x: x[0] == "HETATM", atm_results))
+    mutant_coordinates = structure.select(chains=[mut_chain],
+                                          residues=[mut_residue]).xyz
+    # Index the hetatms and search them only within the threshold distance
+    hetatms = structure.select(mol_types=["HETATM"])
+    _, hetatm_idx, dists = hetatms.spatial_index().query_radius(
+        mutant_coordinates,
+        args.threshold_distance)
+    # Keep the minimum distance to the mutation of each hetatm found
+    min_dists = np.full(len(hetatms), np.inf)
+    np.minimum.at(min_dists, hetatm_idx, dists)
+    near_idx = np.flatnonzero(np.isfinite(min_dists))
     # Create a new nested list with the minimum hetatm to mutation distance
     result = []
-    for hetatm in hetatm_residues:
-        min_dist = pal.min_distance(hetatm[8:11], mutant_coordiantes)
+    for hetatm, min_dist in zip(hetatms.subset(near_idx).to_rows(),
+                                min_dists[near_idx]):
         result.append(["{0:.1f}".format(min_dist)] + hetatm)
     # Output a header row and each list in csv format to stdout
     print(",".join(["Minimum Distance From Mutation"] + pal.PDB_COLUMN_NAMES))
@@ -0,0 +1,327 @@
+"""Residue contacts.
+
+Sparse residue-residue contact maps of PDB structures, and the differences
+in contacts around a mutation between a WT structure and mutant models,
+such as the SCAP, EMBER3D or AlphaFold models of WT_Mutant_Examples.
+
+Run as a script, it takes a WT PDB file and any number of mutant PDB files
+of the same numbering and writes a CSV table of the contacts gained, lost
+and changed in each mutant.
+
+Global variables:
+CONTACT_CUTOFF: Default atom distance in angstroms for a residue contact
+MUTATION_RADIUS: Default distance from the mutation of residues compared
+CHANGE_TOLERANCE: Default change in contact distance reported as changed
+DIFF_COLUMNS: Column names of the rows returned by diff_contacts
+
+Classes:
+ContactMap: Sparse map of the residue pairs in contact in a structure.
+
+Functions:
+contact_map: Return the contact map of a structure.
+residues_near: Return the residues within a distance of coordinates.
+diff_contacts: Return gained, lost and changed contacts of many models.
+mutation_contact_diffs: Return contact differences around a mutation.
+format_distance: Return a distance as written in the CSV table.
+"""
+
+import argparse
+import csv
+import logging
+import sys
+
+import numpy as np
+
+import pdb_analysis_lib as pal
+
+
+CONTACT_CUTOFF = 4.5
+MUTATION_RADIUS = 10.0
+CHANGE_TOLERANCE = 0.5
+DIFF_COLUMNS = ["Model",
+                "Residue A",
+                "Residue B",
+                "Status",
+                "WT Distance",
+                "Mutant Distance"]
+
+
+class ContactMap:
+    """Sparse map of the residue pairs in contact in a structure.
+
+    Residues are (chain, resseq, icode) keys. Each contact is a pair of
+    positions in residues, the lower first, with the minimum distance
+    between the atoms of the two residues.
+    """
+
+    def __init__(self, residues: list, pairs: np.ndarray, distances: np.ndarray):
+        self.residues = residues
+        self.pairs = pairs
+        self.distances = distances
+
+    def __len__(self):
+        return len(self.distances)
+
+    def to_rows(self) -> list:
+        """Return [residue_a, residue_b, distance] for each contact."""
+        return [[self.residues[a], self.residues[b], dist]
+                for (a, b), dist in zip(self.pairs.tolist(),
+                                        self.distances.tolist())]
+
+
+def contact_map(structure: pal.Structure,
+                cutoff: float = CONTACT_CUTOFF,
+                residues: list = None) -> ContactMap:
+    """Return the contact map of a structure.
+
+    Two residues are in contact when any of their atoms are within cutoff
+    of each other. All atom pairs are found with one radius query of the
+    spatial index of the structure, then reduced to the minimum distance
+    per residue pair.
+
+    :param structure: Structure to map the contacts of
+    :param cutoff: Maximum atom distance in angstroms of a contact
+    :param residues: (chain, resseq, icode) keys of residues whose contacts
+        are mapped, all residues when omitted. Contacts between two other
+        residues are left out.
+    :return: ContactMap of the structure
+    """
+    residue_index = structure.residue_index()
+    keys = residue_index.keys()
+    atom_residues = residue_index.atom_residues()
+    if residues is None:
+        query_atoms = np.arange(len(structure))
+    else:
+        wanted = np.zeros(len(keys), dtype=bool)
+        positions = {key: i for i, key in enumerate(keys)}
+        wanted[[positions[key] for key in residues if key in positions]] = True
+        query_atoms = np.flatnonzero(wanted[atom_residues])
+    point_idx, atom_idx, dists = structure.spatial_index().query_radius(
+        structure.xyz[query_atoms], cutoff)
+    res_a = atom_residues[query_atoms[point_idx]]
+    res_b = atom_residues[atom_idx]
+    keep = res_a != res_b
+    low = np.minimum(res_a, res_b)[keep]
+    high = np.maximum(res_a, res_b)[keep]
+    # Keep the minimum distance of each residue pair
+    codes = low.astype(np.int64) * len(keys) + high
+    order = np.lexsort((dists[keep], codes))
+    codes = codes[order]
+    first = np.ones(len(codes), dtype=bool)
+    first[1:] = codes[1:] != codes[:-1]
+    pairs = np.column_stack((low[order][first], high[order][first]))
+    return ContactMap(keys, pairs, dists[keep][order][first].astype(np.float32))
+
+
+def residues_near(structure: pal.Structure, coords, radius: float) -> list:
+    """Return the residues with any atom within radius of coordinates.
+
+    :param structure: Structure to search
+    :param coords: (n, 3) array of coordinates, e.g. of a mutated residue
+    :param radius: Search radius in angstroms
+    :return: (chain, resseq, icode) keys of the residues in file order
+    """
+    residue_index = structure.residue_index()
+    _, atom_idx, _ = structure.spatial_index().query_radius(coords, radius)
+    positions = np.unique(residue_index.atom_residues()[atom_idx])
+    keys = residue_index.keys()
+    return [keys[i] for i in positions.tolist()]
+
+
+def _pair_codes(contacts: ContactMap, vocabulary: dict) -> np.ndarray:
+    """Return the residue pairs of a map as ids of a shared vocabulary."""
+    for key in contacts.residues:
+        vocabulary.setdefault(key, len(vocabulary))
+    ids = np.array([vocabulary[key] for key in contacts.residues], dtype=np.int64)
+    a, b = ids[contacts.pairs[:, 0]], ids[contacts.pairs[:, 1]]
+    return np.minimum(a, b), np.maximum(a, b)
+
+
+def diff_contacts(wt_contacts: ContactMap,
+                  mutant_contacts: list,
+                  tolerance: float = CHANGE_TOLERANCE) -> list:
+    """Return the contacts gained, lost and changed in many mutant models.
+
+    Residues are matched between maps by their (chain, resseq, icode) keys.
+    The contacts of every model are compared to the WT at once, as sorted
+    integer codes of (model, residue pair).
+
+    :param wt_contacts: ContactMap of the WT structure
+    :param mutant_contacts: ContactMap of each mutant model
+    :param tolerance: Change in angstroms in the distance of a contact
+        present in both structures for it to be reported as changed
+    :return: Rows of [model, residue_a, residue_b, status, wt_distance,
+        mutant_distance], model being the position in mutant_contacts and
+        status one of gained, lost or changed, with nan for a distance of
+        a contact missing from a structure
+    """
+    vocabulary = {}
+    wt_a, wt_b = _pair_codes(wt_contacts, vocabulary)
+    mutant_pairs = [_pair_codes(i, vocabulary) for i in mutant_contacts]
+    n_residues = max(1, len(vocabulary))
+    n_pairs = np.int64(n_residues) ** 2
+    n_models = len(mutant_contacts)
+    wt_codes = wt_a * n_residues + wt_b
+    # Codes of every WT contact repeated for every model
+    wt_keys = (np.arange(n_models, dtype=np.int64)[:, None] * n_pairs +
+               wt_codes[None, :]).ravel()
+    wt_dists = np.tile(wt_contacts.distances.astype(float), n_models)
+    mutant_keys = np.concatenate(
+        [model * n_pairs + a * n_residues + b
+         for model, (a, b) in enumerate(mutant_pairs)] + [np.empty(0, np.int64)])
+    mutant_dists = np.concatenate([i.distances.astype(float) for i in mutant_contacts]
+                                  + [np.empty(0)])
+    lost = ~np.isin(wt_keys, mutant_keys)
+    gained = ~np.isin(mutant_keys, wt_keys)
+    _, wt_common, mutant_common = np.intersect1d(wt_keys, mutant_keys,
+                                                 assume_unique=True,
+                                                 return_indices=True)
+    changed = np.abs(wt_dists[wt_common] - mutant_dists[mutant_common]) > tolerance
+    keys = np.concatenate((wt_keys[lost],
+                           mutant_keys[gained],
+                           wt_keys[wt_common[changed]]))
+    status = (["lost"] * int(lost.sum()) + ["gained"] * int(gained.sum()) +
+              ["changed"] * int(changed.sum()))
+    wt_column = np.concatenate((wt_dists[lost],
+                                np.full(gained.sum(), np.nan),
+                                wt_dists[wt_common[changed]]))
+    mutant_column = np.concatenate((np.full(lost.sum(), np.nan),
+                                    mutant_dists[gained],
+                                    mutant_dists[mutant_common[changed]]))
+    order = np.argsort(keys, kind="stable")
+    residues = list(vocabulary)
+    wt_column, mutant_column = wt_column.tolist(), mutant_column.tolist()
+    result = []
+    for key, i in zip(keys[order].tolist(), order.tolist()):
+        model, code = divmod(key, int(n_pairs))
+        a, b = divmod(code, n_residues)
+        result.append([model, residues[a], residues[b], status[i],
+                       wt_column[i], mutant_column[i]])
+    return result
+
+
+def mutation_contact_diffs(wt_structure: pal.Structure,
+                           mutant_structures: list,
+                           chain: str,
+                           residue: str,
+                           radius: float = MUTATION_RADIUS,
+                           cutoff: float = CONTACT_CUTOFF,
+                           tolerance: float = CHANGE_TOLERANCE) -> list:
+    """Return the contact differences around a mutation in mutant models.
+
+    The compared residues are those within radius of the mutated residue
+    in the WT or in any model, so that a contact of a residue near the
+    mutation in one structure is compared against the same residue in all
+    structures.
+
+    :param wt_structure: Structure of the WT
+    :param mutant_structures: Structures of the mutant models, numbered as
+        the WT, e.g. after correct_ember_file
+    :param chain: Chain of the mutated residue
+    :param residue: Residue sequence number of the mutation
+    :param radius: Distance in angstroms from the mutation of residues compared
+    :param cutoff: Maximum atom distance in angstroms of a contact
+    :param tolerance: Change in contact distance reported as changed
+    :return: Rows as diff_contacts
+    """
+    structures = [wt_structure] + list(mutant_structures)
+    near = {}
+    for structure in structures:
+        mutation = structure.residue(chain, residue).xyz
+        for key in residues_near(structure, mutation, radius):
+            near[key] = None
+    maps = [contact_map(structure, cutoff, list(near)) for structure in structures]
+    return diff_contacts(maps[0], maps[1:], tolerance)
+
+
+def format_distance(value: float) -> str:
+    """Return a distance to one decimal, or an empty string for nan."""
+    return "" if np.isnan(value) else "{0:.1f}".format(value)
+
+
+def argument_parser():
+    """Parse arguments for the residue_contacts script."""
+    parser = argparse.ArgumentParser()
+    required_arguments = parser.add_argument_group("Required Arguments")
+    required_arguments.add_argument("wt_file",
+                                    type=str,
+                                    help="WT PDB file")
+    required_arguments.add_argument("mutant_files",
+                                    nargs="+",
+                                    type=str,
+                                    help="Mutant PDB files, numbered as the WT")
+    required_arguments.add_argument("-c",
+                                    "--chain",
+                                    required=True,
+                                    type=str,
+                                    help="Chain of the mutated residue.")
+    required_arguments.add_argument("-r",
+                                    "--residue",
+                                    required=True,
+                                    type=str,
+                                    help="Residue number of the mutation.")
+    parser.add_argument("--radius",
+                        type=float,
+                        default=MUTATION_RADIUS,
+                        help="Distance from the mutation of residues compared.")
+    parser.add_argument("--cutoff",
+                        type=float,
+                        default=CONTACT_CUTOFF,
+                        help="Maximum atom distance of a contact.")
+    parser.add_argument("--tolerance",
+                        type=float,
+                        default=CHANGE_TOLERANCE,
+                        help="Change in contact distance reported as changed.")
+    parser.add_argument("--hetatm",
+                        action="store_true",
+                        help="Include HETATM residues in the contacts.")
+    parser.add_argument("-o",
+                        "--output_file",
+                        type=str,
+                        help="Output CSV file, stdout when omitted.")
+    parser.add_argument("-v",
+                        "--verbose",
+                        action="store_true")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    """Write the contacts gained, lost and changed in each mutant file."""
+    args = argument_parser()
+    if args.verbose:
+        log_level = logging.DEBUG
+    else:
+        log_level = logging.WARNING
+    logging.basicConfig(level=log_level)
+    mol_types = ["ATOM", "HETATM"] if args.hetatm else ["ATOM"]
+    wt_structure = pal.load_structure(args.wt_file, mol_types)
+    mutant_structures = [pal.load_structure(i, mol_types)
+                         for i in args.mutant_files]
+    result = mutation_contact_diffs(wt_structure,
+                                    mutant_structures,
+                                    args.chain,
+                                    args.residue,
+                                    args.radius,
+                                    args.cutoff,
+                                    args.tolerance)
+    logging.info(f"{len(result)} contact difference(s) in "
+                 f"{len(mutant_structures)} model(s)")
+    output = open(args.output_file, 'w', newline='') if args.output_file else sys.stdout
+    try:
+        writer = csv.writer(output)
+        writer.writerow(DIFF_COLUMNS)
+        for model, residue_a, residue_b, status, wt_dist, mutant_dist in result:
+            writer.writerow([args.mutant_files[model],
+                             "{0}:{1}{2}".format(*residue_a),
+                             "{0}:{1}{2}".format(*residue_b),
+                             status,
+                             format_distance(wt_dist),
+                             format_distance(mutant_dist)])
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
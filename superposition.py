@@ -0,0 +1,251 @@
+"""Superposition.
+
+Kabsch superposition of mutant models onto a WT structure, with the global
+and per-residue RMSD of each model, such as for benchmarking the SCAP,
+EMBER3D, AlphaFold and GROMACS models of a mutation against the WT.
+
+Atoms are paired by residue and atom name, residues of each model being
+aligned to the WT with residue_alignment. All models of one protein are
+superposed together as (models, atoms, 3) arrays, so a WT is compared
+against hundreds of models in one call.
+
+Run as a script, it takes a WT PDB file and any number of model PDB files
+and writes a CSV table with the global RMSD and per-residue RMSD of each
+model.
+
+Global variables:
+FIT_ATOMS: Default atom names superposed on
+BACKBONE_ATOMS: Atom names of the protein backbone
+
+Functions:
+paired_coordinates: Return the coordinates of the atoms paired to a WT.
+kabsch: Return the rotations and translations superposing coordinates.
+superpose_models: Return the global and per-residue RMSD of models.
+format_rmsd: Return an RMSD as written in the CSV table.
+"""
+
+import argparse
+import csv
+import logging
+import sys
+
+import numpy as np
+
+import pdb_analysis_lib as pal
+
+
+FIT_ATOMS = ("CA",)
+BACKBONE_ATOMS = ("N", "CA", "C", "O")
+
+
+def paired_coordinates(wt_structure: pal.Structure,
+                       model_structures: list,
+                       chain: str,
+                       atom_names: list = None) -> tuple:
+    """Return the coordinates of the atoms of models paired to a WT.
+
+    The residues of each model chain are aligned to the WT chain with
+    residue_alignment, then atoms are paired by WT residue and atom name
+    with one sorted search per model. The first of alternate locations is
+    used.
+
+    :param wt_structure: Structure of the WT
+    :param model_structures: Structures of the models
+    :param chain: Chain compared
+    :param atom_names: Atom names paired, all when omitted
+    :return: Tuple of (residue, atom_name, wt_xyz, model_xyz, paired), the
+        position in the WT chain_sequence and atom name of the n WT atoms,
+        their (n, 3) coordinates, the (models, n, 3) coordinates of the
+        paired model atoms and a (models, n) boolean array of the atoms
+        found in each model
+    """
+    wt = wt_structure.select(["ATOM"], [chain])
+    names = wt.column("atom_name")
+    keep = np.ones(len(wt), dtype=bool) if atom_names is None \
+        else np.isin(names, list(atom_names))
+    vocabulary = {name: i for i, name in enumerate(np.unique(names[keep]).tolist())}
+    n_names = max(1, len(vocabulary))
+    name_ids = np.array([vocabulary.get(name, -1) for name in names.tolist()],
+                        dtype=np.int64)
+    wt_residues = wt.residue_index().atom_residues()
+    keys = wt_residues.astype(np.int64) * n_names + name_ids
+    keys, first = np.unique(keys[keep], return_index=True)
+    wt_idx = np.flatnonzero(keep)[first]
+    wt_xyz = wt.xyz[wt_idx].astype(np.float64)
+    model_xyz = np.zeros((len(model_structures), len(wt_idx), 3))
+    paired = np.zeros((len(model_structures), len(wt_idx)), dtype=bool)
+    for i, model_structure in enumerate(model_structures):
+        model = model_structure.select(["ATOM"], [chain])
+        _, model_keys, wt_pos, model_pos = pal.residue_alignment(wt_structure,
+                                                                 model,
+                                                                 chain)
+        # Give each model residue the position of its aligned WT residue
+        to_wt = np.full(len(model_keys), -1, dtype=np.int64)
+        to_wt[model_pos] = wt_pos
+        model_residues = to_wt[model.residue_index().atom_residues()]
+        model_names = np.array([vocabulary.get(name, -1) for name in
+                                model.column("atom_name").tolist()], dtype=np.int64)
+        valid = (model_residues >= 0) & (model_names >= 0)
+        model_keys = model_residues * n_names + model_names
+        model_keys, model_first = np.unique(model_keys[valid], return_index=True)
+        model_idx = np.flatnonzero(valid)[model_first]
+        pos = np.searchsorted(model_keys, keys)
+        pos = np.minimum(pos, max(0, len(model_keys) - 1))
+        found = (model_keys[pos] == keys) if len(model_keys) else \
+            np.zeros(len(keys), dtype=bool)
+        paired[i] = found
+        model_xyz[i, found] = model.xyz[model_idx[pos[found]]]
+    return (wt_residues[wt_idx], names[wt_idx], wt_xyz, model_xyz, paired)
+
+
+def kabsch(reference: np.ndarray, coords: np.ndarray, weights: np.ndarray) -> tuple:
+    """Return the rotations and translations superposing coordinates.
+
+    Each of the models is superposed onto the reference with a weighted
+    Kabsch fit, all models at once through batched 3x3 SVDs.
+
+    :param reference: (n, 3) array of reference coordinates
+    :param coords: (models, n, 3) array of model coordinates
+    :param weights: (models, n) array of atom weights, 0 to leave an atom
+        out of the fit of a model
+    :return: Tuple of (models, 3, 3) rotations and (models, 3)
+        translations, such that coords @ rotation.T + translation is the
+        superposed model
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    total = weights.sum(axis=1)[:, None]
+    total[total == 0] = 1
+    ref_centroid = weights @ reference / total
+    centroid = np.einsum("mn,mni->mi", weights, coords) / total
+    p = reference[None, :, :] - ref_centroid[:, None, :]
+    q = coords - centroid[:, None, :]
+    covariance = np.einsum("mn,mni,mnj->mij", weights, q, p)
+    u, _, vt = np.linalg.svd(covariance)
+    # Flip the smallest axis where the best fit would be a reflection
+    sign = np.sign(np.linalg.det(np.matmul(u, vt)))
+    sign[sign == 0] = 1
+    u[:, :, 2] *= sign[:, None]
+    rotation = np.matmul(u, vt).transpose(0, 2, 1)
+    translation = ref_centroid - np.einsum("mij,mj->mi", rotation, centroid)
+    return rotation, translation
+
+
+def superpose_models(wt_structure: pal.Structure,
+                     model_structures: list,
+                     chain: str,
+                     fit_atoms: list = FIT_ATOMS,
+                     atom_names: list = None) -> tuple:
+    """Return the global and per-residue RMSD of models to a WT.
+
+    Models are superposed on the paired fit_atoms, then the RMSD is
+    measured over the paired atom_names, all common atoms by default.
+
+    :param wt_structure: Structure of the WT
+    :param model_structures: Structures of the models
+    :param chain: Chain compared
+    :param fit_atoms: Atom names superposed on, all paired atoms when None
+    :param atom_names: Atom names measured, all paired atoms when None
+    :return: Tuple of a (models,) array of global RMSD, the (resseq,
+        icode) of the WT residues and a (models, residues) array of
+        per-residue RMSD, nan for residues without paired atoms in a model
+    """
+    names = None if atom_names is None or fit_atoms is None \
+        else sorted(set(atom_names) | set(fit_atoms))
+    residue, atom, wt_xyz, model_xyz, paired = paired_coordinates(
+        wt_structure, model_structures, chain, names)
+    fit = paired if fit_atoms is None else paired & np.isin(atom, list(fit_atoms))
+    rotation, translation = kabsch(wt_xyz, model_xyz, fit)
+    moved = np.matmul(model_xyz, rotation.transpose(0, 2, 1)) + translation[:, None, :]
+    measured = paired if atom_names is None else \
+        paired & np.isin(atom, list(atom_names))
+    weights = measured.astype(np.float64)
+    squared = ((moved - wt_xyz[None, :, :]) ** 2).sum(axis=2) * weights
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rmsd = np.sqrt(squared.sum(axis=1) / weights.sum(axis=1))
+        # Paired atoms are sorted by residue, so each residue is one run
+        positions, starts = np.unique(residue, return_index=True)
+        wt_keys, _ = wt_structure.chain_sequence(chain)
+        residues = [wt_keys[i] for i in positions.tolist()]
+        if len(residues):
+            residue_rmsd = np.sqrt(np.add.reduceat(squared, starts, axis=1) /
+                                   np.add.reduceat(weights, starts, axis=1))
+        else:
+            residue_rmsd = np.empty((len(model_structures), 0))
+    return rmsd, residues, residue_rmsd
+
+
+def format_rmsd(value: float) -> str:
+    """Return an RMSD to two decimals, or an empty string for nan."""
+    return "" if np.isnan(value) else "{0:.2f}".format(value)
+
+
+def argument_parser():
+    """Parse arguments for the superposition script."""
+    parser = argparse.ArgumentParser()
+    required_arguments = parser.add_argument_group("Required Arguments")
+    required_arguments.add_argument("wt_file",
+                                    type=str,
+                                    help="WT PDB file")
+    required_arguments.add_argument("model_files",
+                                    nargs="+",
+                                    type=str,
+                                    help="Model PDB files of the same protein")
+    required_arguments.add_argument("-c",
+                                    "--chain",
+                                    required=True,
+                                    type=str,
+                                    help="Chain compared.")
+    parser.add_argument("--fit_atoms",
+                        type=str,
+                        default=",".join(FIT_ATOMS),
+                        help="Comma separated atom names superposed on, or all.")
+    parser.add_argument("--backbone",
+                        action="store_true",
+                        help="Measure RMSD over backbone atoms only.")
+    parser.add_argument("-o",
+                        "--output_file",
+                        type=str,
+                        help="Output CSV file, stdout when omitted.")
+    parser.add_argument("-v",
+                        "--verbose",
+                        action="store_true")
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    """Write the global and per-residue RMSD of each model file."""
+    args = argument_parser()
+    if args.verbose:
+        log_level = logging.DEBUG
+    else:
+        log_level = logging.WARNING
+    logging.basicConfig(level=log_level)
+    fit_atoms = None if args.fit_atoms == "all" else args.fit_atoms.split(',')
+    atom_names = BACKBONE_ATOMS if args.backbone else None
+    wt_structure = pal.load_structure(args.wt_file, ["ATOM"], [args.chain])
+    model_structures = [pal.load_structure(i, ["ATOM"], [args.chain])
+                        for i in args.model_files]
+    rmsd, residues, residue_rmsd = superpose_models(wt_structure,
+                                                    model_structures,
+                                                    args.chain,
+                                                    fit_atoms,
+                                                    atom_names)
+    logging.info(f"{len(model_structures)} model(s) over {len(residues)} residue(s)")
+    output = open(args.output_file, 'w', newline='') if args.output_file else sys.stdout
+    try:
+        writer = csv.writer(output)
+        writer.writerow(["Model", "RMSD"] + [f"{resseq}{icode}"
+                                             for resseq, icode in residues])
+        for model_file, model_rmsd, row in zip(args.model_files,
+                                               rmsd.tolist(),
+                                               residue_rmsd.tolist()):
+            writer.writerow([model_file, format_rmsd(model_rmsd)] +
+                            [format_rmsd(i) for i in row])
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
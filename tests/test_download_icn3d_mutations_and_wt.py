@@ -0,0 +1,339 @@
+"""Tests of the fetchers and scheduler of download_icn3d_mutations_and_wt."""
+
+import gzip
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import threading
+import time
+
+import pytest
+
+import download_icn3d_mutations_and_wt as download
+
+
+TIMEOUT = 10
+PDB_TEXT = b"ATOM      1  CA  ALA A   1       0.000   0.000   0.000  1.00  0.00           C\n"
+
+
+class FakeDriver:
+    """Driver writing the url as a file, raising on the urls in fail."""
+
+    def __init__(self, fail=()):
+        self.fail = fail
+        self.quit_called = False
+
+    def get(self, url):
+        if url in self.fail:
+            raise RuntimeError(f"browser crashed on {url}")
+        with open(url, 'w') as f:
+            f.write("ATOM\n")
+
+    def quit(self):
+        self.quit_called = True
+
+
+def run_with_timeout(function):
+    """Run function in a thread, failing the test if it hangs."""
+    result = {}
+
+    def target():
+        result["value"] = function()
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(TIMEOUT)
+    assert not thread.is_alive(), "timed out waiting for a driver"
+    return result.get("value")
+
+
+def test_discarded_driver_is_replaced_for_waiting_thread():
+    drivers = []
+
+    def factory():
+        drivers.append(FakeDriver())
+        return drivers[-1]
+    pool = download.DriverPool(factory, size=1)
+    taken = threading.Event()
+    release = threading.Event()
+    errors = []
+
+    def crash():
+        try:
+            with pool.driver():
+                taken.set()
+                release.wait(TIMEOUT)
+                raise RuntimeError("browser crashed")
+        except RuntimeError as err:
+            errors.append(err)
+
+    crashing = threading.Thread(target=crash, daemon=True)
+    crashing.start()
+    assert taken.wait(TIMEOUT)
+
+    def wait_for_driver():
+        with pool.driver() as driver:
+            return driver
+    received = []
+    waiter = threading.Thread(target=lambda: received.append(wait_for_driver()),
+                              daemon=True)
+    waiter.start()
+    release.set()
+    crashing.join(TIMEOUT)
+    waiter.join(TIMEOUT)
+    assert not waiter.is_alive(), "waiting thread never got a driver"
+    assert len(drivers) == 2
+    assert drivers[0].quit_called
+    assert len(errors) == 1
+    assert received == [drivers[1]]
+
+
+def test_failed_driver_factory_frees_its_slot():
+    calls = []
+
+    def factory():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("no browser")
+        return FakeDriver()
+    pool = download.DriverPool(factory, size=1)
+    with pytest.raises(RuntimeError):
+        with pool.driver():
+            pass
+
+    def take():
+        with pool.driver() as driver:
+            return driver
+    assert isinstance(run_with_timeout(take), FakeDriver)
+
+
+def test_scheduler_with_more_threads_than_drivers(tmp_path):
+    paths = [str(tmp_path / f"{i}.pdb") for i in range(6)]
+    # The first driver crashes on two files, each retried on a new driver
+    factories = iter([FakeDriver(fail=paths[:2])])
+
+    def factory():
+        return next(factories, None) or FakeDriver()
+    selenium = download.SeleniumFetcher(factory,
+                                        max_drivers=1,
+                                        crawl_delay=0,
+                                        max_sleep=1,
+                                        poll_interval=0.01)
+    http = download.HTTPFetcher(crawl_delay=0, max_connections=3)
+    jobs = [(path, path, "selenium") for path in paths]
+    with download.DownloadScheduler({"selenium": selenium, "http": http},
+                                    max_attempts=3) as scheduler:
+        failures = run_with_timeout(lambda: scheduler.download(jobs))
+    assert failures == []
+    assert all(os.path.isfile(path) for path in paths)
+
+
+def test_page_loads_are_spaced_after_waiting_for_a_driver(tmp_path):
+    crawl_delay = 0.1
+    paths = [str(tmp_path / f"{i}.pdb") for i in range(6)]
+    load_times = []
+    lock = threading.Lock()
+    # The first page loads hang until every thread is waiting for a driver
+    gate = threading.Event()
+
+    class SlowDriver(FakeDriver):
+        def get(self, url):
+            with lock:
+                load_times.append(time.monotonic())
+                blocked = len(load_times) <= 2
+            if blocked:
+                gate.wait(TIMEOUT)
+            super().get(url)
+    selenium = download.SeleniumFetcher(SlowDriver,
+                                        max_drivers=2,
+                                        crawl_delay=crawl_delay,
+                                        max_sleep=1,
+                                        poll_interval=0.01)
+    http = download.HTTPFetcher(crawl_delay=0, max_connections=4)
+    jobs = [(path, path, "selenium") for path in paths]
+    with download.DownloadScheduler({"selenium": selenium, "http": http}) as scheduler:
+        threading.Timer(len(paths) * crawl_delay + 0.2, gate.set).start()
+        failures = run_with_timeout(lambda: scheduler.download(jobs))
+    assert failures == []
+    assert len(load_times) == len(paths)
+    gaps = [b - a for a, b in zip(load_times, load_times[1:])]
+    assert min(gaps) >= crawl_delay * 0.9
+
+
+class PDBHandler(BaseHTTPRequestHandler):
+    """Serves PDB files over keep-alive connections, counting connections.
+
+    /gzip.pdb.gz is a gzip file, /encoded.pdb is gzip encoded in transit,
+    /flaky.pdb fails with 503 twice before it is served, and every other
+    path is not found.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests[self.path] = self.server.requests.get(self.path, 0) + 1
+            count = self.server.requests[self.path]
+        headers = {}
+        if self.path == "/gzip.pdb.gz":
+            status, body = 200, gzip.compress(PDB_TEXT)
+            headers["Content-Type"] = "application/gzip"
+        elif self.path == "/encoded.pdb":
+            status, body = 200, gzip.compress(PDB_TEXT)
+            headers["Content-Encoding"] = "gzip"
+        elif self.path == "/flaky.pdb":
+            status, body = (503, b"") if count <= 2 else (200, PDB_TEXT)
+        else:
+            status, body = 404, b"not found"
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def pdb_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PDBHandler)
+    server.lock = threading.Lock()
+    server.connections = 0
+    server.requests = {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def http_fetcher():
+    fetcher = download.HTTPFetcher(crawl_delay=0)
+    yield fetcher
+    fetcher.close()
+
+
+def test_http_fetcher_decodes_gzip(pdb_server, http_fetcher, tmp_path):
+    for path in ("/gzip.pdb.gz", "/encoded.pdb"):
+        expected_file_path = tmp_path / "1ABC_rcsb.pdb"
+        assert http_fetcher.fetch(pdb_server.url + path, str(expected_file_path))
+        assert expected_file_path.read_bytes() == PDB_TEXT
+        expected_file_path.unlink()
+
+
+def test_http_fetcher_retries_server_errors(pdb_server, http_fetcher, tmp_path):
+    expected_file_path = tmp_path / "1ABC_rcsb.pdb"
+    assert http_fetcher.fetch(pdb_server.url + "/flaky.pdb", str(expected_file_path))
+    assert expected_file_path.read_bytes() == PDB_TEXT
+    assert pdb_server.requests["/flaky.pdb"] == 3
+
+
+def test_http_fetcher_leaves_no_file_when_not_found(pdb_server, http_fetcher, tmp_path):
+    expected_file_path = tmp_path / "1ABC_rcsb.pdb"
+    with pytest.raises(download.requests.HTTPError):
+        http_fetcher.fetch(pdb_server.url + "/missing.pdb", str(expected_file_path))
+    assert os.listdir(tmp_path) == []
+
+
+def test_http_fetcher_reuses_its_connection(pdb_server, http_fetcher, tmp_path):
+    for i in range(3):
+        http_fetcher.fetch(pdb_server.url + "/gzip.pdb.gz", str(tmp_path / f"{i}.pdb"))
+    assert pdb_server.requests["/gzip.pdb.gz"] == 3
+    assert pdb_server.connections == 1
+
+
+class PartFileDriver(FakeDriver):
+    """Driver writing the url as Firefox does, through a .part file.
+
+    The empty file and its .part appear at once, the .part grows in chunks,
+    and is then renamed over the file.
+    """
+
+    def __init__(self, chunks=3, delay=0.05):
+        super().__init__()
+        self.chunks = chunks
+        self.delay = delay
+        self.threads = []
+
+    def get(self, url):
+        open(url, 'w').close()
+        with open(f"{url}.part", 'w'):
+            pass
+        thread = threading.Thread(target=self._write, args=(url,), daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def _write(self, url):
+        for _ in range(self.chunks):
+            time.sleep(self.delay)
+            with open(f"{url}.part", 'a') as f:
+                f.write("ATOM\n")
+        os.replace(f"{url}.part", url)
+
+
+def test_wait_for_download_waits_for_part_file_rename(tmp_path):
+    expected_file_path = str(tmp_path / "1ABC_icn3d.pdb")
+    driver = PartFileDriver()
+    driver.get(expected_file_path)
+    assert download.wait_for_download(expected_file_path,
+                                      timeout=TIMEOUT,
+                                      poll_interval=0.01)
+    assert not os.path.exists(f"{expected_file_path}.part")
+    with open(expected_file_path) as f:
+        assert f.read() == "ATOM\n" * driver.chunks
+
+
+def test_wait_for_download_waits_for_file_still_being_written(tmp_path):
+    expected_file_path = tmp_path / "1ABC_icn3d.pdb"
+    expected_file_path.write_text("ATOM\n")
+
+    def write():
+        for _ in range(10):
+            time.sleep(0.01)
+            with open(expected_file_path, 'a') as f:
+                f.write("ATOM\n")
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+    # Each poll sees a new size until the writes, faster than the polls, stop
+    assert download.wait_for_download(str(expected_file_path),
+                                      timeout=TIMEOUT,
+                                      poll_interval=0.05)
+    assert not writer.is_alive()
+    assert expected_file_path.read_text() == "ATOM\n" * 11
+
+
+def test_wait_for_download_times_out(tmp_path):
+    expected_file_path = tmp_path / "1ABC_icn3d.pdb"
+    expected_file_path.write_text("ATOM\n")
+    # A .part that is never renamed leaves the download unfinished
+    (tmp_path / "1ABC_icn3d.pdb.part").write_text("ATOM\n")
+    start = time.monotonic()
+    assert not download.wait_for_download(str(expected_file_path),
+                                          timeout=0.2,
+                                          poll_interval=0.01)
+    assert 0.2 <= time.monotonic() - start < TIMEOUT
+    assert not download.wait_for_download(str(tmp_path / "missing.pdb"),
+                                          timeout=0.1,
+                                          poll_interval=0.01)
+
+
+def test_selenium_fetcher_waits_for_part_file(tmp_path):
+    driver = PartFileDriver()
+    fetcher = download.SeleniumFetcher(lambda: driver,
+                                       max_drivers=1,
+                                       crawl_delay=0,
+                                       max_sleep=TIMEOUT,
+                                       poll_interval=0.01)
+    expected_file_path = str(tmp_path / "1ABC_A_1_G.pdb")
+    assert fetcher.fetch(expected_file_path, expected_file_path)
+    fetcher.close()
+    assert driver.quit_called
+    assert os.listdir(tmp_path) == ["1ABC_A_1_G.pdb"]
+    with open(expected_file_path) as f:
+        assert f.read() == "ATOM\n" * driver.chunks
@@ -0,0 +1,177 @@
+"""Tests of the PDB parsers and cleaning of pdb_analysis_lib."""
+
+import numpy as np
+
+import pdb_analysis_lib as pal
+
+
+def atom(serial, chain, resseq, icode=" ", name="CA", resname="ALA", record="ATOM",
+         xyz=(0.0, 0.0, 0.0)):
+    """Return a PDB atom line of the given chain and residue."""
+    x, y, z = xyz
+    return (f"{record:<6}{serial:>5} {name:<4} {resname:>3}{chain:>2}{resseq:>4}{icode}"
+            f"   {x:8.3f}{y:8.3f}{z:8.3f}{1.0:6.2f}{0.0:6.2f}          C  \n")
+
+
+def chain_structure(sequence, residues, chain="A", xyz=None):
+    """Return a Structure of one CA atom per residue of a sequence.
+
+    :param sequence: One letter codes of the residues
+    :param residues: (resseq, icode) of each residue
+    :param xyz: (n, 3) coordinates of the atoms, all zero when omitted
+    """
+    three_letters = {letter: name for name, letter in pal.AA_DICT.items()}
+    if xyz is None:
+        xyz = np.zeros((len(sequence), 3))
+    return pal.Structure.from_lines([
+        atom(i + 1, chain, resseq, icode or " ",
+             resname=three_letters[letter], xyz=tuple(xyz[i]))
+        for i, (letter, (resseq, icode)) in enumerate(zip(sequence, residues))])
+
+
+def residue_ids(lines):
+    """Return the chain, number and insertion code of each atom line."""
+    return [line[20:27] for line in lines if line.startswith(("ATOM", "HETATM"))]
+
+
+def test_merge_chains_uses_chain_as_insertion_code():
+    lines = [atom(1, "A", 5), atom(2, "B", 5), atom(3, "B", 6)]
+    merged = list(pal.clean_pdb_lines(lines, merge_chains=True))
+    assert residue_ids(merged) == [" A   5 ", " A   5B", " A   6B"]
+    assert [line[:20] + line[27:] for line in merged] == [line[:20] + line[27:] for line in lines]
+
+
+def test_merge_chains_keeps_residues_with_insertion_codes_apart():
+    lines = [
+        atom(1, "A", 52),
+        atom(2, "A", 52, "B"),
+        atom(3, "B", 52),
+        atom(4, "B", 52, "A"),
+        atom(5, "B", 52, "A", name="CB"),
+        atom(6, "B", 53),
+    ]
+    merged = residue_ids(pal.clean_pdb_lines(lines, merge_chains=True))
+    assert merged[:2] == [" A  52 ", " A  52B"]
+    # 52 of chain B would become the 52B of chain A
+    assert merged[2] == " A  53 "
+    assert merged[3] == merged[4] == " A  52A"
+    assert merged[5] == " A  53B"
+    assert len(set(merged)) == 5
+
+
+def test_merge_chains_keeps_two_character_chains_apart():
+    lines = [
+        atom(1, "A", 1),
+        atom(2, "Mi", 1),
+        atom(3, "BM", 1),
+        atom(4, "Ci", 1),
+        atom(5, "Ci", 2),
+    ]
+    merged = residue_ids(pal.clean_pdb_lines(lines, merge_chains=True))
+    assert merged == [" A   1 ", " A   1i", " A   1M", " A   2 ", " A   2i"]
+
+
+def test_clean_pdb_lines_drops_water_and_hetatm():
+    lines = [
+        "REMARK 350 HOH\n",
+        atom(1, "A", 1),
+        atom(2, "A", 2, name="O", resname="HOH", record="HETATM"),
+        atom(3, "A", 3, name="ZN", resname="ZN", record="HETATM"),
+    ]
+    assert list(pal.clean_pdb_lines(lines)) == [lines[0], lines[1], lines[3]]
+    assert list(pal.clean_pdb_lines(lines, hetatm=True)) == lines[:2]
+
+
+# CRLF line endings, negative residue numbers and coordinates, insertion
+# codes, a two character chain, an altloc and a line without element
+PARSER_LINES = [
+    "HEADER    TEST\r\n",
+    "ATOM      1  N   MET A  -3     -12.345   6.780  -0.001  1.00 20.50           N\r\n",
+    "ATOM      2  CA AMET A  -3     -11.000   7.000   1.250  0.50 21.00           C\r\n",
+    "ATOM      3  CA  GLY A  52       1.000  -2.000   3.000  1.00  0.00           C\r\n",
+    "ATOM      4  CA  SER A  52A      4.500   5.500  -6.500  1.00  9.99           C\r\n",
+    "HETATM    5 ZN    ZNMi 101      -0.500  99.999-100.000  1.00 30.00          ZN\r\n",
+    "ATOM      6  CA  ALA A  53B      1.000   1.000   1.000  1.00  1.00\r\n",
+    "END\r\n",
+]
+
+
+def test_column_parser_matches_line_parser(tmp_path):
+    pdb_file = tmp_path / "1ABC.pdb"
+    pdb_file.write_bytes("".join(PARSER_LINES).encode())
+    rows = pal.read_pdb_atms(PARSER_LINES)
+    columns = pal.read_pdb_columns(str(pdb_file), pal.PDB_COLUMN_KEYS)
+    assert len(rows) == 6
+    for idx, name in enumerate(pal.PDB_COLUMN_KEYS):
+        values = [row[idx] for row in rows]
+        if name in pal.PDB_INT_COLUMNS:
+            assert columns[name].tolist() == [int(i) for i in values]
+        elif name in pal.PDB_FLOAT_COLUMNS:
+            np.testing.assert_array_equal(columns[name],
+                                          np.array(values, dtype=np.float32))
+        else:
+            assert columns[name].tolist() == values
+    assert columns["resseq"].tolist() == [-3, -3, 52, 52, 101, 53]
+    assert columns["icode"].tolist() == ["", "", "", "A", "", "B"]
+
+
+def test_structure_from_file_matches_from_lines(tmp_path):
+    pdb_file = tmp_path / "1ABC.pdb"
+    pdb_file.write_bytes("".join(PARSER_LINES).encode())
+    from_file = pal.Structure.from_file(str(pdb_file), ["ATOM"])
+    from_lines = pal.Structure.from_lines(PARSER_LINES, ["ATOM"])
+    assert len(from_file) == len(from_lines) == 5
+    for name in pal.Structure.INTERNED_COLUMNS:
+        assert from_file.column(name).tolist() == from_lines.column(name).tolist()
+    for name in pal.Structure.ARRAY_COLUMNS:
+        np.testing.assert_array_equal(getattr(from_file, name),
+                                      getattr(from_lines, name))
+
+
+def test_read_pdb_atms_of_structure_is_a_structure():
+    structure = pal.Structure.from_lines(PARSER_LINES)
+    atoms = pal.read_pdb_atms(structure, ["HETATM"])
+    assert isinstance(atoms, pal.Structure)
+    assert atoms.column("chain").tolist() == ["Mi"]
+    assert len(pal.read_pdb_atms(PARSER_LINES, ["HETATM"])) == 1
+
+
+def test_align_sequences_point_mutant_by_position():
+    wt = "MKTAYIAKQRQISFVKSHFSRQ"
+    mutant = wt[:5] + "W" + wt[6:]
+    index_a, index_b = pal.align_sequences(wt, mutant)
+    assert index_a.tolist() == index_b.tolist() == list(range(len(wt)))
+
+
+def test_align_sequences_missing_loop():
+    wt = "MKTAYIAKQRQISFVKSHFSRQ"
+    # A model without the loop IAKQ
+    model = wt[:5] + wt[9:]
+    index_a, index_b = pal.align_sequences(wt, model)
+    assert index_a.tolist() == list(range(5)) + list(range(9, len(wt)))
+    assert index_b.tolist() == list(range(len(model)))
+    assert "".join(wt[i] for i in index_a) == model
+
+
+def test_align_sequences_insertion():
+    wt = "MKTAYIAKQRQISFVKSHFSRQ"
+    model = wt[:10] + "GGG" + wt[10:]
+    index_a, index_b = pal.align_sequences(wt, model)
+    assert index_a.tolist() == list(range(len(wt)))
+    assert index_b.tolist() == list(range(10)) + list(range(13, len(model)))
+
+
+def test_residue_mapping_skips_missing_loop_and_keeps_insertion_codes():
+    wt_sequence = "MKTAYIAKQRQISF"
+    wt_residues = [(i, "") for i in range(1, 6)] + [(5, "A")] + \
+        [(i, "") for i in range(6, 14)]
+    # The model is numbered from 101 with 102A, and lacks the residues 6 to 8
+    model_sequence = wt_sequence[:6] + wt_sequence[9:]
+    model_residues = [(101, ""), (102, ""), (102, "A")] + \
+        [(i, "") for i in range(103, 103 + len(model_sequence) - 3)]
+    mapping = pal.residue_mapping(chain_structure(wt_sequence, wt_residues),
+                                  chain_structure(model_sequence, model_residues),
+                                  "A")
+    assert mapping == {"1": "101", "2": "102", "3": "102A", "4": "103",
+                       "5": "104", "5A": "105", "9": "106", "10": "107",
+                       "11": "108", "12": "109", "13": "110"}
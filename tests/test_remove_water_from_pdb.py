@@ -0,0 +1,25 @@
+"""Tests of the remove_water_from_pdb script."""
+
+import sys
+
+import pytest
+
+import remove_water_from_pdb
+
+from test_pdb_analysis_lib import atom
+
+
+def test_bad_file_does_not_stop_the_batch(tmp_path, monkeypatch):
+    good = tmp_path / "1ABC.pdb"
+    good.write_text(atom(1, "A", 1)
+                    + atom(2, "A", 2, name="O", resname="HOH", record="HETATM"))
+    missing = tmp_path / "2ABC.pdb"
+    output_folder = tmp_path / "clean" / "new"
+    monkeypatch.setattr(sys, "argv", ["remove_water_from_pdb.py",
+                                      str(missing), str(good),
+                                      "-o", str(output_folder)])
+    with pytest.raises(SystemExit) as exit_info:
+        remove_water_from_pdb.main()
+    assert exit_info.value.code == 1
+    assert sorted(p.name for p in output_folder.iterdir()) == ["1ABC_clean.pdb"]
+    assert (output_folder / "1ABC_clean.pdb").read_text() == atom(1, "A", 1)
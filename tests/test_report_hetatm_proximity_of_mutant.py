@@ -0,0 +1,39 @@
+"""Tests of the report_hetatm_proximity_of_mutant script."""
+
+import sys
+
+import pytest
+
+import report_hetatm_proximity_of_mutant as report
+
+from test_pdb_analysis_lib import atom
+
+
+MUTANT_LINES = [
+    atom(1, "A", 319, resname="TYR", xyz=(0.0, 0.0, 0.0)),
+    atom(2, "A", 400, name="ZN", resname="ZN", record="HETATM", xyz=(3.0, 4.0, 0.0)),
+    atom(3, "A", 401, name="ZN", resname="ZN", record="HETATM", xyz=(30.0, 0.0, 0.0)),
+]
+
+
+def run_report(tmp_path, monkeypatch, lines):
+    pdb_file = tmp_path / "1CI6_A_319_Y.pdb"
+    pdb_file.write_text("".join(lines))
+    monkeypatch.setattr(sys, "argv", ["report_hetatm_proximity_of_mutant.py",
+                                      "-i", str(pdb_file)])
+    report.main()
+
+
+def test_reports_hetatms_near_mutation(tmp_path, monkeypatch, capsys):
+    title = "TITLE     Mutated chain_residue A_319; Transcription Factor\n"
+    run_report(tmp_path, monkeypatch, [title] + MUTANT_LINES)
+    header, *rows = capsys.readouterr().out.splitlines()
+    assert header.startswith("Minimum Distance From Mutation,")
+    assert len(rows) == 1
+    assert rows[0].startswith("5.0,HETATM,2,ZN")
+
+
+@pytest.mark.parametrize("title", [[], ["TITLE     PDB From iCn3D 1CI6\n"]])
+def test_missing_mutation_title_is_reported(tmp_path, monkeypatch, title):
+    with pytest.raises(ValueError, match="no TITLE with the mutated chain_residue"):
+        run_report(tmp_path, monkeypatch, title + MUTANT_LINES)
@@ -0,0 +1,96 @@
+"""Tests of residue_contacts against brute force distances."""
+
+import itertools
+
+import numpy as np
+import pytest
+
+import pdb_analysis_lib as pal
+import residue_contacts
+
+from test_pdb_analysis_lib import atom
+
+
+ATOM_NAMES = ("N", "CA", "C")
+
+
+def random_structure(xyz):
+    """Return a Structure of chain A with three atoms per residue."""
+    lines = [atom(i + 1, "A", i // len(ATOM_NAMES) + 1,
+                  name=ATOM_NAMES[i % len(ATOM_NAMES)], xyz=tuple(point))
+             for i, point in enumerate(xyz)]
+    return pal.Structure.from_lines(lines)
+
+
+def brute_force_contacts(structure, cutoff):
+    """Return {(residue_a, residue_b): minimum distance} of all atom pairs."""
+    keys = [("A", resseq, "") for resseq in structure.resseq.tolist()]
+    xyz = structure.xyz.astype(np.float64)
+    result = {}
+    for i, j in itertools.combinations(range(len(structure)), 2):
+        if keys[i] == keys[j]:
+            continue
+        dist = np.linalg.norm(xyz[i] - xyz[j])
+        pair = tuple(sorted((keys[i], keys[j])))
+        if dist <= cutoff and dist < result.get(pair, np.inf):
+            result[pair] = dist
+    return result
+
+
+@pytest.fixture
+def structures():
+    rng = np.random.default_rng(7)
+    wt_xyz = rng.uniform(0, 12, size=(12 * len(ATOM_NAMES), 3))
+    # Models move every atom a little, gaining, losing and changing contacts
+    model_xyz = [wt_xyz + rng.normal(0, 1.0, size=wt_xyz.shape) for _ in range(3)]
+    return random_structure(wt_xyz), [random_structure(i) for i in model_xyz]
+
+
+def test_contact_map_matches_brute_force(structures):
+    wt, _ = structures
+    contacts = residue_contacts.contact_map(wt, cutoff=4.5)
+    expected = brute_force_contacts(wt, 4.5)
+    found = {(a, b): dist for a, b, dist in contacts.to_rows()}
+    assert found.keys() == expected.keys()
+    for pair, dist in expected.items():
+        assert found[pair] == pytest.approx(dist, abs=1e-4)
+
+
+def test_diff_contacts_matches_brute_force(structures):
+    wt, models = structures
+    cutoff, tolerance = 4.5, 0.5
+    rows = residue_contacts.diff_contacts(
+        residue_contacts.contact_map(wt, cutoff),
+        [residue_contacts.contact_map(i, cutoff) for i in models],
+        tolerance)
+    wt_contacts = brute_force_contacts(wt, cutoff)
+    expected = {}
+    for model, structure in enumerate(models):
+        model_contacts = brute_force_contacts(structure, cutoff)
+        for pair in wt_contacts.keys() | model_contacts.keys():
+            wt_dist = wt_contacts.get(pair, np.nan)
+            model_dist = model_contacts.get(pair, np.nan)
+            if pair not in model_contacts:
+                status = "lost"
+            elif pair not in wt_contacts:
+                status = "gained"
+            elif abs(wt_dist - model_dist) > tolerance:
+                status = "changed"
+            else:
+                continue
+            expected[(model, *pair)] = (status, wt_dist, model_dist)
+    found = {(model, a, b): (status, wt_dist, model_dist)
+             for model, a, b, status, wt_dist, model_dist in rows}
+    assert len(found) == len(rows)
+    assert found.keys() == expected.keys()
+    assert {i[0] for i in found.values()} == {"gained", "lost", "changed"}
+    for key, (status, wt_dist, model_dist) in expected.items():
+        assert found[key][0] == status
+        assert found[key][1] == pytest.approx(wt_dist, abs=1e-4, nan_ok=True)
+        assert found[key][2] == pytest.approx(model_dist, abs=1e-4, nan_ok=True)
+
+
+def test_diff_contacts_of_identical_models_is_empty(structures):
+    wt, _ = structures
+    contacts = residue_contacts.contact_map(wt)
+    assert residue_contacts.diff_contacts(contacts, [contacts, contacts]) == []
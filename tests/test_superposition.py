@@ -0,0 +1,73 @@
+"""Tests of the Kabsch superposition of superposition."""
+
+import numpy as np
+import pytest
+
+import superposition
+
+from test_pdb_analysis_lib import chain_structure
+
+
+SEQUENCE = "MKTAYIAKQRQISFVKSHFSRQ"
+
+
+def rotation_matrix(axis, angle):
+    """Return the rotation of angle radians about an axis."""
+    x, y, z = np.asarray(axis, dtype=np.float64) / np.linalg.norm(axis)
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([
+        [c + x * x * (1 - c), x * y * (1 - c) - z * s, x * z * (1 - c) + y * s],
+        [y * x * (1 - c) + z * s, c + y * y * (1 - c), y * z * (1 - c) - x * s],
+        [z * x * (1 - c) - y * s, z * y * (1 - c) + x * s, c + z * z * (1 - c)],
+    ])
+
+
+@pytest.fixture
+def reference():
+    return np.random.default_rng(3).uniform(-10, 10, size=(len(SEQUENCE), 3))
+
+
+def test_kabsch_recovers_known_rotation(reference):
+    rotations = [rotation_matrix((1, 2, 3), 0.7), rotation_matrix((0, 0, 1), 3.0)]
+    translations = [np.array([5.0, -3.0, 2.0]), np.array([0.0, 10.0, 0.0])]
+    # Models are the reference moved away, to be moved back by the fit
+    coords = np.stack([(reference - t) @ r for r, t in zip(rotations, translations)])
+    weights = np.ones(coords.shape[:2])
+    rotation, translation = superposition.kabsch(reference, coords, weights)
+    for i, (r, t) in enumerate(zip(rotations, translations)):
+        np.testing.assert_allclose(rotation[i], r, atol=1e-10)
+        np.testing.assert_allclose(translation[i], t, atol=1e-10)
+        moved = coords[i] @ rotation[i].T + translation[i]
+        np.testing.assert_allclose(moved, reference, atol=1e-10)
+        assert np.sqrt(((moved - reference) ** 2).sum(axis=1).mean()) < 1e-10
+
+
+def test_kabsch_ignores_atoms_of_zero_weight(reference):
+    r = rotation_matrix((1, -1, 0), 1.2)
+    coords = reference @ r
+    # A displaced atom left out of the fit does not change it
+    coords[0] += 50
+    weights = np.ones((1, len(reference)))
+    weights[0, 0] = 0
+    rotation, translation = superposition.kabsch(reference, coords[None], weights)
+    moved = coords[1:] @ rotation[0].T + translation[0]
+    np.testing.assert_allclose(moved, reference[1:], atol=1e-10)
+
+
+def test_superpose_models_of_moved_and_truncated_models(reference):
+    residues = [(i, "") for i in range(1, len(SEQUENCE) + 1)]
+    wt = chain_structure(SEQUENCE, residues, xyz=reference)
+    moved = reference @ rotation_matrix((2, 1, 0), 0.5) + 4.0
+    # A second model lacks residues 6 to 9 and is numbered from 101
+    kept = list(range(5)) + list(range(9, len(SEQUENCE)))
+    truncated = chain_structure("".join(SEQUENCE[i] for i in kept),
+                                [(101 + i, "") for i in range(len(kept))],
+                                xyz=moved[kept])
+    rmsd, wt_residues, residue_rmsd = superposition.superpose_models(
+        wt, [chain_structure(SEQUENCE, residues, xyz=moved), truncated], "A")
+    assert wt_residues == residues
+    # Coordinates are written with three decimals
+    np.testing.assert_allclose(rmsd, 0, atol=2e-3)
+    np.testing.assert_allclose(residue_rmsd[0], 0, atol=2e-3)
+    assert np.isnan(residue_rmsd[1, 5:9]).all()
+    np.testing.assert_allclose(residue_rmsd[1, kept], 0, atol=2e-3)
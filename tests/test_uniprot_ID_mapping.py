@@ -0,0 +1,138 @@
+"""Tests of the asyncio UniProt client against a local mock of the REST API."""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import uniprot_ID_mapping as uim
+
+
+REQUEST_DELAY = 0.02
+
+
+class UniProtHandler(BaseHTTPRequestHandler):
+    """Mock of the ID mapping endpoints, mapping each ID X to X_UP.
+
+    A job reports RUNNING for the first server.running polls of its status,
+    and its results are served in pages linked by cursor. Every request is
+    held for REQUEST_DELAY seconds, so concurrent requests overlap, and the
+    most requests seen in flight at once is counted.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self._begin()
+        length = int(self.headers["Content-Length"])
+        form = parse_qs(self.rfile.read(length).decode())
+        with self.server.lock:
+            job_id = f"job{len(self.server.jobs)}"
+            self.server.jobs[job_id] = form["ids"][0].split(",")
+            self.server.polls[job_id] = []
+        self._end({"jobId": job_id})
+
+    def do_GET(self):
+        self._begin()
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        _, _, endpoint, job_id = url.path.split("/")
+        if endpoint == "status":
+            with self.server.lock:
+                self.server.polls[job_id].append(time.monotonic())
+                running = len(self.server.polls[job_id]) <= self.server.running
+            self._end({"jobStatus": "RUNNING" if running else "FINISHED"})
+        elif endpoint == "details":
+            self._end({"redirectURL": f"{self.server.url}/idmapping/results/{job_id}"
+                                      "?format=json"})
+        else:
+            ids = self.server.jobs[job_id]
+            size = int(query["size"][0])
+            cursor = int(query.get("cursor", ["0"])[0])
+            page = ids[cursor:cursor + size]
+            headers = {}
+            if cursor + size < len(ids):
+                headers["Link"] = (f'<{self.server.url}/idmapping/results/{job_id}'
+                                   f'?format=json&size={size}&cursor={cursor + size}>; '
+                                   'rel="next"')
+            self._end({"results": [{"from": i, "to": f"{i}_UP"} for i in page]},
+                      headers)
+
+    def _begin(self):
+        with self.server.lock:
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight,
+                                            self.server.in_flight)
+        time.sleep(REQUEST_DELAY)
+
+    def _end(self, value, headers=None):
+        body = json.dumps(value).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, header in (headers or {}).items():
+            self.send_header(key, header)
+        self.end_headers()
+        with self.server.lock:
+            self.server.in_flight -= 1
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def uniprot_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), UniProtHandler)
+    server.lock = threading.Lock()
+    server.jobs = {}
+    server.polls = {}
+    server.running = 0
+    server.in_flight = 0
+    server.max_in_flight = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def map_ids(server, ids, **client_options):
+    """Map ids through the mock server with an uncached client."""
+    options = {"api_url": server.url,
+               "polling_interval": 0.01,
+               "cache": uim.ResponseCache()}
+    options.update(client_options)
+    return uim.map_ids("PDB", "UniProtKB", ids, **options)
+
+
+def test_job_status_is_polled_with_backoff(uniprot_server):
+    uniprot_server.running = 4
+    results = map_ids(uniprot_server, ["1ABC"],
+                      polling_interval=0.05,
+                      max_polling_interval=0.2)
+    assert results["results"] == [{"from": "1ABC", "to": "1ABC_UP"}]
+    polls = uniprot_server.polls["job0"]
+    assert len(polls) == 5
+    gaps = [b - a for a, b in zip(polls, polls[1:])]
+    for gap, interval in zip(gaps, [0.05, 0.1, 0.2, 0.2]):
+        assert interval <= gap < interval + 0.1
+
+
+def test_requests_per_host_are_capped(uniprot_server):
+    ids = [f"{i}ABC" for i in range(12)]
+    results = map_ids(uniprot_server, ids, batch_size=1, max_concurrency=3)
+    assert len(uniprot_server.jobs) == len(ids)
+    assert len(results["results"]) == len(ids)
+    assert uniprot_server.max_in_flight == 3
+
+
+def test_paginated_results_are_complete_and_in_order(uniprot_server):
+    ids = [f"{i}ABC" for i in range(23)]
+    results = map_ids(uniprot_server, ids, batch_size=10, page_size=4)
+    assert len(uniprot_server.jobs) == 3
+    assert results["results"] == [{"from": i, "to": f"{i}_UP"} for i in ids]
+    assert results["failedIds"] == []
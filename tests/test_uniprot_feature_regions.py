@@ -0,0 +1,29 @@
+"""Tests of the offline mode of uniprot_feature_regions."""
+
+import logging
+import sys
+
+import pytest
+
+import uniprot_feature_regions as ufr
+import uniprot_ID_mapping
+
+
+@pytest.mark.parametrize("id_, db", [("P12345", "uniprot"), ("1ABC", "pdb")])
+def test_uncached_id_offline_exits(tmp_path, monkeypatch, caplog, id_, db):
+    ptms = tmp_path / "Combined_PTMs.json"
+    ptms.write_text("{}")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(uniprot_ID_mapping, "RESPONSE_CACHE",
+                        uniprot_ID_mapping.RESPONSE_CACHE)
+    monkeypatch.setattr(sys, "argv", ["uniprot_feature_regions.py", id_, db,
+                                      "--ptms", str(ptms),
+                                      "--cache", str(tmp_path / "cache.db"),
+                                      "--offline"])
+    with caplog.at_level(logging.ERROR):
+        with pytest.raises(SystemExit) as exit_info:
+            ufr.main()
+    uniprot_ID_mapping.RESPONSE_CACHE.close()
+    assert exit_info.value.code == 1
+    assert f"{id_} not cached (offline)" in caplog.text
+    assert not (tmp_path / f"{id_}_regions.json").exists()
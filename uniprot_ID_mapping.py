@@ -1,9 +1,13 @@
 # Source: https://www.uniprot.org/help/id_mapping
 
+import os
 import re
 import time
 import json
 import zlib
+import sqlite3
+import asyncio
+import threading
 from xml.etree import ElementTree
 from urllib.parse import urlparse, parse_qs, urlencode
 import requests
@@ -11,6 +15,15 @@ from requests.adapters import HTTPAdapter, Retry
 
 
 POLLING_INTERVAL = 3
+MAX_POLLING_INTERVAL = 30
+MAX_CONCURRENCY = 8
+PAGE_SIZE = 500
+JOB_BATCH_SIZE = 1000
+MAX_IDS_PER_JOB = 100000
+CACHE_TTL = 7 * 24 * 3600
+CACHE_BYTES = 1024 * 2**20
+CACHE_FILE_ENV = "UNIPROT_CACHE_FILE"
+OFFLINE_ENV = "UNIPROT_OFFLINE"
 
 API_URL = "https://rest.uniprot.org"
 
@@ -21,7 +34,7 @@ session.mount("https://", HTTPAdapter(max_retries=retries))
 
 
 def submit_id_mapping(from_db, to_db, ids):
-    request = requests.post(
+    request = session.post(
         f"{API_URL}/idmapping/run",
         data={"from": from_db, "to": to_db, "ids": ",".join(ids)},
     )
@@ -47,7 +60,7 @@ def check_id_mapping_results_ready(job_id):
                 print(f"Retrying in {POLLING_INTERVAL}s")
                 time.sleep(POLLING_INTERVAL)
             else:
-                raise Exception(request["jobStatus"])
+                raise Exception(j["jobStatus"])
         else:
             return bool(j["results"] or j["failedIds"])
 
@@ -146,3 +159,309 @@ def get_id_mapping_results_search(url):
     else:
         raise ValueError(f"pbd id {''.join(results['failedIds'])}  query failed")
     return results
+
+
+def _pooled_session(max_connections):
+    pooled = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_connections,
+                          pool_maxsize=max_connections,
+                          max_retries=retries)
+    pooled.mount("https://", adapter)
+    pooled.mount("http://", adapter)
+    return pooled
+
+
+def _with_page_size(url, size):
+    parsed = urlparse(url)
+    query = parse_qs(parsed.query)
+    query.setdefault("size", [size])
+    return parsed._replace(query=urlencode(query, doseq=True)).geturl()
+
+
+class CacheMiss(LookupError):
+    """A response is not in the cache of an offline ResponseCache."""
+
+
+class ResponseCache:
+    """SQLite cache of UniProt JSON responses shared across runs.
+
+    Responses are stored compressed under a key, the request URL for
+    entries, with their ETag and the time they were fetched. A response is
+    served without a request for ttl seconds, after which it is revalidated
+    with If-None-Match when an ETag was stored. In offline mode cached
+    responses are always served, however old, and a miss raises CacheMiss.
+    When the stored responses exceed max_bytes, the least recently used are
+    evicted. A cache without a path stores nothing.
+    """
+
+    def __init__(self, path=None, ttl=CACHE_TTL, max_bytes=CACHE_BYTES, offline=False):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self._lock = threading.Lock()
+        self._connection = None
+        if path is not None:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Requests of AsyncUniProtClient use the cache from worker threads
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            with self._connection:
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, etag TEXT, fetched REAL, "
+                    "accessed REAL, size INTEGER, body BLOB)")
+                self._connection.execute(
+                    "CREATE INDEX IF NOT EXISTS responses_accessed "
+                    "ON responses (accessed)")
+
+    def lookup(self, key):
+        """Return (value, etag, fresh) of a cached response, or None."""
+        if self._connection is None:
+            return None
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT etag, fetched, body FROM responses WHERE key = ?",
+                (key,)).fetchone()
+            if row is None:
+                return None
+            self._connection.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+        etag, fetched, body = row
+        value = json.loads(zlib.decompress(body))
+        return value, etag, time.time() - fetched < self.ttl
+
+    def store(self, key, value, etag=None):
+        """Store a response, evicting the least recently used over max_bytes."""
+        if self._connection is None:
+            return
+        body = zlib.compress(json.dumps(value).encode())
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, etag, now, now, len(body), body))
+            total = self._connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                evicted = self._connection.execute(
+                    "SELECT key, size FROM responses WHERE key != ? "
+                    "ORDER BY accessed", (key,))
+                keys = []
+                for old_key, size in evicted:
+                    if total <= self.max_bytes:
+                        break
+                    keys.append((old_key,))
+                    total -= size
+                self._connection.executemany(
+                    "DELETE FROM responses WHERE key = ?", keys)
+
+    def revalidated(self, key):
+        """Mark a cached response as fresh again."""
+        if self._connection is None:
+            return
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE responses SET fetched = ? WHERE key = ?", (time.time(), key))
+
+    def get_json(self, session, url, **kwargs):
+        """GET a JSON response from url through the cache."""
+        cached = self.lookup(url)
+        if cached is not None and (cached[2] or self.offline):
+            return cached[0]
+        if self.offline:
+            raise CacheMiss(f"{url} is not cached (offline)")
+        headers = {"Accept": "application/json", **kwargs.pop("headers", {})}
+        if cached is not None and cached[1]:
+            headers["If-None-Match"] = cached[1]
+        response = session.get(url, headers=headers, **kwargs)
+        if response.status_code == 304 and cached is not None:
+            self.revalidated(url)
+            return cached[0]
+        response.raise_for_status()
+        value = response.json()
+        self.store(url, value, response.headers.get("ETag"))
+        return value
+
+    def clear(self):
+        """Remove all cached responses."""
+        if self._connection is None:
+            return
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM responses")
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def id_mapping_key(from_db, to_db, id_):
+    """Cache key of the ID mapping results of one source ID."""
+    return f"idmapping:{from_db}:{to_db}:{id_}"
+
+
+RESPONSE_CACHE = ResponseCache(os.environ.get(CACHE_FILE_ENV),
+                               offline=bool(os.environ.get(OFFLINE_ENV)))
+
+
+class AsyncUniProtClient:
+    """Asyncio client for many concurrent UniProt ID mapping jobs.
+
+    Requests go through a pooled, retrying requests session run in worker
+    threads, so connections are kept alive and shared by all jobs. Each host
+    gets its own cap of max_concurrency requests in flight. Job status is
+    polled with exponential backoff, from polling_interval up to
+    max_polling_interval. The pages of one job are linked by cursors and so
+    are fetched in order, while the pages of different jobs are fetched
+    concurrently.
+
+    Entries and the results of ID mapping jobs go through a ResponseCache,
+    RESPONSE_CACHE by default, so repeated queries are served locally.
+
+    api_url and session can be replaced to run against a local mock of the
+    REST endpoints.
+    """
+
+    def __init__(self,
+                 api_url=API_URL,
+                 max_concurrency=MAX_CONCURRENCY,
+                 session=None,
+                 polling_interval=POLLING_INTERVAL,
+                 max_polling_interval=MAX_POLLING_INTERVAL,
+                 page_size=PAGE_SIZE,
+                 cache=None):
+        self.api_url = api_url
+        self.max_concurrency = max_concurrency
+        self.session = session if session is not None else _pooled_session(max_concurrency)
+        self.polling_interval = polling_interval
+        self.max_polling_interval = max_polling_interval
+        self.page_size = page_size
+        self.cache = cache if cache is not None else RESPONSE_CACHE
+        self._semaphores = {}
+
+    def _limit(self, url):
+        host = urlparse(url).netloc
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphores[host]
+
+    async def request(self, method, url, **kwargs):
+        if self.cache.offline:
+            raise CacheMiss(f"{method} {url} in offline mode")
+        async with self._limit(url):
+            response = await asyncio.to_thread(self.session.request,
+                                               method, url, **kwargs)
+        response.raise_for_status()
+        return response
+
+    async def submit_id_mapping(self, from_db, to_db, ids):
+        response = await self.request(
+            "POST",
+            f"{self.api_url}/idmapping/run",
+            data={"from": from_db, "to": to_db, "ids": ",".join(ids)},
+        )
+        return response.json()["jobId"]
+
+    async def wait_for_job(self, job_id):
+        interval = self.polling_interval
+        while True:
+            response = await self.request(
+                "GET", f"{self.api_url}/idmapping/status/{job_id}")
+            j = response.json()
+            if "jobStatus" in j:
+                if j["jobStatus"] in ("NEW", "RUNNING"):
+                    await asyncio.sleep(interval)
+                    interval = min(interval * 2, self.max_polling_interval)
+                elif j["jobStatus"] == "FINISHED":
+                    return True
+                else:
+                    raise Exception(j["jobStatus"])
+            else:
+                return bool(j.get("results") or j.get("failedIds"))
+
+    async def get_results(self, job_id):
+        response = await self.request(
+            "GET", f"{self.api_url}/idmapping/details/{job_id}")
+        url = _with_page_size(response.json()["redirectURL"], self.page_size)
+        results = {"results": [], "failedIds": []}
+        while url:
+            response = await self.request("GET", url)
+            results = combine_batches(results, response.json(), "json")
+            url = get_next_link(response.headers)
+        return results
+
+    async def get_entry(self, accession):
+        url = f"{self.api_url}/uniprotkb/{accession}"
+        cached = self.cache.lookup(url)
+        if cached is not None and (cached[2] or self.cache.offline):
+            return cached[0]
+        async with self._limit(url):
+            return await asyncio.to_thread(self.cache.get_json, self.session, url)
+
+    async def map_job(self, from_db, to_db, ids):
+        """Map one batch of IDs in a single job.
+
+        Results are cached per source ID, so any batch holding an ID mapped
+        before is served from the cache for that ID, and only the IDs
+        missing from the cache are submitted.
+        """
+        mapped = {}
+        missing = []
+        for id_ in dict.fromkeys(ids):
+            cached = self.cache.lookup(id_mapping_key(from_db, to_db, id_))
+            if cached is not None and (cached[2] or self.cache.offline):
+                mapped[id_] = cached[0]
+            else:
+                missing.append(id_)
+        if missing:
+            job_id = await self.submit_id_mapping(from_db, to_db, missing)
+            finished = await self.wait_for_job(job_id)
+            if finished:
+                job_results = await self.get_results(job_id)
+            else:
+                job_results = {"results": [], "failedIds": missing}
+            rows = {}
+            for row in job_results["results"]:
+                rows.setdefault(str(row["from"]).upper(), []).append(row)
+            failed = {str(i).upper() for i in job_results.get("failedIds", [])}
+            for id_ in missing:
+                mapped[id_] = {"results": rows.get(id_.upper(), []),
+                               "failed": id_.upper() in failed}
+                if finished:
+                    self.cache.store(id_mapping_key(from_db, to_db, id_), mapped[id_])
+        results = {"results": [], "failedIds": []}
+        for id_ in dict.fromkeys(ids):
+            results["results"].extend(mapped[id_]["results"])
+            if mapped[id_]["failed"]:
+                results["failedIds"].append(id_)
+        return results
+
+    async def map_ids(self, from_db, to_db, ids, batch_size=JOB_BATCH_SIZE):
+        """Map IDs in batches of batch_size jobs run concurrently.
+
+        Returns the combined JSON results of all jobs, with "results" and
+        "failedIds" lists.
+        """
+        batches = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+        batch_results = await asyncio.gather(
+            *[self.map_job(from_db, to_db, batch) for batch in batches])
+        results = {"results": [], "failedIds": []}
+        for batch_result in batch_results:
+            results = combine_batches(results, batch_result, "json")
+        return results
+
+    def close(self):
+        self.session.close()
+
+
+def map_ids(from_db, to_db, ids, batch_size=JOB_BATCH_SIZE, **client_options):
+    """Map IDs with an AsyncUniProtClient from synchronous code.
+
+    In offline mode, IDs missing from the cache raise CacheMiss.
+    """
+    client = AsyncUniProtClient(**client_options)
+    try:
+        return asyncio.run(client.map_ids(from_db, to_db, list(ids), batch_size))
+    finally:
+        client.close()
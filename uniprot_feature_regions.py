@@ -1,6 +1,12 @@
 from uniprot_ID_mapping import *
+import uniprot_ID_mapping
+from ptm_store import open_ptms
 import requests
+import asyncio
 import json
+import logging
+import os
+import sys
 import argparse
 
 
@@ -9,15 +15,59 @@ def argument_parser():
     required_arguments = parser.add_argument_group("Required Arguments")
     required_arguments.add_argument("id",
                                     type=str,
-                                    help="query ID")
+                                    nargs="?",
+                                    help="query ID, omitted with --id_list")
     required_arguments.add_argument("db",
                                     type=str,
                                     help="data base can be either uniprot or pdb")
     parser.add_argument("-o",
                         "--output",
                         type=str,
-                        help="output json filename")
+                        help=("output json filename, or with --id_list a merged "
+                              "json lines file (.jsonl) of every ID"))
+    parser.add_argument("-l",
+                        "--id_list",
+                        type=str,
+                        help=("bulk mode: file of query IDs, one per line or "
+                              "comma separated"))
+    parser.add_argument("--output_folder",
+                        type=str,
+                        default=".",
+                        help=("bulk mode: folder of one <id>_regions.json per "
+                              "ID, used when -o is not a .jsonl file"))
+    parser.add_argument("--batch_size",
+                        type=int,
+                        default=MAX_IDS_PER_JOB,
+                        help="bulk mode: PDB IDs per ID mapping job")
+    parser.add_argument("-w",
+                        "--workers",
+                        type=int,
+                        default=MAX_CONCURRENCY,
+                        help="bulk mode: concurrent requests to UniProt")
+    parser.add_argument("--ptms",
+                        type=str,
+                        help=("PTM store made by generate_combined_PTMs.py, "
+                              "default Combined_PTMs.db, or else "
+                              "Combined_PTMs.json"))
+    parser.add_argument("--cache",
+                        type=str,
+                        default=os.environ.get(CACHE_FILE_ENV),
+                        help=("SQLite file caching uniprot responses across runs, "
+                              f"default from ${CACHE_FILE_ENV}"))
+    parser.add_argument("--cache_ttl",
+                        type=float,
+                        default=CACHE_TTL,
+                        help="seconds before cached responses are revalidated")
+    parser.add_argument("--offline",
+                        action="store_true",
+                        default=bool(os.environ.get(OFFLINE_ENV)),
+                        help="only use cached responses, no network requests")
+    parser.add_argument("-v",
+                        "--verbose",
+                        action="store_true")
     args = parser.parse_args()
+    if args.id is None and args.id_list is None:
+        parser.error("an id or --id_list is required")
     return args
 
 
@@ -27,8 +77,12 @@ def query_uniprot(uniprotkb):
     :param uniprotkb: uniprot id
     :returns: dictionary
     """
-    api_url = f'https://rest.uniprot.org/uniprot/{uniprotkb}'
-    return requests.get(api_url).json()
+    api_url = f'https://rest.uniprot.org/uniprotkb/{uniprotkb}'
+    try:
+        return uniprot_ID_mapping.RESPONSE_CACHE.get_json(session, api_url)
+    except requests.HTTPError as err:
+        # invalid ids are answered with an error message
+        return err.response.json()
 
 
 def retrieve_feature_regions(data):
@@ -64,41 +118,227 @@ def retrieve_feature_regions(data):
     return features_dict
 
 
+def entry_feature_regions(data, combined_ptms):
+    """
+    Feature regions of a uniprot entry merged with its combined PTMs.
+    :param data: dictionary of a uniprot entry
+    :param combined_ptms: dictionary of PTMs by uniprot id
+    :returns: dictionary
+    """
+    features_dict = retrieve_feature_regions(data)
+    id_ = data.get('primaryAccession')
+    if id_ in combined_ptms:
+        features_dict = {**features_dict,
+                         **combined_ptms[id_]}
+    return features_dict
+
+
+def mapping_feature_regions(hits, combined_ptms):
+    """
+    Feature regions of every uniprot entry mapped from one pdb id.
+    :param hits: list of id mapping results with the same "from" id
+    :param combined_ptms: dictionary of PTMs by uniprot id
+    :returns: dictionary of feature regions by uniprot id
+    """
+    # a pdb can map to many uniprot ids (one per specie)
+    return {hit['to']['primaryAccession']:
+            entry_feature_regions(hit['to'], combined_ptms)
+            for hit in hits}
+
+
+def read_id_list(filename):
+    """
+    Read query ids, one per line or comma separated, without duplicates.
+    :param filename: path of the id list
+    :returns: list of ids in file order
+    """
+    ids = {}
+    with open(filename) as f:
+        for line in f:
+            for id_ in line.split(','):
+                if id_.strip():
+                    ids[id_.strip()] = None
+    return list(ids)
+
+
+class JSONLinesWriter:
+    """
+    Append the features of each id as one line of a json lines file,
+    {"id": ..., "features": ...}. Lines are flushed as they are written,
+    so the ids of a previous, interrupted run are kept and skipped.
+    """
+
+    def __init__(self, filename):
+        self.done = set()
+        if os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        self.done.add(json.loads(line)['id'])
+                    except (ValueError, KeyError):
+                        # a partial last line from an interrupted run
+                        continue
+        self.file_object = open(filename, 'a')
+
+    def write(self, id_, features_dict):
+        self.file_object.write(json.dumps({'id': id_, 'features': features_dict}) + '\n')
+        self.file_object.flush()
+        self.done.add(id_)
+
+    def close(self):
+        self.file_object.close()
+
+
+class FolderWriter:
+    """
+    Write the features of each id to <folder>/<id>_regions.json. Files are
+    renamed into place once complete, and existing files are skipped.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.done = {name[:-len('_regions.json')] for name in os.listdir(folder)
+                     if name.endswith('_regions.json')}
+
+    def write(self, id_, features_dict):
+        filename = os.path.join(self.folder, id_ + '_regions.json')
+        with open(filename + '.part', "w") as f:
+            f.write(json.dumps(features_dict))
+        os.replace(filename + '.part', filename)
+        self.done.add(id_)
+
+    def close(self):
+        pass
+
+
+async def _query_entry(client, id_):
+    try:
+        return id_, await client.get_entry(id_)
+    except (requests.HTTPError, CacheMiss) as err:
+        logging.warning(f"invalid uniprotKB: {id_} ({err})")
+        return id_, None
+
+
+async def bulk_feature_regions(ids, db, combined_ptms, writer,
+                               batch_size=MAX_IDS_PER_JOB,
+                               max_concurrency=MAX_CONCURRENCY):
+    """
+    Write the feature regions of many ids as their queries complete.
+    Uniprot entries are fetched concurrently, and pdb ids are mapped in
+    jobs of batch_size ids. Ids that fail are logged and not written,
+    so that they are retried by the next run.
+    :param ids: list of query ids
+    :param db: 'uniprot' or 'pdb'
+    :param combined_ptms: dictionary of PTMs by uniprot id
+    :param writer: JSONLinesWriter or FolderWriter
+    :param batch_size: number of pdb ids per id mapping job
+    :param max_concurrency: number of concurrent requests
+    """
+    client = AsyncUniProtClient(max_concurrency=max_concurrency)
+    try:
+        if db == 'uniprot':
+            tasks = [_query_entry(client, id_) for id_ in ids]
+            for task in asyncio.as_completed(tasks):
+                id_, data = await task
+                if data is not None:
+                    writer.write(id_, entry_feature_regions(data, combined_ptms))
+        else:
+            async def map_batch(batch):
+                try:
+                    return batch, await client.map_job("PDB", "UniProtKB", batch)
+                except (requests.HTTPError, CacheMiss) as err:
+                    logging.warning(f"pdb id(s) {', '.join(batch)} query failed ({err})")
+                    return batch, None
+            batches = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+            for task in asyncio.as_completed([map_batch(i) for i in batches]):
+                batch, results = await task
+                if results is None:
+                    continue
+                hits = {}
+                for hit in results['results']:
+                    hits.setdefault(hit['from'].upper(), []).append(hit)
+                failed = {id_.upper() for id_ in results['failedIds']}
+                for id_ in batch:
+                    if id_.upper() in failed:
+                        logging.warning(f"pdb id {id_} query failed")
+                        continue
+                    writer.write(id_, mapping_feature_regions(hits.get(id_.upper(), []),
+                                                              combined_ptms))
+                logging.info(f"{len(batch)} pdb id(s) mapped")
+    finally:
+        client.close()
+
+
+def bulk_main(args, combined_ptms):
+    """
+    Bulk mode of 'uniprot_feature_regions': query every id of
+    args.id_list and write the features of each as soon as it is done.
+    """
+    ids = read_id_list(args.id_list)
+    if args.output is not None and args.output.endswith('.jsonl'):
+        writer = JSONLinesWriter(args.output)
+    else:
+        writer = FolderWriter(args.output_folder)
+    try:
+        todo = [id_ for id_ in ids if id_ not in writer.done]
+        logging.info(f"{len(ids) - len(todo)} of {len(ids)} id(s) already done")
+        asyncio.run(bulk_feature_regions(todo, args.db, combined_ptms, writer,
+                                         args.batch_size, args.workers))
+    finally:
+        writer.close()
+
+
 def main():
     """
     'uniprot_feature_regions' takes as input two arguments:
     (i) id, (ii) database (options are: 'uniprot' or 'pdb')
     and returns a json file containing the feature regions of
-    each uniprot id.
+    each uniprot id. With --id_list, a file of ids is queried in
+    bulk instead.
     """
     args = argument_parser()
-    with open('Combined_PTMs.json', "r") as f:
-        combined_ptms = json.load(f)
-    if args.db in ['uniprot', 'pdb']:
+    if args.verbose:
+        log_level = logging.DEBUG
+    else:
+        log_level = logging.WARNING
+    logging.basicConfig(level=log_level)
+    if args.offline and args.cache is None:
+        raise ValueError("--offline needs a --cache file")
+    uniprot_ID_mapping.RESPONSE_CACHE = ResponseCache(args.cache,
+                                                      ttl=args.cache_ttl,
+                                                      offline=args.offline)
+    if args.ptms is not None:
+        ptms_file = args.ptms
+    elif os.path.exists('Combined_PTMs.db'):
+        ptms_file = 'Combined_PTMs.db'
+    else:
+        ptms_file = 'Combined_PTMs.json'
+    combined_ptms = open_ptms(ptms_file)
+    if args.db in ['uniprot', 'pdb'] and args.id_list is not None:
+        bulk_main(args, combined_ptms)
+    elif args.db in ['uniprot', 'pdb']:
         features_dict = {}
-        if args.db == 'uniprot':
-            data = query_uniprot(args.id)
-            if 'messages' in data:
-                raise ValueError(f"invalid uniprotKB: {args.id}")
-            features_dict = retrieve_feature_regions(data)
-            if args.id in combined_ptms:
-                features_dict = {**features_dict,
-                                 **combined_ptms[args.id]}
-        elif args.db == 'pdb':
-            job_id = submit_id_mapping(from_db="PDB",
-                                       to_db="UniProtKB",
-                                       ids=[args.id])
-            if check_id_mapping_results_ready(job_id):
-                link = get_id_mapping_results_link(job_id)
-                results = get_id_mapping_results_search(link)
-                # a pdb can map to many uniprot ids (one per specie)
-                for hit in results['results']:
-                    id_ = hit['to']['primaryAccession']
-                    feature_hits_dict = retrieve_feature_regions(hit['to'])
-                    if id_ in combined_ptms:
-                        feature_hits_dict = {**feature_hits_dict,
-                                             **combined_ptms[id_]}
-                    features_dict[hit['to']['primaryAccession']] = feature_hits_dict
+        try:
+            if args.db == 'uniprot':
+                data = query_uniprot(args.id)
+                if 'messages' in data:
+                    raise ValueError(f"invalid uniprotKB: {args.id}")
+                features_dict = retrieve_feature_regions(data)
+                if args.id in combined_ptms:
+                    features_dict = {**features_dict,
+                                     **combined_ptms[args.id]}
+            elif args.db == 'pdb':
+                results = map_ids(from_db="PDB",
+                                  to_db="UniProtKB",
+                                  ids=[args.id])
+                if results['failedIds']:
+                    raise ValueError(f"pbd id {args.id}  query failed")
+                features_dict = mapping_feature_regions(results['results'],
+                                                        combined_ptms)
+        except CacheMiss:
+            logging.error(f"{args.db} id {args.id} not cached (offline)")
+            sys.exit(1)
         if args.output is not None and '.json' in args.output:
             filename = args.output
         else: